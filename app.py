@@ -3,17 +3,41 @@
 基于 Textual 框架的现代 TUI 应用
 支持 Gemini + 智谱 GLM 双引擎
 """
+import sys
+import threading
+from pathlib import Path
+
+from rich.markup import escape
 from textual.app import App, ComposeResult
-from textual.widgets import Header, Footer, Input, Static
+from textual.widgets import Header, Footer, Input, Static, Tabs, Tab
 from textual.containers import ScrollableContainer
 from textual.binding import Binding
-from textual import work
+from textual import work, events
 
 from widgets.message_log import MessageLog, InlineInput, ShortcutTriggered
-from services.gemini_service import GeminiService
-from services.zhipu_service import ZhipuService
-from config.settings import PRIMARY_SERVICE, ENABLE_WEB_SEARCH, ZHIPU_MODELS, DEFAULT_ZHIPU_MODEL
+from widgets.frame_scheduler import FrameScheduler
+from widgets.prompt_queue import PromptQueue
+from services.session import ChatSession, MessageRecord, StreamLimiter, PathChange
+from services.cancel import CancelToken, StreamCancelled, AvoidedTokenEstimator
+from services.context_cache import context_cache
+from services.quota import quota_ledger, format_tokens
+from services.router import router, provider_of
+from services.compare import CompareRun, CompareResult, run_models, load_results, summarize
+from utils.tracing import tracer
+from utils.text_width import pad
+from utils.code_index import CodeIndex
+from utils.highlight import highlight_cache
+from utils.theme_engine import DEFAULT_FLAVOR, CachedStylesheet, flavor_variables, load_flavors
+from utils.markdown_stream import MarkdownStream
+from utils.input_history import input_history
+from utils import dev_reload
+from config.settings import ENABLE_WEB_SEARCH, ZHIPU_MODELS, MAX_CONCURRENT_STREAMS, COMPARE_MODELS, GEMINI_MODELS
+
+# /save 默认保存目录
+SAVE_CODE_DIR = "code_snippets"
 
+# 中断的回答在界面上追加的提示 (Markdown)
+CANCELLED_NOTE = "\n\n> ⏹ *回答已中断 (内容不完整)*"
 
 class CyberpunkChatApp(App):
     """🗡️ 六脉神剑真厉害 - 极客剑灵助手"""
@@ -21,7 +45,7 @@ class CyberpunkChatApp(App):
     TITLE = "🗡️ 六脉神剑真厉害"
     CSS_PATH = [
         "styles/base.tcss",
-        "styles/all_themes.tcss"
+        "styles/themes.tcss"
     ]
     
     BINDINGS = [
@@ -31,49 +55,74 @@ class CyberpunkChatApp(App):
         Binding("f12", "switch_flavor", "切换主题", show=True), # 切换界面风格
         Binding("ctrl+s", "switch_speed", "切换速度", show=True),
         Binding("ctrl+d", "switch_service", "切换服务", show=True),  # 主/备服务切换
+        Binding("ctrl+t", "new_session", "新建会话", show=True),
+        Binding("escape", "stop_generation", "停止生成", show=True),
+        Binding("f3", "prev_session", "上个会话", show=False),
+        Binding("f4", "next_session", "下个会话", show=False),
     ]
 
 
     def __init__(self):
         super().__init__()
-        # 初始化两个服务
-        self.zhipu_service = ZhipuService(enable_web_search=ENABLE_WEB_SEARCH)
-        self.gemini_service = GeminiService()
-
-        # 根据配置选择主服务
-        if PRIMARY_SERVICE == "zhipu":
-            self.primary_service = self.zhipu_service
-            self.fallback_service = self.gemini_service
-            self.current_model = DEFAULT_ZHIPU_MODEL  # 默认使用免费额度最多的模型
-            self._is_zhipu_primary = True
-        else:
-            self.primary_service = self.gemini_service
-            self.fallback_service = self.zhipu_service
-            self.current_model = "gemini-2.5-flash"
-            self._is_zhipu_primary = False
-
-        self.using_primary = True  # 当前是否使用主服务
-        self.current_flavor = "mocha"
-        self.flavors = ["latte", "frappe", "macchiato", "mocha"]
+        # 多标签会话：每个会话独立的服务 / 历史 / 模型 / 在途流
+        self._next_session_id = 1
+        self.sessions: list[ChatSession] = []
+        self.session = self._create_session()  # 当前活动会话
+        # 全局流式并发上限 (各会话公平排队)
+        self.stream_limiter = StreamLimiter(MAX_CONCURRENT_STREAMS)
+
         self._total_tokens = 0  # 会话总 token 统计
+        self._tokens_avoided = 0  # 中断生成省下的 token (估算)
+        self._output_estimator = AvoidedTokenEstimator()
+        # 全局帧调度器：所有动画共用一个时钟
+        self.frame_scheduler = FrameScheduler(self)
+
+        # 开发模式：恢复热重启前保存的会话
+        self._dev_commands: dev_reload.CommandReader | None = None
+        self._restored_state = dev_reload.load_state() if dev_reload.is_dev_mode() else None
+        if self._restored_state:
+            self._restore_sessions(self._restored_state)
+
+        # 主题：一套规则 + 当前风味的变量表，解析结果缓存到磁盘
+        self.current_flavor = (self._restored_state or {}).get("flavor", DEFAULT_FLAVOR)
+        self.flavors = list(load_flavors())
+        self.stylesheet = CachedStylesheet(variables=self.get_css_variables())
 
     @property
     def active_service(self):
-        """获取当前活跃的服务"""
-        return self.primary_service if self.using_primary else self.fallback_service
+        """获取当前会话活跃的服务"""
+        return self.session.active_service
 
     @property
     def service_name(self) -> str:
-        """获取当前服务名称"""
-        if self.using_primary:
-            return "智谱 GLM" if self._is_zhipu_primary else "Gemini"
-        else:
-            return "Gemini (备)" if self._is_zhipu_primary else "智谱 GLM (备)"
+        """获取当前会话的服务名称"""
+        return self.session.service_name
+
+    @property
+    def current_model(self) -> str:
+        """当前会话的模型"""
+        return self.session.current_model
+
+    @current_model.setter
+    def current_model(self, model: str) -> None:
+        self.session.current_model = model
+
+    def _create_session(self, title: str = "") -> ChatSession:
+        """新建会话 (只建数据，不挂载组件)"""
+        session = ChatSession(self._next_session_id, title)
+        self._next_session_id += 1
+        self.sessions.append(session)
+        return session
 
     def compose(self) -> ComposeResult:
         """构建 UI 布局"""
         yield Header(show_clock=True)
+        yield Tabs(
+            *[Tab(session.title, id=session.tab_id) for session in self.sessions],
+            active=self.session.tab_id, id="session-tabs",
+        )
         yield MessageLog(id="message-log")
+        yield PromptQueue(id="prompt-queue")
         # yield StatusBar(id="status-bar")  # 临时屏蔽，排查刷新问题
     
     def on_mount(self) -> None:
@@ -81,8 +130,35 @@ class CyberpunkChatApp(App):
         import platform
         from datetime import datetime
 
-        self.screen.add_class(f"theme-{self.current_flavor}")
-        message_log = self.query_one("#message-log", MessageLog)
+        if self._restored_state:
+            for record in self.session.messages:
+                self._mount_record(record)
+        else:
+            self._add_welcome_message(self.session)
+        # 创建内联输入框
+        self._ensure_input()
+        # 输入历史在后台加载索引 (条目多时不阻塞首帧)
+        threading.Thread(target=input_history.preload, name="input-history", daemon=True).start()
+        # 后台探测不健康的模型，恢复后路由自动切回
+        router.start_probes()
+
+        if dev_reload.is_dev_mode():
+            self._dev_commands = dev_reload.CommandReader()
+            self.set_interval(0.3, self._poll_dev_command, name="dev-reload")
+            self.call_after_refresh(self._report_first_paint)
+            if self._restored_state:
+                self.notify(f"已恢复 {len(self.sessions)} 个会话", title="♻️ 热重启")
+                # 重启前排队的问题继续发送
+                for session in self.sessions:
+                    if session.queue:
+                        self._on_stream_finished(session)
+                    self._refresh_tab_label(session)
+                self._refresh_queue(self.session)
+
+    def _add_welcome_message(self, session: ChatSession) -> None:
+        """新会话的启动自检信息"""
+        import platform
+        from datetime import datetime
 
         # 获取系统信息
         os_info = f"{platform.system()} {platform.release()}"
@@ -90,18 +166,19 @@ class CyberpunkChatApp(App):
         boot_time = datetime.now().strftime("%H:%M:%S")
 
         # 获取当前模型的详细信息
-        if self.current_model.startswith("glm-"):
-            model_info = ZHIPU_MODELS.get(self.current_model, {})
-            model_display = f"{model_info.get('name', self.current_model)} [dim]({model_info.get('desc', '')})[/]"
+        if session.current_model.startswith("glm-"):
+            model_info = ZHIPU_MODELS.get(session.current_model, {})
+            model_display = f"{model_info.get('name', session.current_model)} [dim]({self._quota_desc(session.current_model)})[/]"
         else:
-            model_display = self.current_model
+            model_display = session.current_model
 
         # 极简启动自检风格 (Rich Markup)
         web_status = "[cyan]联网[/]" if ENABLE_WEB_SEARCH else "[dim]离线[/]"
         welcome_msg = rf"""
 [bold bright_cyan]🗡️  SYSTEM ONLINE[/]   [dim]Target: {os_info}  ::  Python {py_ver}  ::  T={boot_time}[/]
 
-[bold white]ENGINE:[/] [cyan]{self.service_name}[/]
+[bold white]SESSION:[/] [cyan]{session.title}[/]
+[bold white]ENGINE:[/] [cyan]{session.service_name}[/]
 [bold white]MODEL:[/]  [cyan]{model_display}[/]
 [bold white]WEB:[/]    {web_status}
 
@@ -109,18 +186,73 @@ class CyberpunkChatApp(App):
   [bold green]F5   [/]  Reset Session       [bold green]F2     [/]  Clear Screen
   [bold green]F12  [/]  Switch Theme        [bold green]/save  [/]  Export Code
   [bold green]C+D  [/]  Switch Service      [bold green]↑ / ↓  [/]  History Nav
+  [bold green]C+T  [/]  New Session         [bold green]F3 / F4[/]  Prev / Next Tab
   [bold green]C+Q  [/]  Quit App[/]
 
 [dim italic]Sword Spirit is listening...[/]
 """
         # 显示欢迎消息 (直接传给 Static 渲染 Markup)
-        message_log.add_system_message(welcome_msg)
-        # 创建内联输入框
-        message_log.create_inline_input()
+        self._add_system_message(welcome_msg, session)
     
+    async def on_unmount(self) -> None:
+        """退出时关闭共享 HTTP 会话，额度账本压缩进快照"""
+        from utils.http import close_async_clients
+        await close_async_clients()
+        router.stop_probes()
+        quota_ledger.compact()
+
+    @staticmethod
+    def _quota_desc(model: str) -> str:
+        """智谱模型的额度说明：剩余 / 总额度 (按账本计算)"""
+        info = ZHIPU_MODELS[model]
+        tier = "免费" if info["type"] == "free" else "付费"
+        if not quota_ledger.available(model):
+            return f"{tier} 已用尽 / {format_tokens(info['tokens'])}"
+        return f"{tier} 剩余 {format_tokens(quota_ledger.remaining(model))} / {format_tokens(info['tokens'])}"
+
+    @staticmethod
+    def _model_name(model: str) -> str:
+        return ZHIPU_MODELS[model]["name"] if model in ZHIPU_MODELS else model
+
+    def _route_model(self, session: ChatSession) -> str:
+        """发送前由路由器选择本轮模型：首选额度用尽时改换首选，暂时不健康时只绕开本轮 (恢复后自动回到首选)"""
+        decision = router.choose(session.current_model)
+        model = decision.model
+        message = ""
+        if decision.reason == "额度用尽":
+            old = session.current_model
+            session.current_model = model
+            if model in ZHIPU_MODELS:
+                session.zhipu_service.set_model(model)
+            desc = f" ({self._quota_desc(model)})" if model in ZHIPU_MODELS else ""
+            message = f"⚠️ {self._model_name(old)} 额度已用尽，自动切换至 {self._model_name(model)}{desc}"
+        elif model != session.routed_model:
+            if model == session.current_model:
+                message = f"✅ {self._model_name(model)} 已恢复，切回首选模型"
+            else:
+                message = (
+                    f"🔀 路由: 本轮改用 {self._model_name(model)} "
+                    f"({decision.reason}，首选 {self._model_name(session.current_model)}；/stats 查看)"
+                )
+        if message:
+            self._add_system_message(message, session)
+        session.routed_model = model
+        return model
+
     def on_app_focus(self, event) -> None:
         """当应用获得焦点时，自动聚焦到输入框"""
+        self.frame_scheduler.set_focused(True)
         self._focus_input()
+
+    def on_app_blur(self, event) -> None:
+        """终端失焦时动画降频"""
+        self.frame_scheduler.set_focused(False)
+
+    async def on_event(self, event: events.Event) -> None:
+        """用户输入视为活动，唤醒空闲降频的动画时钟"""
+        if isinstance(event, (events.Key, events.MouseDown, events.MouseScrollUp, events.MouseScrollDown)):
+            self.frame_scheduler.touch()
+        await super().on_event(event)
     
     def on_descendant_focus(self, event) -> None:
         """任何子组件获得焦点时，确保输入框可用"""
@@ -139,29 +271,49 @@ class CyberpunkChatApp(App):
     
     async def on_inline_input_submitted(self, event: "InlineInput.Submitted") -> None:
         """处理内联输入提交"""
+        with tracer.span("app.on_inline_input_submitted"):
+            await self._on_submitted(event)
+
+    async def _on_submitted(self, event: "InlineInput.Submitted") -> None:
         user_input = event.value.strip()
         if not user_input:
             return
 
-        message_log = self.query_one("#message-log", MessageLog)
-
-        # 移除当前输入框容器
-        if event.input.parent:
-            event.input.parent.remove()
-
+        # 输入框保持可用 (提交时已清空)，新消息挂载在它上方
         # 检查是否是指令
         if user_input.startswith("/"):
             await self._handle_command(user_input)
+        elif self.session.is_streaming:
+            # 生成中：排队，上一轮提交历史后自动发送
+            self.session.queue.append(user_input)
+            self._refresh_queue(self.session)
         else:
-            # 显示用户消息
-            message_log.add_user_message(user_input)
-            # 启动异步 AI 响应
-            self._stream_ai_response(user_input)
+            self._start_turn(self.session, user_input)
 
-        # 无论是否是指令，如果不是流式响应（指令通常立即完成），都需要重新创建输入框
-        # 注意：_stream_ai_response 会在 finally 中创建输入框，所以这里只需要处理指令的情况
-        if user_input.startswith("/"):
-             message_log.create_inline_input()
+        # 指令可能清空了消息区 (含输入框)
+        self._ensure_input()
+
+    def _start_turn(self, session: ChatSession, user_input: str) -> None:
+        """显示用户消息并启动该会话的流式响应"""
+        turn = session.new_turn(user_input, self._route_model(session))
+        self._append_record(session, turn.user)
+        record = turn.ai
+        # 分块器：每个字符只扫描一次，闭合的块分发给代码块索引与气泡
+        record.md_stream = MarkdownStream()
+        record.md_stream.subscribe(lambda block: session.code_index.add_block(record.turn, block))
+        record.md_stream.subscribe(lambda block: self._bubble_call(record, "add_block", block))
+        self._append_record(session, record)
+        session.cancel_token = CancelToken()
+        # 启动异步 AI 响应 (整轮记为一个跨线程异步区间)
+        trace_id = tracer.async_begin("turn", chars=len(user_input))
+        session.worker = self._stream_ai_response(session, record, user_input, trace_id)
+        self._refresh_tab_label(session)
+
+    def _ensure_input(self) -> None:
+        """确保消息区底部有输入框 (已有时保留，不打断正在输入的内容)"""
+        message_log = self.query_one("#message-log", MessageLog)
+        if message_log._current_input is None:
+            message_log.create_inline_input()
 
     def on_shortcut_triggered(self, event: ShortcutTriggered) -> None:
         """处理来自 InlineInput 的快捷键事件"""
@@ -182,6 +334,14 @@ class CyberpunkChatApp(App):
             self.action_switch_speed()
         elif action == "switch_service":
             self.action_switch_service()
+        elif action == "new_session":
+            self.action_new_session()
+        elif action == "stop_generation":
+            self.action_stop_generation()
+        elif action == "prev_session":
+            self.action_prev_session()
+        elif action == "next_session":
+            self.action_next_session()
         else:
             self._add_system_message(f"❌ 未知快捷键: {action}")
         event.stop()  # 阻止事件继续传播
@@ -196,15 +356,28 @@ class CyberpunkChatApp(App):
             self.action_show_help()
         elif cmd in ["/usage", "/u"]:
             self.action_show_usage()
+        elif cmd in ["/stats", "/fps"]:
+            self.action_show_stats()
+        elif cmd == "/trace":
+            self.action_trace(args[0].lower() if args else "")
         elif cmd in ["/clear", "/cls"]:
             self.action_clear_log()
         elif cmd in ["/reset", "/restart"]:
             self.action_reset_session()
         elif cmd in ["/undo", "/pop"]:
             self.action_undo_last_turn()
+        elif cmd == "/redo":
+            self.action_redo_turn()
+        elif cmd in ["/delete", "/del"]:
+            self.action_delete_turn(args)
+        elif cmd == "/edit":
+            self.action_edit_turn(args)
+        elif cmd in ["/branch", "/br"]:
+            self.action_branch(args)
         elif cmd in ["/save", "/save_code", "/code"]:
-            filename = args[0] if args else "code_snippet.txt"
-            self.action_save_code(filename)
+            self.action_save_code(args)
+        elif cmd in ["/blocks", "/codes"]:
+            self.action_list_code_blocks()
         elif cmd in ["/model", "/m"]:
             self.action_switch_model()
         elif cmd in ["/theme", "/flavor", "/t"]:
@@ -215,6 +388,15 @@ class CyberpunkChatApp(App):
             self.exit()
         elif cmd in ["/service", "/engine", "/switch"]:
             self.action_switch_service()
+        elif cmd in ["/new", "/tab", "/tabs", "/close"]:
+            self._handle_session_command(cmd, args)
+        elif cmd in ["/queue", "/qu"]:
+            self.action_queue(args)
+        elif cmd in ["/stop", "/abort"]:
+            self.action_stop_generation()
+        elif cmd in ["/compare", "/cmp"]:
+            rest = command_str.split(None, 1)[1] if args else ""
+            self.action_compare(rest)
         else:
             self._add_system_message(f"❌ 未知指令: {cmd} (输入 /help 查看帮助)")
 
@@ -227,13 +409,26 @@ class CyberpunkChatApp(App):
 [bold white]指令[/]          [bold white]快捷键[/]    [bold white]说明[/]
 ──────────────────────────────────────────────
 [yellow]/usage[/]        -          查看额度消耗统计
+[yellow]/stats[/]        -          帧率统计与模型路由状态
+[yellow]/trace[/] on|off -          请求追踪 (导出 Chrome Trace)
 [yellow]/help[/]         -          显示此帮助信息
-[yellow]/undo[/]         -          撤销上一轮对话
-[yellow]/save[/] <file>  -          保存代码块
+[yellow]/stop[/]         Esc        中断正在生成的回答
+[yellow]-[/]             Ctrl+R     反向搜索输入历史 (↑ 按已输入前缀过滤)
+[yellow]/queue[/]        -          待发送队列 (up/rm <n>, clear)
+[yellow]/undo[/]         -          撤销上一轮对话 (可多次)
+[yellow]/redo[/]         -          恢复最近撤销 / 删除的一轮
+[yellow]/delete[/] <n>   -          删除第 n 轮对话 (无参数列出各轮)
+[yellow]/edit[/] <n> \\[q] -          从第 n 轮分叉改写重发 (原对话保留)
+[yellow]/branch[/]       -          分支列表 (<n> 切换, new, diff <a> \\[b], rm)
+[yellow]/save[/] \\[n|all] -          保存代码块 (可按语言 / 目录，/blocks 列出)
 [yellow]/model[/]        -          切换 AI 模型
-[yellow]/service[/]      Ctrl+D     切换主备服务
+[yellow]/service[/]      Ctrl+D     切换首选服务 (智谱 / Gemini)
 [yellow]/theme[/]        F12        切换界面主题
 [yellow]/speed[/]        Ctrl+S     切换打字机速度
+[yellow]/compare[/] <q>  -          多模型并排对比 (/compare stats)
+[yellow]/new[/] \\[name]   Ctrl+T     新建会话标签
+[yellow]/tab[/] <n>      F3 / F4    切换会话 (/tabs 列出)
+[yellow]/close[/]        -          关闭当前会话
 [yellow]/clear[/]        F2         清空屏幕日志
 [yellow]/reset[/]        F5         重置会话
 [yellow]/quit[/]         Ctrl+Q     退出程序
@@ -243,169 +438,805 @@ class CyberpunkChatApp(App):
         self._add_system_message(help_text)
 
     def action_undo_last_turn(self) -> None:
-        """撤销上一轮对话"""
-        # 1. 服务层撤销
-        success = self.active_service.undo_last_turn()
-        if not success:
-            self._add_system_message("⚠️ 无法撤销：历史记录不足或已空。")
-            return
-            
-        # 2. UI 层撤销 (删除最后两个气泡: AI 和 User)
+        """撤销当前分支的上一轮对话 (可连续撤销，/redo 恢复)"""
+        session = self.session
+        if session.is_streaming:
+            self._add_system_message("⚠️ 当前会话仍在生成中，无法撤销")
+            return
+        if session.branch.tip is None:
+            self._add_system_message("⚠️ 无法撤销：没有可撤销的对话。")
+            return
+        turn_id = session.branch.tip.id
+        self._apply_path_change(session, session.remove_turn(turn_id))
+        self._add_system_message(f"↩️ 已撤销第 {turn_id} 轮对话 (/redo 恢复)")
+
+    def action_redo_turn(self) -> None:
+        """恢复最近一次撤销 / 删除 (插回原位置)"""
+        session = self.session
+        if session.is_streaming:
+            self._add_system_message("⚠️ 当前会话仍在生成中，无法重做")
+            return
+        change = session.restore_turn()
+        if change is None:
+            self._add_system_message("⚠️ 没有可重做的对话。")
+            return
+        self._apply_path_change(session, change)
+        restored = "、".join(str(turn.id) for turn in change.added)
+        self._add_system_message(f"↪️ 已恢复第 {restored} 轮对话")
+
+    def action_delete_turn(self, args: list[str]) -> None:
+        """/delete <n> 删除第 n 轮；无参数时列出各轮"""
+        session = self.session
+        if not args:
+            self._list_turns()
+            return
+        try:
+            turn_id = int(args[0])
+        except ValueError:
+            self._add_system_message("⚠️ 用法: /delete <轮次编号>")
+            return
+        if session.is_streaming:
+            self._add_system_message("⚠️ 当前会话仍在生成中，无法删除")
+            return
+        if turn_id not in session.turns:
+            self._add_system_message(f"⚠️ 第 {turn_id} 轮不存在 (/delete 列出各轮)")
+            return
+        self._apply_path_change(session, session.remove_turn(turn_id))
+        self._add_system_message(f"🗑️ 已删除第 {turn_id} 轮对话 (/redo 恢复)")
+
+    def _list_turns(self) -> None:
+        session = self.session
+        if not session.turns:
+            self._add_system_message("📭 当前分支还没有对话轮次")
+            return
+        lines = [f"[bold]💬 对话轮次[/] ({escape(session.branch.name)}) "
+                 "/delete <n> 删除 · /edit <n> 改写重发 · /redo 恢复"]
+        for turn in session.turns.values():
+            preview = turn.user.content.replace("\n", " ")[:50]
+            lines.append(f"  [yellow]{turn.id:>3}[/]. {escape(preview)}")
+        self._add_system_message("\n".join(lines))
+
+    def _apply_path_change(self, session: ChatSession, change: PathChange | None) -> None:
+        """按路径差异卸载 / 挂载气泡 (记录直接持有气泡，无需遍历组件树)"""
+        if change is None:
+            return
+        for turn in change.removed:
+            for record in turn.records:
+                if record.bubble is not None:
+                    record.bubble.remove()
+                    record.bubble = None
+        if session is not self.session:
+            return
         message_log = self.query_one("#message-log", MessageLog)
-        
-        # 从子组件列表中从后往前找
-        bubbles_to_remove = []
-        found_ai = False
-        found_user = False
-        
-        # 倒序遍历子组件
-        children = list(message_log.children)
-        for child in reversed(children):
-            # 跳过输入框容器
-            if "input-container" in child.classes:
-                continue
-            
-            # 识别气泡类型 (通过类名判断更稳健)
-            # GlitchAIBubble 没有显式的 class 属性判断，只能用类型或 looking at class list
-            # 我们的气泡都在 message_log.py 里定义了
-            from widgets.message_log import UserBubble, GlitchAIBubble
-            
-            if not found_ai and isinstance(child, GlitchAIBubble):
-                bubbles_to_remove.append(child)
-                found_ai = True
-            elif found_ai and not found_user and isinstance(child, UserBubble):
-                bubbles_to_remove.append(child)
-                found_user = True
-                break # 找到一对了，停止
-        
-        if found_ai and found_user:
-            for bubble in bubbles_to_remove:
-                bubble.remove()
-            self._add_system_message("↩️ 已撤销上一轮对话")
+        # 从后往前挂载：每轮都挂到其后第一条已挂载的后续轮次消息之前
+        for turn in reversed(change.added):
+            anchor = session.next_turn_record(turn)
+            for record in turn.records:
+                self._mount_record(record)
+                if anchor is not None and anchor.bubble is not None:
+                    message_log.move_child(record.bubble, before=anchor.bubble)
+
+    # ============== 分支 ==============
+
+    def action_edit_turn(self, args: list[str]) -> None:
+        """/edit <n> [新问题]：从第 n 轮之前分叉，原对话保留在原分支"""
+        session = self.session
+        if session.is_streaming:
+            self._add_system_message("⚠️ 当前会话仍在生成中，无法分叉")
+            return
+        try:
+            turn = session.turns[int(args[0])]
+        except (IndexError, ValueError, KeyError):
+            self._add_system_message("⚠️ 用法: /edit <轮次编号> [新问题] (/delete 列出各轮)")
+            return
+        origin = session.branch
+        branch = session.fork(turn.parent)
+        self._apply_path_change(session, session.switch_branch(branch))
+        self._add_system_message(
+            f"🌿 已从第 {turn.id} 轮分叉到 [bold]{escape(branch.name)}[/] "
+            f"(原对话保留在 {escape(origin.name)}，/branch 切换)"
+        )
+        text = " ".join(args[1:]).strip()
+        if text:
+            self._start_turn(session, text)
         else:
-            self._add_system_message("⚠️ UI 同步警告：未能完全匹配到最后的气泡对，仅撤销了记忆。")
+            # 原问题放入输入框，改完回车即在新分支上发送
+            self._ensure_input()
+            message_log = self.query_one("#message-log", MessageLog)
+            message_log._current_input._set_text(turn.user.content)
 
-    def action_save_code(self, filename: str) -> None:
-        """提取最后一条 AI 回复中的代码块并保存"""
-        # 获取最后一条 AI 消息的内容
-        history = self.active_service.get_history()
-        # 检查最后一条消息是否是 AI 回复 (model 或 assistant)
-        if not history or history[-1][0] not in ["model", "assistant"]:
-            self._add_system_message("⚠️ 无法保存：最后一条消息不是 AI 回复。")
+    def action_branch(self, args: list[str]) -> None:
+        """/branch [n|名称] | /branch new [名称] | /branch diff <a> [b] | /branch rm <n|名称>"""
+        session = self.session
+        sub = args[0].lower() if args else ""
+        if not sub:
+            self._list_branches()
             return
-        
-        content = history[-1][1]
-        
-        # 正则提取代码块
-        import re
-        # 匹配 ```language ... ``` 块
-        code_blocks = re.findall(r"```(?:\w+)?\n(.*?)```", content, re.DOTALL)
-        
-        if not code_blocks:
+        if sub == "diff":
+            self._diff_branches(args[1:])
+            return
+        if session.is_streaming:
+            self._add_system_message("⚠️ 当前会话仍在生成中，无法切换分支")
+            return
+        if sub == "new":
+            branch = session.fork(session.branch.tip, args[1] if len(args) > 1 else "")
+            session.switch_branch(branch)
+            self._add_system_message(f"🌿 新分支 [bold]{escape(branch.name)}[/] (与 {len(branch)} 轮共享)")
+            return
+        if sub == "rm":
+            branch = session.find_branch(args[1]) if len(args) > 1 else None
+            if branch is None or branch is session.branch:
+                self._add_system_message("⚠️ 用法: /branch rm <序号|名称> (不能删除当前分支)")
+                return
+            session.delete_branch(branch)
+            self._add_system_message(f"🗑️ 已删除分支 {escape(branch.name)}")
+            return
+        branch = session.find_branch(args[0])
+        if branch is None:
+            self._add_system_message(f"⚠️ 分支不存在: {escape(args[0])} (/branch 列出)")
+            return
+        self._apply_path_change(session, session.switch_branch(branch))
+        self._add_system_message(f"🌿 已切换到分支 [bold]{escape(branch.name)}[/] ({len(branch)} 轮)")
+
+    def _list_branches(self) -> None:
+        session = self.session
+        lines = ["[bold]🌿 分支[/] (/branch <n> 切换 · new [名称] · diff <a> \\[b] · rm <n>)"]
+        for i, branch in enumerate(session.branches, 1):
+            marker = "[green]●[/]" if branch is session.branch else " "
+            last = branch.tip.user.content.replace("\n", " ")[:40] if branch.tip else "(空)"
+            lines.append(f" {marker} [yellow]{i}[/]. {escape(branch.name):<12} {len(branch):>3} 轮  {escape(last)}")
+        self._add_system_message("\n".join(lines))
+
+    def _diff_branches(self, args: list[str]) -> None:
+        """对比两个分支：公共前缀 + 各自独有的轮次 (b 默认当前分支)"""
+        session = self.session
+        a = session.find_branch(args[0]) if args else None
+        b = session.find_branch(args[1]) if len(args) > 1 else session.branch
+        if a is None or b is None:
+            self._add_system_message("⚠️ 用法: /branch diff <a> \\[b]")
+            return
+        common, only_a, only_b = session.diverge(a, b)
+        lines = [f"[bold]🔀 {escape(a.name)} ↔ {escape(b.name)}[/]  共享前 {len(common)} 轮"]
+        for branch, turns in ((a, only_a), (b, only_b)):
+            lines.append(f"[bold]{escape(branch.name)}[/] 独有 {len(turns)} 轮:")
+            for turn in turns:
+                question = turn.user.content.replace("\n", " ")[:40]
+                lines.append(f"  [yellow]{turn.id:>3}[/]. {escape(question)}  [dim]→ {len(turn.ai.content)} 字[/]")
+        self._add_system_message("\n".join(lines))
+
+    def action_save_code(self, args: list[str]) -> None:
+        """保存代码块: /save [编号|语言|all|文件名] [目录]"""
+        index = self.session.code_index
+        if not index.blocks:
             self._add_system_message("⚠️ 未检测到代码块。")
             return
-        
-        # 如果有多个，全部合并保存
-        full_code = "\n\n# === Code Block ===\n".join(code_blocks)
-        
+
+        selector = args[0] if args else ""
+        directory = args[1] if len(args) > 1 else SAVE_CODE_DIR
+        selector_lower = selector.lower()
+
+        if not selector:
+            blocks = index.last_turn_blocks()
+        elif selector_lower == "all":
+            blocks = index.blocks
+        elif selector.isdigit():
+            block = index.get(int(selector))
+            if block is None:
+                self._add_system_message(f"⚠️ 没有第 {selector} 个代码块 (共 {len(index.blocks)} 个，/blocks 查看)")
+                return
+            blocks = [block]
+        elif selector_lower in index.by_lang:
+            blocks = index.by_lang[selector_lower]
+        elif Path(selector).suffix:
+            # 兼容旧用法: /save 文件名 -> 最近一个代码块写入该文件
+            try:
+                Path(selector).write_text(index.blocks[-1].code + "\n", encoding="utf-8")
+                self._add_system_message(f"💾 代码已保存至:\n{Path(selector).resolve()}")
+            except OSError as e:
+                self._add_system_message(f"❌ 保存失败: {str(e)}")
+            return
+        else:
+            langs = ", ".join(sorted(index.by_lang)) or "-"
+            self._add_system_message(f"⚠️ 无法识别: {selector} (可用语言: {langs})")
+            return
+
         try:
-            with open(filename, "w", encoding="utf-8") as f:
-                f.write(full_code)
-            
-            import os
-            abs_path = os.path.abspath(filename)
-            self._add_system_message(f"💾 代码已保存至:\n{abs_path}")
-        except Exception as e:
+            written, skipped = CodeIndex.save(blocks, directory)
+        except OSError as e:
             self._add_system_message(f"❌ 保存失败: {str(e)}")
+            return
+        lines = [f"💾 已保存 {len(written)} 个代码块至 {Path(directory).resolve()}"]
+        lines += [f"  {path.name}" for path in written]
+        if skipped:
+            lines.append(f"[dim]跳过 {skipped} 个 (目录中已有相同内容)[/]")
+        self._add_system_message("\n".join(lines))
+
+    def action_list_code_blocks(self) -> None:
+        """列出会话内的代码块索引"""
+        index = self.session.code_index
+        if not index.blocks:
+            self._add_system_message("📦 本会话还没有代码块")
+            return
+        lines = [f"[bold cyan]📦 代码块索引[/] [dim]({len(index.blocks)} 个)[/]"]
+        for block in index.blocks:
+            first = escape(next((l.strip() for l in block.code.splitlines() if l.strip()), ""))
+            flag = "" if block.complete else " [yellow](未完成)[/]"
+            lines.append(
+                f"  [yellow]{block.number:>2}[/]. {block.lang or 'text':<10} 第 {block.turn} 轮  "
+                f"{block.code.count(chr(10)) + 1:>3} 行{flag}  [dim]{first[:40]}[/]"
+            )
+        lines.append("[dim]用法: /save <编号|语言|all> \\[目录][/]")
+        self._add_system_message("\n".join(lines))
 
     def action_show_usage(self) -> None:
         """显示额度消耗报告"""
-        history_len = len(self.active_service._history) // 2
-        service_type = "智谱 GLM" if self._is_zhipu_primary and self.using_primary else \
-                       "Gemini" if not self._is_zhipu_primary and self.using_primary else \
-                       "智谱 GLM (备)" if self._is_zhipu_primary else "Gemini (备)"
+        history_len = len(self.session.turns)
+        service_type = self.service_name
+        quota_lines = "\n".join(
+            f"*   **{info['name']}**: {self._quota_desc(model)} | 已用 `{quota_ledger.used(model):,}` tokens / `{quota_ledger.requests(model)}` 次"
+            for model, info in ZHIPU_MODELS.items()
+        )
 
         usage_text = f"""
 ### 📊 额度消耗报告 (Usage Report)
 
 *   **当前服务**: `{service_type}`
 *   **当前模型**: `{self.current_model}`
-*   **本会话总计**: `{self._total_tokens:,}` tokens (估算)
+*   **本会话总计**: `{self.session.total_tokens:,}` tokens (估算)
+*   **全部会话总计**: `{self._total_tokens:,}` tokens (估算)
+*   **中断节省**: `{self.session.tokens_avoided:,}` / 全部 `{self._tokens_avoided:,}` tokens (估算)
 *   **已对话轮数**: `{history_len}` 轮
+*   **Gemini 上下文缓存**: 命中 `{context_cache.cached_tokens:,}` / 新发送 `{context_cache.fresh_tokens:,}` 输入 tokens (命中率 `{context_cache.hit_ratio:.0%}`)
+*   **缓存状态**: 存活 `{len(context_cache)}` 份 | 创建 `{context_cache.created}` / 复用 `{context_cache.reused}` / 续期 `{context_cache.refreshed}` / 删除 `{context_cache.deleted}`
+
+#### 🎫 智谱额度 (账本累计)
+
+{quota_lines}
 
 > 💡 **注**: 以上统计为估算值。智谱 GLM-4 约 10元/千tokens。
 """
         self._add_system_message(usage_text)
 
+    def action_show_stats(self) -> None:
+        """显示帧调度器统计 (上一秒)"""
+        st = self.frame_scheduler.stats
+        stats_text = f"""
+[bold cyan]⏱️ 帧调度统计 (上一秒)[/bold cyan]
+
+[bold white]时钟频率:[/]  {st.clock_fps} fps  [dim](0 = 已停表)[/]
+[bold white]有效帧数:[/]  {st.frames}
+[bold white]回调次数:[/]  {st.callbacks}  [dim](跳过不可见: {st.skipped})[/]
+[bold white]动画耗时:[/]  {st.busy_ms:.2f} ms
+[bold white]订阅数量:[/]  {st.subscribers}
+[bold white]高亮缓存:[/]  {len(highlight_cache)} 条  [dim](命中 {highlight_cache.hits} / 未命中 {highlight_cache.misses})[/]
+
+{self._router_stats()}"""
+        self._add_system_message(stats_text)
+
+    def _router_stats(self) -> str:
+        """路由器各候选项的评分与最近决策"""
+        import time
+
+        now = time.time()
+        preferred = self.current_model
+        lines = [
+            "[bold cyan]🧭 路由 (评分越低越优先)[/bold cyan]",
+            f"[dim]{pad('模型', 22)} {pad('评分', 7)} {pad('错误率', 7)} {pad('首字', 8)} {pad('速度', 9)} 状态[/]",
+        ]
+        scored = sorted(
+            ((router.score(option, preferred, now), option) for option in router.options),
+            key=lambda item: item[0],
+        )
+        for score, option in scored:
+            ttft = f"{option.ttft_ms:.0f}ms" if option.ttft_ms is not None else "-"
+            tps = f"{option.tps:.0f}tok/s" if option.tps is not None else "-"
+            if not quota_ledger.available(option.model):
+                state = "[yellow]额度用尽[/]"
+            elif option.failures == 0:
+                state = "[green]健康[/]"
+            else:
+                retry = max(0, option.next_probe - now)
+                label = "[yellow]降级[/]" if option.healthy else "[red]不健康[/]"
+                state = f"{label} [dim]{retry:.0f}s 后探测 (已探测 {option.probes} 次)[/]"
+            mark = "[bold green]▶[/]" if option.model == preferred else " "
+            lines.append(
+                f"{mark}{pad(option.model, 21)} {pad(f'{score:.2f}', 7)} "
+                f"{pad(f'{option.error_rate(now):.0%}', 7)} {pad(ttft, 8)} {pad(tps, 9)} {state}"
+            )
+            if option.failures and option.last_error:
+                lines.append(f"  [dim]{escape(option.last_error[:80])}[/]")
+        recent = list(router.decisions)[-5:]
+        if recent:
+            lines.append("")
+            lines.append("[bold white]最近决策:[/]")
+            for decision in reversed(recent):
+                at = time.strftime("%H:%M:%S", time.localtime(decision.at))
+                lines.append(f"  [dim]{at}[/] {decision.preferred} → [cyan]{decision.model}[/] [dim]({decision.reason})[/]")
+        return "\n".join(lines)
+
+    def action_trace(self, mode: str) -> None:
+        """开关请求追踪，关闭时导出 Chrome trace-event JSON"""
+        if mode == "on":
+            tracer.start()
+            self._add_system_message("🧵 请求追踪已开启 (/trace off 结束并导出)")
+        elif mode == "off":
+            if not tracer.enabled:
+                self._add_system_message("⚠️ 请求追踪未开启")
+                return
+            tracer.stop()
+            from datetime import datetime
+            from utils.logger import LOG_DIR
+            path = LOG_DIR / f"trace_{datetime.now():%Y%m%d_%H%M%S}.json"
+            try:
+                tracer.export(path)
+                self._add_system_message(
+                    f"🧵 已导出 {tracer.event_count} 个事件:\n{path}\n[dim]用 chrome://tracing 或 ui.perfetto.dev 打开[/]"
+                )
+            except OSError as e:
+                self._add_system_message(f"❌ 导出失败: {e}")
+        else:
+            state = "开启" if tracer.enabled else "关闭"
+            self._add_system_message(f"🧵 请求追踪: {state} | 缓冲事件: {tracer.event_count} (用法: /trace on|off)")
+
     def action_reset_session(self) -> None:
         """重置会话 (清空屏幕 + 历史)"""
-        self.active_service.clear_history()
+        self.session.reset_history()
         self.action_clear_log()
         self._add_system_message("🧠 记忆已擦除，会话重置。")
 
-    @work(exclusive=True, thread=True)
-    def _stream_ai_response(self, user_input: str) -> None:
-        """后台线程处理 AI 流式响应"""
-        message_log = self.query_one("#message-log", MessageLog)
-
-        # 创建 AI 消息气泡
-        ai_bubble = self.call_from_thread(message_log.add_ai_message_streaming, self.current_model)
+    @work(thread=True, group="stream")
+    def _stream_ai_response(
+        self, session: ChatSession, record: MessageRecord, user_input: str, trace_id: int | None = None
+    ) -> None:
+        """后台线程处理 AI 流式响应 (各会话各自一个 Worker，全局并发受限)"""
+        try:
+            with self.stream_limiter.slot(session.cancel_token):
+                with tracer.span("worker.stream_ai_response", model=record.model, session=session.id):
+                    self._run_stream(session, record, user_input)
+        except StreamCancelled:
+            # 排队中被取消：请求从未发出，撤回这一轮的消息
+            self.call_from_thread(self._drop_queued_turn, session, record)
+        finally:
+            tracer.async_end("turn", trace_id)
+            self.call_from_thread(self._on_stream_finished, session)
 
+    def _run_stream(self, session: ChatSession, record: MessageRecord, user_input: str) -> None:
+        # 路由到的服务若没回答上一轮，先按对话路径补齐其历史
+        service = session.prepare_turn(record.turn, record.model)
+        cancel = session.cancel_token
         try:
             # 调用流式 API
-            for chunk in self.active_service.stream_chat_sync(user_input, self.current_model):
+            for chunk in service.stream_chat_sync(user_input, record.model, cancel):
                 # 检测重连信号
                 if chunk.startswith("__RECONNECTING__:"):
                     parts = chunk.split(":")
                     attempt = int(parts[1])
                     max_attempts = int(parts[2])
-                    self.call_from_thread(ai_bubble.set_reconnecting, attempt, max_attempts)
+                    self.call_from_thread(self._bubble_call, record, "set_reconnecting", attempt, max_attempts)
                     continue
                 # 检测 Token 统计信号
                 if chunk.startswith("__TOKEN_STATS__:"):
                     turn_tokens = int(chunk.split(":")[1])
+                    session.total_tokens += turn_tokens
                     self._total_tokens += turn_tokens
                     continue
-                self.call_from_thread(ai_bubble.append_text, chunk)
+                with tracer.span("ui.flush", chars=len(chunk)):
+                    self.call_from_thread(self._deliver_chunk, record, chunk)
+
+            # 记录本轮写入的历史条目 (撤销 / 删除后据此重建历史)
+            session.commit_turn(record.turn, service)
+            usage = service.last_usage or {}
+            if cancel is not None and cancel.cancelled:
+                # 中断：保留部分回答，估算省下的 token
+                avoided = self._output_estimator.estimate(record.model, usage.get("output_tokens", 0))
+                session.tokens_avoided += avoided
+                self._tokens_avoided += avoided
+                self.call_from_thread(self._finish_record, session, record, "cancelled")
+                return
+            self._output_estimator.observe(record.model, usage.get("output_tokens", 0))
 
             # 完成后显示
-            self.call_from_thread(ai_bubble.finalize_with_glitch)
+            self.call_from_thread(self._finish_record, session, record, "done")
 
         except Exception as e:
             error_msg = str(e)
-            self.call_from_thread(ai_bubble.set_error, error_msg)
-
-            # 主服务失败时自动切换到备用服务
-            if self.using_primary:
-                self.using_primary = False
-                # 更新当前模型为备用服务的默认模型
-                if self._is_zhipu_primary:
-                    # 从智谱切换到 Gemini
-                    self.current_model = "gemini-2.5-flash"
-                else:
-                    # 从 Gemini 切换到智谱
-                    self.current_model = "glm-4"
+            # 失败已由服务层上报路由器：下一轮按最新评分选择 (不健康的模型由后台探测恢复)
+            self.call_from_thread(self._finish_record, session, record, "error", error_msg)
 
-                self.call_from_thread(
-                    self._add_system_message,
-                    f"⚠️ 主服务不可用，已自动切换至备用服务 ({self.service_name})"
-                )
+    # ============== 会话消息 ==============
 
-        finally:
-            # 创建新的内联输入框
-            self.call_from_thread(message_log.create_inline_input)
-    
-    def _add_system_message(self, text: str) -> None:
-        """添加系统消息"""
+    def _deliver_chunk(self, record: MessageRecord, chunk: str) -> None:
+        """UI 线程：写入会话数据并送入分块器，活动标签页同时写入气泡"""
+        record.content += chunk
+        if record.bubble is not None:
+            record.bubble.append_text(chunk)
+        if record.md_stream is not None:
+            record.md_stream.feed(chunk)
+
+    def _bubble_call(self, record: MessageRecord, method: str, *args) -> None:
+        """UI 线程：气泡存在时调用其方法"""
+        if record.bubble is not None:
+            getattr(record.bubble, method)(*args)
+
+    def _finish_record(self, session: ChatSession, record: MessageRecord, state: str, error: str = "") -> None:
+        """UI 线程：流结束，更新消息状态与气泡"""
+        record.state = state
+        if state == "error":
+            # 出错的回答不进入历史，其代码块也一并移除
+            session.code_index.drop_turn(record.turn)
+            record.content = f"⚠️ 错误: {error}"
+            record.md_stream = None
+            self._bubble_call(record, "set_error", error)
+            return
+        if record.md_stream is not None:
+            # 闭合剩余块 (未闭合的围栏按中断块输出)，中断提示单独成块
+            record.md_stream.flush()
+            if state == "cancelled":
+                self._deliver_chunk(record, CANCELLED_NOTE)
+                record.md_stream.flush()
+            record.md_stream = None
+        elif state == "cancelled":
+            self._deliver_chunk(record, CANCELLED_NOTE)
+        self._bubble_call(record, "finalize_with_glitch")
+
+    def _drop_queued_turn(self, session: ChatSession, record: MessageRecord) -> None:
+        """UI 线程：移除尚未发出的一轮 (用户消息 + 空回答，不进入重做栈)"""
+        self._apply_path_change(session, session.remove_turn(record.turn, undoable=False))
+        self._add_system_message("⏹ 已取消排队中的请求", session)
+
+    def action_stop_generation(self) -> None:
+        """中断当前会话正在生成的回答 (Esc / /stop)"""
+        session = self.session
+        if not session.is_streaming or session.cancel_token is None:
+            return
+        if session.cancel_token.cancelled:
+            return
+        session.cancel_token.cancel()
+        self._add_system_message("⏹ 正在中断生成...")
+
+    def _on_stream_finished(self, session: ChatSession) -> None:
+        """UI 线程：本轮历史已提交，发送队列中的下一个问题"""
+        session.worker = None
+        session.cancel_token = None
+        if session.queue:
+            self._start_turn(session, session.queue.pop(0))
+            self._refresh_queue(session)
+        self._refresh_tab_label(session)
+
+    # ============== 待发送队列 ==============
+
+    def _refresh_queue(self, session: ChatSession) -> None:
+        """刷新队列显示 (仅活动会话) 与标签计数"""
+        if session is self.session:
+            self.query_one("#prompt-queue", PromptQueue).show_items(session.queue)
+        self._refresh_tab_label(session)
+
+    def action_queue(self, args: list[str]) -> None:
+        """/queue | /queue up <n> | /queue rm <n> | /queue clear"""
+        queue = self.session.queue
+        sub = args[0].lower() if args else ""
+        if sub == "clear":
+            count = len(queue)
+            queue.clear()
+            self._add_system_message(f"🗑️ 已清空待发送队列 ({count} 条)")
+        elif sub in ("up", "rm", "top"):
+            try:
+                idx = int(args[1]) - 1
+                if not 0 <= idx < len(queue):
+                    raise ValueError
+            except (IndexError, ValueError):
+                self._add_system_message(f"⚠️ 无效的队列序号 (共 {len(queue)} 条)")
+                return
+            if sub == "rm":
+                removed = queue.pop(idx)
+                self._add_system_message(f"🗑️ 已移除: {removed[:40]}")
+            elif idx > 0:
+                # up 上移一位，top 移到队首
+                target = 0 if sub == "top" else idx - 1
+                queue.insert(target, queue.pop(idx))
+        elif not queue:
+            self._add_system_message("📥 待发送队列为空 (生成期间提交的问题会自动排队)")
+        else:
+            lines = ["[bold yellow]📥 待发送队列[/]"]
+            lines += [f"  {i}. {escape(item)}" for i, item in enumerate(queue, 1)]
+            lines.append("[dim]用法: /queue up|top|rm <n>, /queue clear[/]")
+            self._add_system_message("\n".join(lines))
+        self._refresh_queue(self.session)
+
+    def _append_record(self, session: ChatSession, record: MessageRecord) -> None:
+        """追加消息记录，活动会话同时挂载气泡"""
+        session.messages.append(record)
+        if session is self.session:
+            self._mount_record(record)
+
+    def _mount_record(self, record: MessageRecord) -> None:
+        """为消息记录挂载气泡"""
         message_log = self.query_one("#message-log", MessageLog)
-        message_log.add_system_message(text)
+        if record.role == "user":
+            record.bubble = message_log.add_user_message(record.content)
+        elif record.role == "ai":
+            if record.state == "streaming":
+                bubble = message_log.add_ai_message_streaming(record.model)
+                bubble.append_text(record.content)
+                # 切回标签页：补上已闭合块的渲染，后续块由订阅继续送达
+                if record.md_stream is not None:
+                    for block in record.md_stream.blocks:
+                        bubble.add_block(block)
+                record.bubble = bubble
+            else:
+                record.bubble = message_log.add_ai_message(record.model, record.content, record.state)
+        elif record.role == "compare":
+            record.bubble = message_log.add_compare_view(record.payload)
+        else:
+            record.bubble = message_log.add_system_message(record.content)
+
+    def _add_system_message(self, text: str, session: ChatSession | None = None) -> None:
+        """添加系统消息 (默认写入当前会话)"""
+        self._append_record(session or self.session, MessageRecord("system", text))
     
     def action_clear_log(self) -> None:
         """清空消息记录"""
+        message_log = self.query_one("#message-log", MessageLog)
+        # 在途回复保留 (仍需接收后续内容)
+        self.session.messages = [m for m in self.session.messages if m.state == "streaming"]
+        message_log.clear_messages()
+        for record in self.session.messages:
+            self._mount_record(record)
+        self._add_system_message("📝 消息已清空")
+        self._ensure_input()
+
+    # ============== 开发模式热重载 ==============
+
+    def _restore_sessions(self, state: dict) -> None:
+        """按保存的状态重建全部会话 (在 compose 之前调用)"""
+        self.sessions = [ChatSession.from_state(data) for data in state["sessions"]]
+        self.session = next(
+            (s for s in self.sessions if s.id == state["active"]), self.sessions[0]
+        )
+        self._next_session_id = max(s.id for s in self.sessions) + 1
+        self._total_tokens = state.get("total_tokens", 0)
+        self._tokens_avoided = state.get("tokens_avoided", 0)
+
+    def _report_first_paint(self) -> None:
+        """首帧已绘制：报告从 dev.py 触发重启到现在的耗时"""
+        elapsed_ms = dev_reload.record_first_paint()
+        if elapsed_ms is not None:
+            self.notify(f"重启到首帧 {elapsed_ms:.0f} ms", title="⏱️ 热重启")
+
+    def _poll_dev_command(self) -> None:
+        """轮询 dev.py 写入的命令"""
+        command = self._dev_commands.poll()
+        if command is None:
+            return
+        action, paths = command["action"], command.get("paths", [])
+        try:
+            if action == "css":
+                self._dev_reload_css()
+            elif action == "widgets":
+                self._dev_reload_widgets(paths)
+            elif action == "restart":
+                self._dev_restart()
+                return
+            self.notify(", ".join(paths), title=f"🔥 已热重载 ({action})")
+        except Exception as e:
+            # 样式写错等情况：保持当前界面，修好后再次保存即可
+            self.notify(str(e)[:300], title="❌ 热重载失败", severity="error", timeout=8)
+
+    def _dev_reload_css(self) -> None:
+        """重新读取样式表与风味变量并应用"""
+        load_flavors(reload=True)
+        self.stylesheet.read_all([Path(path) for path in self.css_path])
+        self.refresh_css(animate=False)
+
+    def _dev_reload_widgets(self, paths: list[str]) -> None:
+        """进程内重载气泡组件模块，并按会话数据重建消息区"""
+        modules = [dev_reload.HOT_MODULES[path] for path in paths if path in dev_reload.HOT_MODULES]
+        dev_reload.reload_modules(modules)
+
+        message_log = self.query_one("#message-log", MessageLog)
+        draft = message_log._current_input.text if message_log._current_input else ""
+        for record in self.session.messages:
+            record.bubble = None
+        message_log.clear_messages()
+        for record in self.session.messages:
+            self._mount_record(record)
+        self._ensure_input()
+        if draft and message_log._current_input:
+            message_log._current_input.text = draft
+
+    def _dev_restart(self) -> None:
+        """保存会话状态后以约定的退出码退出，由 dev.py 重新拉起"""
+        for session in self.sessions:
+            if session.cancel_token is not None:
+                session.cancel_token.cancel()
+        dev_reload.save_state({
+            "sessions": [session.to_state() for session in self.sessions],
+            "active": self.session.id,
+            "flavor": self.current_flavor,
+            "total_tokens": self._total_tokens,
+            "tokens_avoided": self._tokens_avoided,
+        })
+        self.exit(return_code=dev_reload.RESTART_EXIT_CODE)
+
+    # ============== 多模型对比 ==============
+
+    def action_compare(self, rest: str) -> None:
+        """/compare [-m 模型1,模型2] <问题> | /compare stats"""
+        rest = rest.strip()
+        if rest.lower() == "stats":
+            self._show_compare_stats()
+            return
+
+        models = COMPARE_MODELS
+        if rest.startswith("-m"):
+            # "-m a,b 问题" 与 "-ma,b 问题" 都接受
+            spec, *prompt = rest[2:].split(None, 1) or [""]
+            models = [m.strip() for m in spec.split(",") if m.strip()]
+            rest = prompt[0] if prompt else ""
+        if not rest or not models:
+            self._add_system_message(
+                "用法: /compare [-m 模型1,模型2] <问题> | /compare stats\n"
+                f"[dim]默认模型: {', '.join(COMPARE_MODELS)}[/]"
+            )
+            return
+
+        # 使用当前会话的上下文，但不写入会话历史
+        run = CompareRun(
+            prompt=rest,
+            history=self.session.history_for(self.session.branch.tip),
+            results=[CompareResult(model=m) for m in models],
+        )
+        self._append_record(self.session, MessageRecord("user", f"⚖️ /compare {rest}"))
+        self._append_record(self.session, MessageRecord("compare", payload=run))
+        self._compare_run(run)
+
+    @work(thread=True, group="compare")
+    def _compare_run(self, run: CompareRun) -> None:
+        """对比模式：整次对比占一个并发名额 (与标签页的流共用上限)，其中各模型同时请求"""
+        with self.stream_limiter.slot():
+            with tracer.span("worker.compare", models=len(run.results)):
+                run_models(run, lambda result: self.call_from_thread(self._on_compare_result, run, result))
+
+    def _on_compare_result(self, run: CompareRun, result: CompareResult) -> None:
+        """UI 线程：单个模型完成，刷新视图并统计用量"""
+        self._total_tokens += result.input_tokens + result.output_tokens
+        for session in self.sessions:
+            for record in session.messages:
+                if record.payload is run and record.bubble is not None:
+                    record.bubble.refresh_results()
+
+    def _show_compare_stats(self) -> None:
+        """汇总 data/compare_results.jsonl"""
+        summary = summarize(load_results())
+        if not summary:
+            self._add_system_message("📊 暂无对比记录 (先运行 /compare <问题>)")
+            return
+
+        def fmt(value, pattern):
+            return pattern.format(value) if value is not None else "-"
+
+        lines = [
+            "[bold cyan]📊 模型对比统计[/] [dim](按 TTFT 中位数排序)[/]",
+            "",
+            "[bold white]" + pad("模型", 24) + "".join(
+                pad(h, w, "right") for h, w in
+                [("次数", 6), ("成功率", 8), ("TTFT", 9), ("总耗时", 9), ("tok/s", 8), ("平均输出", 9)]
+            ) + "  额度[/]",
+        ]
+        for s in summary:
+            lines.append(
+                f"{s['model']:<24}{s['runs']:>6}{s['ok_rate']:>8.0%}"
+                f"{fmt(s['ttft_p50'], '{:,.0f}ms'):>9}"
+                f"{fmt(s['total_p50'] and s['total_p50'] / 1000, '{:.1f}s'):>9}"
+                f"{fmt(s['tokens_per_s'], '{:.0f}'):>8}"
+                f"{fmt(s['output_tokens'], '{:,.0f}'):>9}  {s['tier']}"
+            )
+        self._add_system_message("\n".join(lines))
+
+    # ============== 多标签会话 ==============
+
+    def _activate_session(self, session: ChatSession) -> None:
+        """切换活动会话：按会话数据重建消息区"""
+        if session is self.session:
+            return
+        for record in self.session.messages:
+            record.bubble = None
+        self.session = session
+
         message_log = self.query_one("#message-log", MessageLog)
         message_log.clear_messages()
-        message_log.add_system_message("📝 消息已清空")
-        message_log.create_inline_input()
+        for record in session.messages:
+            self._mount_record(record)
+        self._ensure_input()
+        self._refresh_queue(session)
+
+        tabs = self.query_one("#session-tabs", Tabs)
+        if tabs.active != session.tab_id:
+            tabs.active = session.tab_id
+
+    def _refresh_tab_label(self, session: ChatSession) -> None:
+        """标签标题 (生成中的会话带标记)"""
+        label = f"⏳ {session.title}" if session.is_streaming else session.title
+        if session.queue:
+            label += f" (+{len(session.queue)})"
+        try:
+            self.query_one(f"#{session.tab_id}", Tab).label = label
+        except Exception:
+            pass
+
+    def _session_by_tab(self, tab_id: str | None) -> ChatSession | None:
+        for session in self.sessions:
+            if session.tab_id == tab_id:
+                return session
+        return None
+
+    def on_tabs_tab_activated(self, event: Tabs.TabActivated) -> None:
+        """点击标签或 Tabs 内部切换"""
+        session = self._session_by_tab(event.tab.id if event.tab else None)
+        if session is not None:
+            self._activate_session(session)
+
+    def action_new_session(self, title: str = "") -> None:
+        """新建会话标签并切换过去"""
+        session = self._create_session(title)
+        self.query_one("#session-tabs", Tabs).add_tab(Tab(session.title, id=session.tab_id))
+        self._activate_session(session)
+        self._add_welcome_message(session)
+
+    def action_prev_session(self) -> None:
+        self._cycle_session(-1)
+
+    def action_next_session(self) -> None:
+        self._cycle_session(1)
+
+    def _cycle_session(self, step: int) -> None:
+        idx = self.sessions.index(self.session)
+        self._activate_session(self.sessions[(idx + step) % len(self.sessions)])
+
+    def action_close_session(self) -> None:
+        """关闭当前会话 (生成中的会话不可关闭)"""
+        session = self.session
+        if session.is_streaming:
+            self._add_system_message("⚠️ 当前会话仍在生成中，无法关闭")
+            return
+        if len(self.sessions) == 1:
+            self._add_system_message("⚠️ 至少保留一个会话")
+            return
+        idx = self.sessions.index(session)
+        self._activate_session(self.sessions[idx - 1] if idx > 0 else self.sessions[1])
+        self.sessions.remove(session)
+        self.query_one("#session-tabs", Tabs).remove_tab(session.tab_id)
+        self._add_system_message(f"🗂️ 已关闭 {session.title}")
+
+    def _handle_session_command(self, cmd: str, args: list[str]) -> None:
+        """处理 /new /tab /tabs /close"""
+        if cmd == "/new":
+            self.action_new_session(" ".join(args))
+        elif cmd == "/close":
+            self.action_close_session()
+        elif cmd == "/tab" and args:
+            try:
+                idx = int(args[0]) - 1
+                if not 0 <= idx < len(self.sessions):
+                    raise ValueError
+            except ValueError:
+                self._add_system_message(f"⚠️ 无效的会话序号: {args[0]} (共 {len(self.sessions)} 个)")
+                return
+            self._activate_session(self.sessions[idx])
+        else:
+            lines = ["[bold cyan]🗂️ 会话列表[/]"]
+            for i, session in enumerate(self.sessions, 1):
+                marker = "[bold green]▶[/]" if session is self.session else " "
+                status = "[yellow]生成中[/]" if session.is_streaming else "[dim]空闲[/]"
+                lines.append(
+                    f"{marker} {i}. {session.title}  {status}  "
+                    f"[dim]{session.current_model} | {session.total_tokens:,} tokens[/]"
+                )
+            lines.append(
+                f"[dim]并发: {self.stream_limiter.active}/{self.stream_limiter.limit} 进行中, "
+                f"{self.stream_limiter.waiting} 排队[/]"
+            )
+            self._add_system_message("\n".join(lines))
     
     def action_switch_model(self) -> None:
         """切换模型 - 显示详细的模型列表"""
@@ -418,7 +1249,7 @@ class CyberpunkChatApp(App):
             current_idx = models.index(self.current_model) if self.current_model in models else 0
             next_model = models[(current_idx + 1) % len(models)]
             self.current_model = next_model
-            self.zhipu_service.set_model(next_model)
+            self.session.zhipu_service.set_model(next_model)
 
             # 构建详细的模型列表消息
             lines = ["[bold cyan]━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━[/bold cyan]"]
@@ -434,10 +1265,10 @@ class CyberpunkChatApp(App):
                 # 当前模型用醒目的颜色
                 if is_current:
                     model_name = f"[bold green]{info['name']}[/]"
-                    desc = f"[bold green]{info['desc']}[/]"
+                    desc = f"[bold green]{self._quota_desc(model_id)}[/]"
                 else:
                     model_name = info['name']
-                    desc = info['desc']
+                    desc = self._quota_desc(model_id)
 
                 lines.append(f"{prefix}{model_name} - {desc}")
 
@@ -448,7 +1279,7 @@ class CyberpunkChatApp(App):
             self._add_system_message("\n".join(lines))
         else:
             # Gemini 模型切换
-            models = ["gemini-2.5-flash", "gemini-flash-latest", "gemini-2.5-flash-lite"]
+            models = GEMINI_MODELS
             current_idx = models.index(self.current_model) if self.current_model in models else 0
             next_model = models[(current_idx + 1) % len(models)]
             self.current_model = next_model
@@ -471,22 +1302,12 @@ class CyberpunkChatApp(App):
             self._add_system_message("\n".join(lines))
 
     def action_switch_service(self) -> None:
-        """手动切换主备服务"""
-        self.using_primary = not self.using_primary
-
-        # 更新当前模型
-        if self.using_primary:
-            # 切换到主服务
-            if self._is_zhipu_primary:
-                self.current_model = self.zhipu_service._model
-            else:
-                self.current_model = "gemini-2.5-flash"
-        else:
-            # 切换到备用服务
-            if self._is_zhipu_primary:
-                self.current_model = "gemini-2.5-flash"
-            else:
-                self.current_model = self.zhipu_service._model
+        """切换首选服务 (当前会话)：改用另一服务当前评分最好的模型"""
+        session = self.session
+        provider = "gemini" if provider_of(session.current_model) == "zhipu" else "zhipu"
+        session.current_model = router.best(provider)
+        if provider == "zhipu":
+            session.zhipu_service.set_model(session.current_model)
 
         self._add_system_message(f"🔄 服务切换: 当前使用 {self.service_name} | 模型: {self.current_model}")
     
@@ -497,20 +1318,25 @@ class CyberpunkChatApp(App):
         speed_names = {"slow": "🐢 慢速 (1秒/行)", "normal": "🚀 正常 (0.3秒/行)", "fast": "⚡ 快速 (0.1秒/行)"}
         self._add_system_message(f"速度: {speed_names.get(new_speed, new_speed)}")
 
+    def get_css_variables(self) -> dict[str, str]:
+        """Textual 设计变量 + 当前风味的 $ctp-* 变量"""
+        variables = super().get_css_variables()
+        # 基类 __init__ 里也会调用，此时还没设置风味
+        flavor = getattr(self, "current_flavor", DEFAULT_FLAVOR)
+        return {**variables, **flavor_variables(flavor)}
+
     def action_switch_flavor(self) -> None:
         """切换 Catppuccin 风味 (Latte -> Frappe -> Macchiato -> Mocha)"""
-        # 移除当前风味 class
-        self.screen.remove_class(f"theme-{self.current_flavor}")
-        
         # 循环切换
         current_idx = self.flavors.index(self.current_flavor)
         next_flavor = self.flavors[(current_idx + 1) % len(self.flavors)]
         
-        # 添加新风味 class
+        # 换变量表后重新套用样式 (各风味的解析结果有缓存)
         self.current_flavor = next_flavor
-        self.screen.add_class(f"theme-{next_flavor}")
+        with tracer.span("ui.switch_flavor", flavor=next_flavor):
+            self.refresh_css(animate=False)
         
-        self._add_system_message(f"🎨 主题风味: {next_flavor.title()}")
+        self._add_system_message(f"🎨 主题风味: {load_flavors()[next_flavor]['name']}")
 
 
 
@@ -518,6 +1344,7 @@ def main():
     """主入口"""
     app = CyberpunkChatApp()
     app.run()
+    sys.exit(app.return_code or 0)
 
 
 if __name__ == "__main__":
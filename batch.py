@@ -0,0 +1,254 @@
+"""
+六脉神剑 - 无界面批处理 (Headless Batch Runner)
+从文件或 stdin 读取问题 (JSONL / CSV)，并发跑完后写出 JSONL 结果。
+与 TUI 共用密钥池、人格与服务层；中断后重跑会跳过已成功的条目。
+
+用法:
+    python batch.py prompts.jsonl -o results.jsonl -c 4
+    cat words.csv | python batch.py - --format csv --template "翻译成英文: {prompt}"
+
+输入每条记录: {"id": "可选", "prompt": "问题", "model": "可选"}
+CSV 需要 prompt 列 (没有时取第一列)，可选 id / model 列。
+"""
+import argparse
+import csv
+import hashlib
+import io
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from rich.console import Console
+from rich.progress import Progress, BarColumn, MofNCompleteColumn, TimeElapsedColumn, TextColumn
+
+from config.settings import (
+    PRIMARY_SERVICE, ZHIPU_MODELS, ENABLE_WEB_SEARCH, load_api_keys, load_zhipu_api_keys
+)
+from services import GeminiService, ZhipuService
+from services.quota import quota_ledger
+from utils.logger import get_logger
+from utils.rate_limit import per_key_bucket
+
+logger = get_logger("batch")
+console = Console(stderr=True)
+
+# 默认每个 Key 每分钟请求数 (Gemini 免费档约 10 RPM)
+DEFAULT_RPM_PER_KEY = 10
+
+
+# ============== 输入 ==============
+
+def _item_id(index: int, prompt: str) -> str:
+    """没有 id 时按内容生成稳定 id (续跑依赖它)"""
+    return f"{index}-{hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:10]}"
+
+
+def read_items(source: str, fmt: str | None) -> list[dict]:
+    """读取问题列表 (source 为 '-' 时读 stdin)"""
+    if source == "-":
+        text = sys.stdin.read()
+    else:
+        text = Path(source).read_text(encoding="utf-8-sig")
+    if fmt is None:
+        fmt = "csv" if source.lower().endswith(".csv") else "jsonl"
+
+    rows: list[dict] = []
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(text))
+        for row in reader:
+            prompt = row.get("prompt") or next(iter(row.values()), "")
+            rows.append({"id": row.get("id"), "prompt": prompt, "model": row.get("model")})
+    else:
+        for line_no, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                console.print(f"[yellow]⚠️ 第 {line_no} 行不是合法 JSON，已跳过[/]")
+                continue
+            if isinstance(row, str):
+                row = {"prompt": row}
+            rows.append(row)
+
+    items = []
+    for index, row in enumerate(rows):
+        prompt = (row.get("prompt") or row.get("text") or "").strip()
+        if not prompt:
+            continue
+        items.append({
+            "id": str(row.get("id") or _item_id(index, prompt)),
+            "prompt": prompt,
+            "model": row.get("model") or None,
+        })
+    return items
+
+
+def load_finished(output: Path) -> set[str]:
+    """已成功完成的 id (续跑时跳过；失败的会重试)"""
+    finished = set()
+    if not output.exists():
+        return finished
+    with open(output, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 中断时写了半行
+            if row.get("ok"):
+                finished.add(row["id"])
+    return finished
+
+
+# ============== 执行 ==============
+
+class BatchRunner:
+    """并发执行 + 限速 + 重试 + 结果落盘"""
+
+    def __init__(self, model: str, output: Path, template: str, retries: int, rpm_per_key: float):
+        self.model = model
+        self.template = template
+        self.retries = retries
+        self._output = open(output, "a", encoding="utf-8")
+        self._write_lock = threading.Lock()
+
+        # 限速按所用服务的密钥数放大
+        gemini_keys = len(load_api_keys())
+        zhipu_keys = len(load_zhipu_api_keys())
+        self._buckets = {
+            "gemini": per_key_bucket(rpm_per_key, gemini_keys),
+            "zhipu": per_key_bucket(rpm_per_key, zhipu_keys),
+        }
+
+    def close(self) -> None:
+        self._output.close()
+
+    def _write(self, row: dict) -> None:
+        line = json.dumps(row, ensure_ascii=False) + "\n"
+        with self._write_lock:
+            self._output.write(line)
+            self._output.flush()
+
+    def run_item(self, item: dict) -> dict:
+        """执行单条 (工作线程)：失败时指数退避重试"""
+        model = item["model"] or self.model
+        if model in ZHIPU_MODELS:
+            # 长批次中途赠送额度用尽时自动换到剩余最多的模型
+            model = quota_ledger.pick_model(model)
+        provider = "zhipu" if model.startswith("glm-") else "gemini"
+        # 只替换 {prompt}：模板里的其他花括号 (如 JSON 示例) 原样保留
+        prompt = self.template.replace("{prompt}", item["prompt"]) if self.template else item["prompt"]
+
+        row = {"id": item["id"], "model": model, "ok": False}
+        for attempt in range(1, self.retries + 2):
+            self._buckets[provider].acquire()
+            # 每条独立实例：无历史，互不影响
+            service = ZhipuService(enable_web_search=ENABLE_WEB_SEARCH) if provider == "zhipu" else GeminiService()
+            started = time.perf_counter()
+            first_chunk_at = None
+            parts = []
+            try:
+                for chunk in service.stream_chat_sync(prompt, model):
+                    if chunk.startswith("__RECONNECTING__:") or chunk.startswith("__TOKEN_STATS__:"):
+                        continue
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                    parts.append(chunk)
+            except Exception as e:
+                row["error"] = str(e)[:500]
+                logger.warning("批处理失败 id=%s attempt=%d: %s", item["id"], attempt, e)
+                if attempt <= self.retries:
+                    # 指数退避 + 抖动，避免所有线程同时重试
+                    time.sleep(min(30.0, 2 ** (attempt - 1)) * (0.5 + random.random()))
+                continue
+
+            usage = service.last_usage or {}
+            row.update({
+                "ok": True,
+                "output": "".join(parts),
+                "ttft_ms": round((first_chunk_at - started) * 1000, 1) if first_chunk_at else None,
+                "total_ms": round((time.perf_counter() - started) * 1000, 1),
+                "input_tokens": usage.get("input_tokens", 0),
+                "output_tokens": usage.get("output_tokens", 0),
+                "estimated": usage.get("estimated", True),
+            })
+            row.pop("error", None)
+            break
+
+        row["attempts"] = attempt
+        row["finished_at"] = round(time.time(), 3)
+        self._write(row)
+        return row
+
+
+def parse_args(argv=None):
+    default_model = quota_ledger.pick_model() if PRIMARY_SERVICE == "zhipu" else "gemini-2.5-flash"
+    parser = argparse.ArgumentParser(description="六脉神剑批处理：JSONL/CSV 问题 -> JSONL 结果")
+    parser.add_argument("input", help="输入文件 (JSONL / CSV)，- 表示 stdin")
+    parser.add_argument("-o", "--output", help="结果文件 (默认: <输入>.results.jsonl)")
+    parser.add_argument("-f", "--format", choices=["jsonl", "csv"], help="输入格式 (默认按扩展名)")
+    parser.add_argument("-m", "--model", default=default_model, help=f"默认模型 (默认 {default_model})")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="并发数 (默认 4)")
+    parser.add_argument("-r", "--retries", type=int, default=3, help="失败重试次数 (默认 3)")
+    parser.add_argument("--rpm-per-key", type=float, default=DEFAULT_RPM_PER_KEY,
+                        help=f"每个 Key 每分钟请求数 (默认 {DEFAULT_RPM_PER_KEY})")
+    parser.add_argument("-t", "--template", default="", help="问题模板，{prompt} 为占位符 (其他花括号原样保留)")
+    parser.add_argument("--no-resume", action="store_true", help="忽略已有结果，全部重跑")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    items = read_items(args.input, args.format)
+
+    if args.output:
+        output = Path(args.output)
+    elif args.input == "-":
+        output = Path("batch_results.jsonl")
+    else:
+        output = Path(args.input).with_suffix(".results.jsonl")
+
+    finished = set() if args.no_resume else load_finished(output)
+    pending = [item for item in items if item["id"] not in finished]
+    console.print(
+        f"[bold green]🗡️ 批处理[/] 共 {len(items)} 条 | 已完成 {len(items) - len(pending)} | "
+        f"待处理 {len(pending)} | 并发 {args.concurrency} | 输出 {output}"
+    )
+    if not pending:
+        return 0
+
+    runner = BatchRunner(args.model, output, args.template, args.retries, args.rpm_per_key)
+    ok = failed = 0
+    executor = ThreadPoolExecutor(max_workers=max(1, args.concurrency), thread_name_prefix="batch")
+    try:
+        with Progress(
+            TextColumn("[cyan]{task.description}"), BarColumn(), MofNCompleteColumn(),
+            TimeElapsedColumn(), console=console,
+        ) as progress:
+            task = progress.add_task("处理中", total=len(pending))
+            futures = [executor.submit(runner.run_item, item) for item in pending]
+            for future in as_completed(futures):
+                if future.result()["ok"]:
+                    ok += 1
+                else:
+                    failed += 1
+                progress.update(task, advance=1, description=f"成功 {ok} / 失败 {failed}")
+    except KeyboardInterrupt:
+        console.print("[bold red]🛑 已中断[/] 已完成的结果已保存，重新运行即可续跑")
+        executor.shutdown(wait=False, cancel_futures=True)
+        return 130
+    finally:
+        executor.shutdown(wait=True)
+        runner.close()
+
+    console.print(f"[bold green]✅ 完成[/] 成功 {ok} | 失败 {failed} | 结果: {output}")
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+主题性能基准 - 样式表解析耗时与风味切换延迟
+在无界面模式下挂载 N 个消息气泡，测量：
+- 冷启动解析 (清空磁盘缓存) 与热启动解析 (命中缓存)
+- 每次 F12 切换风味的 refresh_css 耗时，以及到下一帧完成的总延迟
+
+用法:
+    python bench_theme.py            # 默认 1000 个气泡，每个风味切换 5 轮
+    python bench_theme.py -n 200 -r 2
+"""
+import argparse
+import asyncio
+import shutil
+import statistics
+import time
+
+from rich.console import Console
+
+from app import CyberpunkChatApp
+from utils.theme_engine import CACHE_DIR, CachedStylesheet
+from widgets.message_log import MessageLog
+
+console = Console()
+
+
+def measure_parse(app: CyberpunkChatApp) -> float:
+    """用应用实际的 CSS 源重新解析一遍 (毫秒)"""
+    stylesheet = CachedStylesheet(variables=app.get_css_variables())
+    stylesheet.source = app.stylesheet.source.copy()
+    CachedStylesheet._bundles.clear()  # 只测磁盘缓存，不用进程内缓存
+    started = time.perf_counter()
+    stylesheet.parse()
+    return (time.perf_counter() - started) * 1000
+
+
+async def run(bubbles: int, rounds: int) -> None:
+    app = CyberpunkChatApp()
+    async with app.run_test(size=(120, 40)) as pilot:
+        await pilot.pause(0.2)
+        message_log = app.query_one("#message-log", MessageLog)
+        started = time.perf_counter()
+        for i in range(bubbles):
+            if i % 3 == 0:
+                message_log.add_user_message(f"问题 {i}")
+            elif i % 3 == 1:
+                message_log.add_ai_message(app.current_model, f"**回答** {i}\n\n- 要点\n- 要点", "done")
+            else:
+                message_log.add_system_message(f"系统消息 {i}")
+        await pilot.pause(0.5)
+        console.print(f"挂载 {bubbles} 个气泡: {(time.perf_counter() - started) * 1000:.0f} ms "
+                      f"| 节点数 {len(list(app.screen.walk_children()))}")
+
+        # 解析耗时：冷 (无磁盘缓存) / 热 (命中磁盘缓存)
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+        cold = measure_parse(app)
+        warm = statistics.median(measure_parse(app) for _ in range(5))
+        console.print(f"样式表解析: 冷 {cold:.1f} ms | 热 {warm:.1f} ms "
+                      f"| 规则数 {len(app.stylesheet.rules)}")
+
+        # 风味切换：refresh_css 本身 + 到下一帧
+        refresh_ms, frame_ms = [], []
+        for _ in range(rounds * len(app.flavors)):
+            started = time.perf_counter()
+            app.action_switch_flavor()
+            refresh_ms.append((time.perf_counter() - started) * 1000)
+            await pilot.pause()
+            frame_ms.append((time.perf_counter() - started) * 1000)
+
+        console.print(
+            f"风味切换 ({len(refresh_ms)} 次): refresh_css 中位数 {statistics.median(refresh_ms):.1f} ms "
+            f"(最大 {max(refresh_ms):.1f}) | 到下一帧 {statistics.median(frame_ms):.1f} ms "
+            f"(最大 {max(frame_ms):.1f})"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="主题解析与切换基准")
+    parser.add_argument("-n", "--bubbles", type=int, default=1000, help="气泡数量 (默认 1000)")
+    parser.add_argument("-r", "--rounds", type=int, default=5, help="每个风味切换轮数 (默认 5)")
+    args = parser.parse_args()
+    asyncio.run(run(args.bubbles, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
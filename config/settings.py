@@ -3,6 +3,7 @@
 """
 import os
 from pathlib import Path
+from urllib.parse import urlparse
 
 # 加载.env文件（override=True 让 .env 覆盖系统环境变量）
 try:
@@ -25,11 +26,24 @@ _SPEED_MAP = {"slow": 0.04, "normal": 0.015, "fast": 0.005, "instant": 0}
 TYPEWRITER_SPEED = os.getenv("TYPEWRITER_SPEED", "slow")
 TYPEWRITER_DELAY = _SPEED_MAP.get(TYPEWRITER_SPEED.lower(), 0.015)
 
+# 日志配置
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()          # text 或 json (JSON Lines)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))  # 单文件上限
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))    # 保留的压缩旧文件数
+LOG_ROTATE_DAILY = os.getenv("LOG_ROTATE_DAILY", "true").lower() == "true"  # 每天零点切分
+
 def setup_proxy():
-    """设置系统代理环境变量"""
+    """设置系统代理环境变量 (GEMINI_BASE_URL 指向本机替身时该地址直连)"""
     os.environ['HTTP_PROXY'] = os.environ['HTTPS_PROXY'] = PROXY_URL
     os.environ['http_proxy'] = os.environ['https_proxy'] = PROXY_URL
     os.environ['all_proxy'] = PROXY_URL
+    host = urlparse(GEMINI_BASE_URL).hostname if GEMINI_BASE_URL else None
+    if host in ("127.0.0.1", "localhost", "::1"):
+        bypass = [h for h in os.environ.get("NO_PROXY", "").split(",") if h]
+        if host not in bypass:
+            bypass.append(host)
+        os.environ['NO_PROXY'] = os.environ['no_proxy'] = ",".join(bypass)
 
 def load_api_keys():
     """从环境变量加载 API 密钥列表 (支持逗号分隔多Key)"""
@@ -85,19 +99,56 @@ def load_zhipu_api_keys():
     return [val.strip()]
 
 
-# 智谱模型配置（根据用户实际配额更新于 2026-01-05）
+# 智谱模型配置（根据用户实际配额更新于 2026-01-05；tokens 为总额度，剩余额度由 services/quota.py 按账本计算）
 ZHIPU_MODELS = {
     # 赠送额度（按 tokens 降序排列，优先使用）
-    "glm-4.5-air": {"name": "GLM-4.5 Air", "desc": "947万 免费", "type": "free"},
-    "glm-4.6": {"name": "GLM-4.6", "desc": "700万 免费", "type": "free"},
-    "glm-4.6v": {"name": "GLM-4.6V", "desc": "600万 免费", "type": "free"},
+    "glm-4.5-air": {"name": "GLM-4.5 Air", "desc": "947万 免费", "type": "free", "tokens": 9_470_000},
+    "glm-4.6": {"name": "GLM-4.6", "desc": "700万 免费", "type": "free", "tokens": 7_000_000},
+    "glm-4.6v": {"name": "GLM-4.6V", "desc": "600万 免费", "type": "free", "tokens": 6_000_000},
     # 付费额度
-    "glm-4.7": {"name": "GLM-4.7", "desc": "588万 付费", "type": "paid"},
+    "glm-4.7": {"name": "GLM-4.7", "desc": "588万 付费", "type": "paid", "tokens": 5_880_000},
 }
 
+# 剩余额度低于该值 (tokens) 的赠送模型视为用尽，自动切换 (避免请求中途耗尽)
+ZHIPU_QUOTA_RESERVE = int(os.getenv("ZHIPU_QUOTA_RESERVE", "20000"))
+
+# Gemini 可选模型 (/model 轮换顺序)
+GEMINI_MODELS = ["gemini-2.5-flash", "gemini-flash-latest", "gemini-2.5-flash-lite"]
+
+# Gemini 接口地址 (为空用官方地址；可指向本地替身 mock_gemini.py 测试)
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")
+
+# Gemini 上下文缓存：系统指令 + 较早的稳定历史放进服务端缓存，每轮只发送新增部分
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE_ENABLED", "true").lower() == "true"
+GEMINI_CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", "600"))              # 缓存存活秒数 (使用时临近过期自动续期)
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", "1024"))  # 低于服务端最小缓存长度时不创建
+GEMINI_CACHE_STEP = int(os.getenv("GEMINI_CACHE_STEP", "4"))              # 缓存前缀按几轮对齐 (越大重建越少)
+
 # 主备服务配置
 PRIMARY_SERVICE = os.getenv("PRIMARY_SERVICE", "zhipu").lower()
 ENABLE_WEB_SEARCH = os.getenv("ENABLE_WEB_SEARCH", "true").lower() == "true"
 
-# 智谱默认模型（优先使用赠送额度最多的）
+# 路由器后台探测不健康模型的间隔 (秒，失败后指数退避；0 = 不探测，仅靠真实请求恢复)
+ROUTER_PROBE_INTERVAL = float(os.getenv("ROUTER_PROBE_INTERVAL", "30"))
+
+# 每轮流式请求的最多尝试次数 (中途断开时从断点续写，首字前失败则重发)
+STREAM_MAX_ATTEMPTS = int(os.getenv("STREAM_MAX_ATTEMPTS", "3"))
+
+# 全局同时进行的流式请求上限 (多标签会话共享)
+MAX_CONCURRENT_STREAMS = int(os.getenv("MAX_CONCURRENT_STREAMS", "3"))
+
+# 智谱默认模型（无账本数据时的首选；实际按剩余额度自动选择，见 services/quota.py）
 DEFAULT_ZHIPU_MODEL = "glm-4.5-air"
+
+# 本地 OpenAI 兼容网关 (gateway.py)
+GATEWAY_HOST = os.getenv("GATEWAY_HOST", "127.0.0.1")
+GATEWAY_PORT = int(os.getenv("GATEWAY_PORT", "8765"))
+GATEWAY_TOKEN = os.getenv("GATEWAY_TOKEN", "")  # 非空时要求 Authorization: Bearer <token>
+GATEWAY_CLIENT_CONCURRENCY = int(os.getenv("GATEWAY_CLIENT_CONCURRENCY", "4"))  # 每个客户端同时进行的请求数
+
+# /compare 默认参与对比的模型 (逗号分隔，可用环境变量覆盖)
+COMPARE_MODELS = [
+    m.strip() for m in os.getenv(
+        "COMPARE_MODELS", "glm-4.5-air,glm-4.6,glm-4.7,gemini-2.5-flash,gemini-2.5-flash-lite"
+    ).split(",") if m.strip()
+]
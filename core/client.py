@@ -2,9 +2,11 @@
 Gemini 客户端初始化 - 支持多 Key 轮换
 """
 from google import genai
-from config.settings import load_api_keys, setup_proxy
+from google.genai import types
+from config.settings import load_api_keys, setup_proxy, GEMINI_BASE_URL
 from rich.console import Console
 import random
+import threading
 
 console = Console(stderr=True)
 
@@ -15,6 +17,9 @@ class ClientPool:
         self.api_keys = load_api_keys()
         self.current_index = 0
         self._client = None
+        self._clients: dict[int, genai.Client] = {}  # 每个 Key 一个客户端 (复用连接)
+        self._lease_index = 0
+        self._lock = threading.Lock()
         
         if not self.api_keys:
             console.print("❌ 致命错误: 未找到 API 密钥!")
@@ -23,6 +28,7 @@ class ClientPool:
         
         # 随机起点，避免所有用户都从第一个 Key 开始
         self.current_index = random.randint(0, len(self.api_keys) - 1)
+        self._lease_index = self.current_index
         self._init_client()
         
         console.print(f"🔑 密钥池已加载: [bold green]{len(self.api_keys)}[/] 个 | 本次挂载: [dim]{self._mask_key()}[/]")
@@ -32,9 +38,37 @@ class ClientPool:
         key = self.api_keys[self.current_index]
         return f"{key[:4]}...{key[-4:]}" if len(key) > 8 else "***"
     
+    def _client_for(self, index: int):
+        """获取指定 Key 的客户端 (懒创建并缓存)"""
+        client = self._clients.get(index)
+        if client is None:
+            # GEMINI_BASE_URL 可指向本地替身接口 (测试缓存等功能时不消耗真实额度)
+            http_options = types.HttpOptions(base_url=GEMINI_BASE_URL) if GEMINI_BASE_URL else None
+            client = genai.Client(api_key=self.api_keys[index], http_options=http_options)
+            self._clients[index] = client
+        return client
+
+    def key_index(self, client) -> int:
+        """客户端对应的 Key 序号 (上下文缓存按 Key 隔离)"""
+        for index, cached in self._clients.items():
+            if cached is client:
+                return index
+        return -1
+
+    def client_at(self, index: int):
+        """指定 Key 的客户端 (复用已有缓存的请求固定走创建缓存的 Key)"""
+        return self._client_for(index)
+
     def _init_client(self):
         """初始化当前 Key 的客户端"""
-        self._client = genai.Client(api_key=self.api_keys[self.current_index])
+        self._client = self._client_for(self.current_index)
+
+    def lease(self):
+        """按请求轮询分配 Key (并发会话均匀分摊到整个密钥池)"""
+        with self._lock:
+            index = self._lease_index
+            self._lease_index = (index + 1) % len(self.api_keys)
+            return self._client_for(index)
     
     def rotate_key(self):
         """轮换到下一个 Key (429 时调用)"""
@@ -22,16 +22,6 @@ except ImportError:
 class ZhipuClient:
     """智谱客户端 - 单 Key 版本"""
 
-    # 智谱模型列表（根据用户实际配额）
-    MODELS = {
-        # 赠送额度（优先使用）
-        "glm-4.6v": {"name": "GLM-4.6V", "desc": "赠送 600万", "type": "free", "tokens": 6000000},
-        "glm-4.6": {"name": "GLM-4.6", "desc": "赠送 700万", "type": "free", "tokens": 7000000},
-        "glm-4.5-air": {"name": "GLM-4.5 Air", "desc": "赠送 962万", "type": "free", "tokens": 9621586},
-        # 付费额度
-        "glm-4.7": {"name": "GLM-4.7", "desc": "付费 977万", "type": "paid", "tokens": 9770866},
-    }
-
     def __init__(self):
         self._client = None
         self._has_key = False
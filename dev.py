@@ -1,18 +1,25 @@
 """
 六脉神剑 - 极客热重载启动器 (Geek Hot-Reloader)
-使用 watchdog 监控文件变化，自动重启应用。
+使用 watchdog 监控文件变化，按内容哈希判断是否真的改了：
+- .tcss / 风味变量 -> 应用内直接重新套用样式
+- 气泡组件模块     -> 应用内重载模块并重建消息区
+- 其他代码 / 配置  -> 应用保存会话后退出 (退出码 3)，重新拉起并恢复会话
+需要完整重启时，由预热的 zygote 进程 (已导入 textual / rich / genai / zhipuai 等
+第三方库，不导入项目模块) fork 出新的应用进程，省掉解释器启动与重型导入。
+不支持 fork 的平台 (Windows) 退回普通子进程。
 支持 Rich 美化输出，智能防抖。
 """
+import atexit
 import sys
 import time
+import threading
 import subprocess
 import signal
 import os
+import select
 from pathlib import Path
 from rich.console import Console
 from rich.panel import Panel
-from rich.live import Live
-from rich.spinner import Spinner
 from rich.text import Text
 
 try:
@@ -22,22 +29,249 @@ except ImportError:
     print("❌ 缺少 watchdog 库。请运行: pip install watchdog")
     sys.exit(1)
 
+from utils.dev_reload import (
+    ENV_FLAG, RESTART_AT_ENV, RESTART_EXIT_CODE, classify, content_hash, read_first_paint, send_command,
+)
+
 # 配置
 PROJECT_DIR = Path(__file__).parent.resolve()
 WATCH_EXTENSIONS = {".py", ".tcss", ".css", ".json", ".env"}
-IGNORE_DIRS = {".git", ".venv", "__pycache__", ".idea", ".vscode", "logs", "screenshot", "doc"}
+# data/ 是应用自己的缓存 (天气 / 新闻)，.dev/ .cache/ 是热重载与样式缓存，都不触发重载
+IGNORE_DIRS = {
+    ".git", ".venv", "__pycache__", ".idea", ".vscode", "logs", "screenshot", "doc",
+    "data", ".dev", ".cache", "code_snippets", "themes_cloned",
+}
 DEBOUNCE_DELAY = 1.0  # 防抖延迟 (秒) - 稍微调大一点保证文件写入完成
+RESTART_TIMEOUT = 5.0  # 等待应用保存会话并退出的最长时间 (秒)
+
+# zygote 预先导入的第三方重型模块 (项目模块一律不导入，保证改动生效)
+WARM_MODULES = [
+    "textual.app", "textual.widgets", "textual.containers", "textual.binding",
+    "rich.console", "rich.markdown", "rich.syntax", "rich.text",
+    "pygments.lexers", "httpx", "google.genai", "zhipuai", "psutil",
+]
 
 console = Console()
 
+
+# ============== Zygote 预热进程 ==============
+
+def _project_module(module) -> bool:
+    path = getattr(module, "__file__", None)
+    return bool(path) and Path(path).resolve().is_relative_to(PROJECT_DIR)
+
+
+def _run_app_child(restart_at: str) -> None:
+    """zygote fork 出的子进程：清掉项目模块后按 __main__ 运行 app.py (不返回)"""
+    import runpy
+    code = 1
+    try:
+        os.setsid()  # 独立进程组，便于整组结束
+        os.environ["PYTHONUNBUFFERED"] = "1"
+        os.environ[ENV_FLAG] = "1"
+        os.environ[RESTART_AT_ENV] = restart_at
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # dev.py 自身依赖的项目模块 (utils.*) 也要重新导入，改动才能生效
+        for name, module in list(sys.modules.items()):
+            if name != "__main__" and _project_module(module):
+                del sys.modules[name]
+        os.chdir(PROJECT_DIR)
+        sys.argv = ["app.py"]
+        runpy.run_path(str(PROJECT_DIR / "app.py"), run_name="__main__")
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        # os._exit 不会执行 atexit：先手动执行 (日志后台线程在其中刷完队列)
+        try:
+            atexit._run_exitfuncs()
+        except BaseException:
+            pass
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def zygote_main(command_fd: int, reply_fd: int) -> None:
+    """zygote 主循环：单线程 (fork 安全)，收到 spawn 就 fork 一个应用进程"""
+    for name in WARM_MODULES:
+        try:
+            __import__(name)
+        except Exception:
+            pass  # 缺少的可选依赖交给应用自己报错
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C 由 dev.py 处理
+
+    def reply(line: str) -> None:
+        os.write(reply_fd, (line + "\n").encode())
+
+    reply("ready")
+    buffer = b""
+    children: set[int] = set()
+    while True:
+        readable, _, _ = select.select([command_fd], [], [], 0.1)
+        if readable:
+            data = os.read(command_fd, 4096)
+            if not data:
+                break  # dev.py 已退出
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                parts = line.decode().split()
+                if parts and parts[0] == "spawn":
+                    pid = os.fork()
+                    if pid == 0:
+                        os.close(command_fd)
+                        os.close(reply_fd)
+                        _run_app_child(parts[1])
+                    children.add(pid)
+                    reply(f"pid {pid}")
+        # 回收已退出的应用进程并上报退出码
+        for pid in list(children):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                children.discard(pid)
+                reply(f"exit {pid} {os.waitstatus_to_exitcode(status)}")
+    os._exit(0)
+
+
+class ZygoteChild:
+    """zygote fork 出的应用进程 (接口对齐 subprocess.Popen 的 pid / poll)"""
+
+    def __init__(self, zygote: "Zygote", pid: int):
+        self._zygote = zygote
+        self.pid = pid
+
+    def poll(self) -> int | None:
+        self._zygote.pump()
+        return self._zygote.exit_codes.get(self.pid)
+
+
+class Zygote:
+    """dev.py 侧的 zygote 句柄"""
+
+    def __init__(self):
+        self.process: subprocess.Popen | None = None
+        self.exit_codes: dict[int, int] = {}
+        self._buffer = b""
+        self._command_w = self._reply_r = None
+
+    @staticmethod
+    def supported() -> bool:
+        return hasattr(os, "fork") and sys.platform != "win32"
+
+    def start(self) -> bool:
+        """启动 zygote 并等它导入完毕"""
+        command_r, self._command_w = os.pipe()
+        self._reply_r, reply_w = os.pipe()
+        started = time.perf_counter()
+        self.process = subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()), "--zygote", str(command_r), str(reply_w)],
+            cwd=PROJECT_DIR,
+            pass_fds=(command_r, reply_w),
+        )
+        os.close(command_r)
+        os.close(reply_w)
+        line = self._read_line(timeout=60)
+        if line != "ready":
+            self.stop()
+            return False
+        console.print(f"[dim]🧬 zygote 预热完成 ({(time.perf_counter() - started) * 1000:.0f} ms)[/dim]")
+        return True
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def spawn(self, restart_at: float) -> ZygoteChild | None:
+        try:
+            os.write(self._command_w, f"spawn {restart_at}\n".encode())
+        except OSError:
+            return None
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            line = self._read_line(timeout=deadline - time.time())
+            if line is None:
+                break
+            if line.startswith("pid "):
+                return ZygoteChild(self, int(line.split()[1]))
+            self._handle(line)
+        return None
+
+    def pump(self) -> None:
+        """处理 zygote 发来的退出通知 (非阻塞)"""
+        while True:
+            line = self._read_line(timeout=0)
+            if line is None:
+                return
+            self._handle(line)
+
+    def _handle(self, line: str) -> None:
+        parts = line.split()
+        if len(parts) == 3 and parts[0] == "exit":
+            self.exit_codes[int(parts[1])] = int(parts[2])
+
+    def _read_line(self, timeout: float) -> str | None:
+        while b"\n" not in self._buffer:
+            if self._reply_r is None:
+                return None
+            readable, _, _ = select.select([self._reply_r], [], [], max(0.0, timeout))
+            if not readable:
+                return None
+            data = os.read(self._reply_r, 4096)
+            if not data:
+                return None
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line.decode()
+
+    def stop(self) -> None:
+        for fd in (self._command_w, self._reply_r):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._command_w = self._reply_r = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process = None
+
 class HotReloader(FileSystemEventHandler):
     """智能热重载处理器"""
 
-    def __init__(self):
+    def __init__(self, use_zygote: bool = True):
         self.process = None
+        self.zygote = Zygote() if use_zygote and Zygote.supported() else None
         self.last_change_time = 0
         self.needs_restart = True  # 初始启动
         self.running = True
+        self._hashes = self._scan()   # 相对路径 -> 内容哈希
+        self._changed: set[str] = set()
+        self._lock = threading.Lock()  # watchdog 回调线程与主循环共用 _changed
+        self._seq = 0
+
+    def _watched(self, path: Path) -> bool:
+        try:
+            rel = path.relative_to(PROJECT_DIR)
+        except ValueError:
+            return False
+        return path.suffix in WATCH_EXTENSIONS and not any(p in IGNORE_DIRS for p in rel.parts)
+
+    def _scan(self) -> dict[str, str]:
+        """启动时记录所有被监控文件的内容哈希"""
+        hashes = {}
+        for root, dirs, files in os.walk(PROJECT_DIR):
+            dirs[:] = [d for d in dirs if d not in IGNORE_DIRS]
+            for name in files:
+                path = Path(root) / name
+                if self._watched(path):
+                    digest = content_hash(path)
+                    if digest:
+                        hashes[path.relative_to(PROJECT_DIR).as_posix()] = digest
+        return hashes
 
     def _kill_process(self):
         """优雅地杀死子进程"""
@@ -56,18 +290,38 @@ class HotReloader(FileSystemEventHandler):
                 pass
             self.process = None
 
-    def restart_application(self):
-        """重启应用"""
+    def _is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def restart_application(self, restart_at: float | None = None):
+        """重启应用 (restart_at: 触发重启的时刻，用于统计到首帧的耗时)"""
+        restart_at = restart_at or time.time()
         self._kill_process()
-        
+        self._report_first_paint()
+
         console.print(Panel(
             Text("🔄 正在加载神经连接...", style="bold yellow"),
             border_style="yellow",
             padding=(0, 2)
         ))
 
+        # 优先由预热的 zygote fork；它不可用时退回普通子进程
+        if self.zygote is not None:
+            if not self.zygote.alive() and not self.zygote.start():
+                console.print("[yellow]⚠️ zygote 启动失败，改用普通子进程[/yellow]")
+                self.zygote = None
+            else:
+                self.process = self.zygote.spawn(restart_at)
+                if self.process is not None:
+                    return
+                console.print("[yellow]⚠️ zygote 无响应，改用普通子进程[/yellow]")
+                self.zygote.stop()
+                self.zygote = None
+
         env = os.environ.copy()
         env["PYTHONUNBUFFERED"] = "1"  # 确保子进程立即输出
+        env[ENV_FLAG] = "1"  # 应用侧开启命令轮询与会话恢复
+        env[RESTART_AT_ENV] = str(restart_at)
 
         try:
             # 启动子进程
@@ -86,62 +340,123 @@ class HotReloader(FileSystemEventHandler):
         except Exception as e:
             console.print(f"[bold red]❌ 启动失败:[/bold red] {e}")
 
+    def _report_first_paint(self):
+        """打印上一次重启到首帧的耗时 (应用首帧后写入 .dev/)"""
+        record = read_first_paint()
+        if record and record.get("restart_at") != getattr(self, "_reported_restart", None):
+            self._reported_restart = record.get("restart_at")
+            mode = "zygote fork" if self.zygote is not None else "子进程"
+            console.print(f"[dim]⏱️ 上次重启到首帧: {record['first_paint_ms']:.0f} ms ({mode})[/dim]")
+
+    def _graceful_restart(self, paths: list[str]):
+        """通知应用保存会话并退出，超时则强杀，然后重新拉起"""
+        restart_at = time.time()
+        if self._is_running():
+            self._seq += 1
+            send_command(self._seq, "restart", paths)
+            deadline = time.time() + RESTART_TIMEOUT
+            while self._is_running() and time.time() < deadline:
+                time.sleep(0.05)
+            if self._is_running():
+                console.print("[yellow]⚠️ 应用未响应重启命令，强制重启 (会话不保留)[/yellow]")
+        self.restart_application(restart_at)
+
+    def _apply_changes(self):
+        """按变更类型热重载或重启"""
+        with self._lock:
+            paths = sorted(self._changed)
+            self._changed.clear()
+        if "dev.py" in paths:
+            console.print("[yellow]⚠️ dev.py 本身已修改，需要手动重新运行[/yellow]")
+
+        kind = classify(paths)
+        if not self._is_running():
+            self.restart_application()
+        elif kind == "restart":
+            self._graceful_restart(paths)
+        else:
+            # 样式 / 组件：交给应用进程内处理
+            self._seq += 1
+            send_command(self._seq, kind, paths)
+
     def on_modified(self, event):
         """文件变更回调"""
         if event.is_directory:
             return
+        self._record(Path(event.src_path))
 
-        path = Path(event.src_path)
-        
-        # 检查忽略目录
-        if any(p in path.parts for p in IGNORE_DIRS):
+    def _record(self, path: Path):
+        # 检查忽略目录与扩展名
+        if not self._watched(path):
             return
 
-        # 检查扩展名
-        if path.suffix not in WATCH_EXTENSIONS:
-            return
+        # 内容没变 (只是被重新写入 / touch) 不算变更
+        rel = path.relative_to(PROJECT_DIR).as_posix()
+        digest = content_hash(path)
+        with self._lock:
+            if digest is None or digest == self._hashes.get(rel):
+                return
+            self._hashes[rel] = digest
 
-        # 记录变更
-        current_time = time.time()
-        # 简单防抖：如果距离上次变更很近，只更新时间
-        self.last_change_time = current_time
-        self.needs_restart = True
-        
-        rel_path = path.relative_to(PROJECT_DIR)
-        console.print(f"[dim]� 检测到变更: {rel_path}[/dim]")
+            # 记录变更
+            # 简单防抖：如果距离上次变更很近，只更新时间
+            self.last_change_time = time.time()
+            self._changed.add(rel)
 
     def on_created(self, event):
         self.on_modified(event)
 
+    def on_moved(self, event):
+        """编辑器常用 "写临时文件再改名" 的方式保存"""
+        if not event.is_directory:
+            self._record(Path(event.dest_path))
+
     def loop(self):
         """主循环"""
+        # 先预热 zygote (导入第三方库)，之后每次重启只需 fork
+        if self.zygote is not None and not self.zygote.start():
+            console.print("[yellow]⚠️ zygote 启动失败，改用普通子进程[/yellow]")
+            self.zygote = None
+
         observer = Observer()
         observer.schedule(self, str(PROJECT_DIR), recursive=True)
         observer.start()
 
         console.print(f"[bold green]🚀 六脉神剑监视器已激活[/bold green]")
-        console.print(f"[dim]📁 监控目录: {PROJECT_DIR}[/dim]")
-        
+        console.print(f"[dim]📁 监控目录: {PROJECT_DIR} ({len(self._hashes)} 个文件)[/dim]")
+
         try:
             while self.running:
                 current_time = time.time()
-                
-                # 检查是否需要重启，并且防抖时间已过
-                if self.needs_restart and (current_time - self.last_change_time > DEBOUNCE_DELAY):
+
+                if self.needs_restart:
                     self.needs_restart = False
                     self.restart_application()
-                
+
+                # 有变更，并且防抖时间已过
+                if self._changed and (current_time - self.last_change_time > DEBOUNCE_DELAY):
+                    self._apply_changes()
+
+                # 应用自己请求重启 (退出码 3)
+                if self.process is not None and self.process.poll() == RESTART_EXIT_CODE:
+                    self.restart_application()
+
                 time.sleep(0.1)
-                
+
         except KeyboardInterrupt:
             console.print("\n[bold red]🛑 系统下线...[/bold red]")
         finally:
             observer.stop()
             observer.join()
             self._kill_process()
+            if self.zygote is not None:
+                self.zygote.stop()
 
 def main():
-    reloader = HotReloader()
+    if len(sys.argv) == 4 and sys.argv[1] == "--zygote":
+        zygote_main(int(sys.argv[2]), int(sys.argv[3]))
+        return
+    reloader = HotReloader(use_zygote="--no-zygote" not in sys.argv)
     reloader.loop()
 
 if __name__ == "__main__":
@@ -0,0 +1,541 @@
+"""
+六脉神剑 - 本地 OpenAI 兼容网关 (Local Gateway)
+让编辑器 / 脚本等本地工具直接复用密钥池、模型路由与人格设定。
+
+    python gateway.py [--host 127.0.0.1] [--port 8765]
+
+接口:
+    POST /v1/chat/completions   (stream=true 时为 SSE)
+    GET  /v1/models
+    GET  /metrics               (Prometheus 文本格式)
+
+- 纯 asyncio HTTP/1.1，支持 keep-alive，一个进程服务多个本地客户端
+- 上游 SDK 客户端 / 连接池进程内共享，同步流在线程池中运行再桥接回事件循环
+- 每个客户端 (Bearer Token 或 IP) 独立并发上限
+- 按路由器评分选择模型 (指定的模型为首选)，首个 chunk 之前失败切换到次优候选；客户端断开时立即关闭上游流
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from rich.console import Console
+
+from config.settings import (
+    ZHIPU_MODELS, GEMINI_MODELS, ENABLE_WEB_SEARCH,
+    GATEWAY_HOST, GATEWAY_PORT, GATEWAY_TOKEN, GATEWAY_CLIENT_CONCURRENCY,
+)
+from services import GeminiService, ZhipuService
+from services.cancel import CancelToken
+from services.router import router, provider_of
+from utils.logger import get_logger
+
+logger = get_logger("gateway")
+console = Console(stderr=True)
+
+# ============== 配置参数 ==============
+KEEP_ALIVE_TIMEOUT = 60.0      # 空闲连接保持时间 (秒)
+MAX_BODY_BYTES = 4 * 1024 * 1024
+UPSTREAM_WORKERS = 32          # 上游同步流的线程数
+
+_STATUS_TEXT = {
+    200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+    405: "Method Not Allowed", 411: "Length Required", 413: "Payload Too Large",
+    500: "Internal Server Error", 502: "Bad Gateway",
+}
+
+
+class HttpError(Exception):
+    """直接返回给客户端的错误"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# ============== HTTP/1.1 ==============
+
+class Request:
+    """解析后的 HTTP 请求"""
+
+    def __init__(self, method: str, path: str, version: str, headers: dict[str, str], body: bytes):
+        self.method = method
+        self.path = path.split("?", 1)[0]
+        self.headers = headers
+        self.body = body
+        connection = headers.get("connection", "").lower()
+        # HTTP/1.1 默认长连接，HTTP/1.0 需显式 keep-alive
+        if version == "HTTP/1.0":
+            self.keep_alive = connection == "keep-alive"
+        else:
+            self.keep_alive = connection != "close"
+
+    def json(self) -> dict:
+        try:
+            data = json.loads(self.body or b"{}")
+        except json.JSONDecodeError:
+            raise HttpError(400, "请求体不是合法 JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "请求体必须是 JSON 对象")
+        return data
+
+
+async def read_request(reader: asyncio.StreamReader) -> Request | None:
+    """读取一个请求 (连接关闭或空闲超时返回 None)"""
+    try:
+        line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+    except (asyncio.TimeoutError, ConnectionError):
+        return None
+    if not line:
+        return None
+    try:
+        method, path, version = line.decode("latin-1").strip().split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "无效的请求行")
+
+    headers: dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HttpError(411, "不支持 chunked 请求体，请提供 Content-Length")
+    length = int(headers.get("content-length", "0") or 0)
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, "请求体过大")
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), path, version.upper(), headers, body)
+
+
+def _head(status: int, headers: dict[str, str], keep_alive: bool) -> bytes:
+    lines = [f"HTTP/1.1 {status} {_STATUS_TEXT.get(status, 'OK')}"]
+    headers = {**headers, "Connection": "keep-alive" if keep_alive else "close"}
+    lines += [f"{k}: {v}" for k, v in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_body(writer, status: int, body: bytes, content_type: str, keep_alive: bool) -> None:
+    """定长响应"""
+    writer.write(_head(status, {"Content-Type": content_type, "Content-Length": str(len(body))}, keep_alive))
+    writer.write(body)
+    await writer.drain()
+
+
+async def send_json(writer, status: int, data, keep_alive: bool) -> None:
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    await send_body(writer, status, body, "application/json; charset=utf-8", keep_alive)
+
+
+def error_body(message: str, kind: str = "invalid_request_error") -> dict:
+    """OpenAI 风格的错误结构"""
+    return {"error": {"message": message, "type": kind}}
+
+
+class ChunkedWriter:
+    """分块传输 (SSE 响应在长连接上也能界定结束)"""
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    async def start(self, keep_alive: bool) -> None:
+        self._writer.write(_head(200, {
+            "Content-Type": "text/event-stream; charset=utf-8",
+            "Cache-Control": "no-cache",
+            "Transfer-Encoding": "chunked",
+        }, keep_alive))
+        await self._writer.drain()
+
+    async def send_event(self, data: str) -> None:
+        payload = f"data: {data}\n\n".encode("utf-8")
+        self._writer.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+        await self._writer.drain()
+
+    async def finish(self) -> None:
+        self._writer.write(b"0\r\n\r\n")
+        await self._writer.drain()
+
+
+# ============== 指标 ==============
+
+class Metrics:
+    """Prometheus 文本格式的计数器"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.requests = defaultdict(int)        # (path, status) -> 次数
+        self.completions = defaultdict(int)     # (model, outcome) -> 次数
+        self.routes = defaultdict(int)          # (首选, 实际, 原因) -> 次数
+        self.tokens = defaultdict(int)          # direction -> tokens
+        self.failovers = 0
+        self.active_streams = 0
+        self.open_connections = 0
+        self.connections_total = 0
+        self.ttft_ms_sum = 0.0
+        self.ttft_count = 0
+
+    def render(self) -> str:
+        lines = [
+            "# TYPE gateway_uptime_seconds gauge",
+            f"gateway_uptime_seconds {time.time() - self.started_at:.0f}",
+            "# TYPE gateway_open_connections gauge",
+            f"gateway_open_connections {self.open_connections}",
+            "# TYPE gateway_connections_total counter",
+            f"gateway_connections_total {self.connections_total}",
+            "# TYPE gateway_active_streams gauge",
+            f"gateway_active_streams {self.active_streams}",
+            "# TYPE gateway_failovers_total counter",
+            f"gateway_failovers_total {self.failovers}",
+            "# TYPE gateway_requests_total counter",
+        ]
+        for (path, status), count in sorted(self.requests.items()):
+            lines.append(f'gateway_requests_total{{path="{path}",status="{status}"}} {count}')
+        lines.append("# TYPE gateway_completions_total counter")
+        for (model, outcome), count in sorted(self.completions.items()):
+            lines.append(f'gateway_completions_total{{model="{model}",outcome="{outcome}"}} {count}')
+        lines.append("# TYPE gateway_tokens_total counter")
+        for direction, count in sorted(self.tokens.items()):
+            lines.append(f'gateway_tokens_total{{direction="{direction}"}} {count}')
+        lines.append("# TYPE gateway_routes_total counter")
+        for (preferred, model, reason), count in sorted(self.routes.items()):
+            lines.append(f'gateway_routes_total{{preferred="{preferred}",model="{model}",reason="{reason}"}} {count}')
+        lines.append("# TYPE gateway_router_score gauge")
+        now = time.time()
+        for option in router.options:
+            lines.append(f'gateway_router_score{{model="{option.model}"}} {router.score(option, "", now):.3f}')
+        lines.append("# TYPE gateway_router_healthy gauge")
+        for option in router.options:
+            lines.append(f'gateway_router_healthy{{model="{option.model}"}} {int(option.healthy)}')
+        lines += [
+            "# TYPE gateway_ttft_ms summary",
+            f"gateway_ttft_ms_sum {self.ttft_ms_sum:.1f}",
+            f"gateway_ttft_ms_count {self.ttft_count}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+# ============== 上游流 ==============
+
+class UpstreamStream:
+    """在线程池中运行同步服务流，通过 asyncio.Queue 交回事件循环"""
+
+    def __init__(self, model: str, history: list, prompt: str):
+        self.model = model
+        self.prompt = prompt
+        self.cancel = CancelToken()
+        if provider_of(model) == "zhipu":
+            self.service = ZhipuService(enable_web_search=ENABLE_WEB_SEARCH)
+        else:
+            self.service = GeminiService()
+        self.service.set_history(history)
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def start(self, loop: asyncio.AbstractEventLoop, executor: ThreadPoolExecutor) -> None:
+        loop.run_in_executor(executor, self._pump, loop)
+
+    def _pump(self, loop: asyncio.AbstractEventLoop) -> None:
+        put = self._queue.put_nowait
+        try:
+            for chunk in self.service.stream_chat_sync(self.prompt, self.model, self.cancel):
+                if chunk.startswith("__RECONNECTING__:") or chunk.startswith("__TOKEN_STATS__:"):
+                    continue
+                loop.call_soon_threadsafe(put, ("chunk", chunk))
+            loop.call_soon_threadsafe(put, ("end", None))
+        except Exception as e:
+            loop.call_soon_threadsafe(put, ("error", e))
+
+    async def next(self) -> tuple[str, object]:
+        return await self._queue.get()
+
+    @property
+    def usage(self) -> dict:
+        return self.service.last_usage or {}
+
+
+# ============== 网关 ==============
+
+class Gateway:
+    """OpenAI 兼容网关"""
+
+    def __init__(self, client_concurrency: int = GATEWAY_CLIENT_CONCURRENCY, token: str = GATEWAY_TOKEN):
+        self.client_concurrency = max(1, client_concurrency)
+        self.token = token
+        self.metrics = Metrics()
+        self._executor = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix="upstream")
+        self._client_slots: dict[str, asyncio.Semaphore] = {}
+
+    # ---------- 连接 ----------
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """一个 TCP 连接上顺序处理多个请求 (keep-alive)"""
+        peer = writer.get_extra_info("peername")
+        peer_ip = peer[0] if peer else "unknown"
+        self.metrics.open_connections += 1
+        self.metrics.connections_total += 1
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HttpError as e:
+                    await send_json(writer, e.status, error_body(e.message), keep_alive=False)
+                    break
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if request is None:
+                    break
+                keep_alive = await self._dispatch(request, writer, peer_ip)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.metrics.open_connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _dispatch(self, request: Request, writer, peer_ip: str) -> bool:
+        """路由单个请求，返回连接是否可继续复用"""
+        status = 200
+        try:
+            if request.path == "/metrics" and request.method == "GET":
+                body = self.metrics.render().encode("utf-8")
+                await send_body(writer, 200, body, "text/plain; version=0.0.4", request.keep_alive)
+            elif request.path == "/v1/models" and request.method == "GET":
+                self._check_auth(request)
+                await send_json(writer, 200, self._list_models(), request.keep_alive)
+            elif request.path == "/v1/chat/completions":
+                if request.method != "POST":
+                    raise HttpError(405, "仅支持 POST")
+                client_id = self._check_auth(request) or peer_ip
+                status = await self._chat_completions(request, writer, client_id)
+            else:
+                raise HttpError(404, f"未知路径: {request.path}")
+        except HttpError as e:
+            status = e.status
+            await send_json(writer, e.status, error_body(e.message), request.keep_alive)
+        except ConnectionError:
+            self.metrics.requests[(request.path, 499)] += 1
+            return False
+        except Exception as e:
+            logger.exception("网关内部错误: %s", e)
+            status = 500
+            await send_json(writer, 500, error_body(str(e), "server_error"), keep_alive=False)
+            self.metrics.requests[(request.path, status)] += 1
+            return False
+        self.metrics.requests[(request.path, status)] += 1
+        return request.keep_alive
+
+    def _check_auth(self, request: Request) -> str | None:
+        """校验 Bearer Token，返回 token (用作客户端标识)"""
+        auth = request.headers.get("authorization", "")
+        token = auth[7:].strip() if auth.lower().startswith("bearer ") else None
+        if self.token and token != self.token:
+            raise HttpError(401, "无效的 API Key")
+        return token or None
+
+    def _list_models(self) -> dict:
+        created = int(self.metrics.started_at)
+        models = [
+            {"id": model, "object": "model", "created": created, "owned_by": "zhipu"}
+            for model in ZHIPU_MODELS
+        ] + [
+            {"id": model, "object": "model", "created": created, "owned_by": "google"}
+            for model in GEMINI_MODELS
+        ]
+        return {"object": "list", "data": models}
+
+    # ---------- Chat Completions ----------
+
+    @staticmethod
+    def _parse_messages(messages) -> tuple[list, str]:
+        """OpenAI messages -> (历史 (role, text), 本轮问题)"""
+        if not isinstance(messages, list) or not messages:
+            raise HttpError(400, "messages 不能为空")
+
+        def text_of(message) -> str:
+            content = message.get("content") or ""
+            if isinstance(content, list):  # 多段内容只取文本
+                content = "".join(p.get("text", "") for p in content if isinstance(p, dict))
+            return str(content)
+
+        system_parts = []
+        history = []
+        for message in messages[:-1]:
+            role = message.get("role")
+            if role == "system":
+                system_parts.append(text_of(message))
+            elif role in ("user", "assistant"):
+                history.append((role, text_of(message)))
+        last = messages[-1]
+        if last.get("role") != "user":
+            raise HttpError(400, "最后一条消息必须是 user")
+        prompt = text_of(last)
+        # 客户端的 system 提示附加在本轮问题前 (服务层已注入人格)
+        if system_parts:
+            prompt = "\n\n".join(system_parts + [prompt])
+        return history, prompt
+
+    async def _open_stream(self, candidates: list[str], history: list, prompt: str) -> tuple[UpstreamStream, str | None]:
+        """启动上游流并等到首个 chunk；首字前失败则切换到下一个候选 (路由器排序)"""
+        loop = asyncio.get_running_loop()
+        last_error: Exception | None = None
+        for index, candidate in enumerate(candidates):
+            stream = UpstreamStream(candidate, history, prompt)
+            stream.start(loop, self._executor)
+            kind, value = await stream.next()
+            if kind == "chunk":
+                return stream, value
+            if kind == "end":
+                return stream, None
+            last_error = value
+            self.metrics.completions[(candidate, "error")] += 1
+            if index + 1 < len(candidates):
+                self.metrics.failovers += 1
+                logger.warning("上游失败，切换候选: %s -> %s (%s)", candidate, candidates[index + 1], value)
+        raise HttpError(502, f"上游服务均不可用: {last_error}")
+
+    async def _chat_completions(self, request: Request, writer, client_id: str) -> int:
+        data = request.json()
+        # 指定的模型作为首选，由路由器按健康度 / 延迟 / 额度 / 成本选择 (未指定时按主服务)
+        decision = router.choose(data.get("model") or None)
+        self.metrics.routes[(decision.preferred, decision.model, decision.reason)] += 1
+        history, prompt = self._parse_messages(data.get("messages"))
+        streaming = bool(data.get("stream"))
+
+        slot = self._client_slots.setdefault(client_id, asyncio.Semaphore(self.client_concurrency))
+        async with slot:
+            started = time.perf_counter()
+            stream, first = await self._open_stream(decision.candidates[:2], history, prompt)
+            self.metrics.ttft_ms_sum += (time.perf_counter() - started) * 1000
+            self.metrics.ttft_count += 1
+            self.metrics.active_streams += 1
+            try:
+                if streaming:
+                    outcome = await self._relay_sse(stream, first, request, writer)
+                else:
+                    outcome = await self._relay_full(stream, first, request, writer)
+            except ConnectionError:
+                # 客户端断开：关闭上游流，连接归还连接池
+                stream.cancel.cancel()
+                self.metrics.completions[(stream.model, "disconnected")] += 1
+                raise
+            finally:
+                self.metrics.active_streams -= 1
+
+        usage = stream.usage
+        self.metrics.tokens["input"] += usage.get("input_tokens", 0)
+        self.metrics.tokens["output"] += usage.get("output_tokens", 0)
+        self.metrics.completions[(stream.model, outcome)] += 1
+        return 200
+
+    @staticmethod
+    def _usage_body(stream: UpstreamStream) -> dict:
+        usage = stream.usage
+        prompt_tokens = usage.get("input_tokens", 0)
+        completion_tokens = usage.get("output_tokens", 0)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def _relay_sse(self, stream: UpstreamStream, first: str | None, request: Request, writer) -> str:
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        out = ChunkedWriter(writer)
+        await out.start(request.keep_alive)
+
+        def event(delta: dict, finish_reason=None, **extra) -> str:
+            return json.dumps({
+                "id": completion_id, "object": "chat.completion.chunk", "created": created,
+                "model": stream.model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }, ensure_ascii=False)
+
+        await out.send_event(event({"role": "assistant", "content": ""}))
+        outcome = "ok"
+        if first is not None:
+            await out.send_event(event({"content": first}))
+            while True:
+                kind, value = await stream.next()
+                if kind == "chunk":
+                    await out.send_event(event({"content": value}))
+                    continue
+                if kind == "error":
+                    # 已开始输出，无法再切换引擎：以错误事件结束
+                    outcome = "error"
+                    await out.send_event(json.dumps(error_body(str(value), "upstream_error"), ensure_ascii=False))
+                break
+        if outcome == "ok":
+            await out.send_event(event({}, "stop", usage=self._usage_body(stream)))
+        await out.send_event("[DONE]")
+        await out.finish()
+        return outcome
+
+    async def _relay_full(self, stream: UpstreamStream, first: str | None, request: Request, writer) -> str:
+        parts = [first] if first is not None else []
+        if first is not None:
+            while True:
+                kind, value = await stream.next()
+                if kind == "chunk":
+                    parts.append(value)
+                    continue
+                if kind == "error":
+                    raise HttpError(502, f"上游中断: {value}")
+                break
+        await send_json(writer, 200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": stream.model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(parts)},
+                "finish_reason": "stop",
+            }],
+            "usage": self._usage_body(stream),
+        }, request.keep_alive)
+        return "ok"
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def serve(host: str, port: int, gateway: Gateway) -> None:
+    server = await asyncio.start_server(gateway.handle_connection, host, port)
+    router.start_probes()
+    console.print(f"[bold green]🗡️ 网关已启动[/] http://{host}:{port}/v1  [dim](/metrics 查看指标)[/]")
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="六脉神剑本地 OpenAI 兼容网关")
+    parser.add_argument("--host", default=GATEWAY_HOST)
+    parser.add_argument("--port", type=int, default=GATEWAY_PORT)
+    parser.add_argument("--client-concurrency", type=int, default=GATEWAY_CLIENT_CONCURRENCY,
+                        help="每个客户端同时进行的请求数")
+    args = parser.parse_args(argv)
+
+    gateway = Gateway(client_concurrency=args.client_concurrency)
+    try:
+        asyncio.run(serve(args.host, args.port, gateway))
+    except KeyboardInterrupt:
+        console.print("\n[bold red]🛑 网关已关闭[/]")
+    finally:
+        gateway.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
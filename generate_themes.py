@@ -1,201 +1,202 @@
-import sys
+"""
+主题生成器 - 变量驱动
+- styles/themes.tcss: 只有一套规则，颜色全部引用 $ctp-* 设计变量
+- styles/flavors.json: 每个 Catppuccin 风味只是一张小的变量表
+运行时只加载当前风味的变量 (见 utils/theme_engine.py)
+"""
+import json
 import os
+import sys
 
 # Add the cloned repo to path
 sys.path.append(os.path.abspath("themes_cloned/catppuccin_python"))
 
 from catppuccin import PALETTE
 
+# 规则中用到的 Catppuccin 颜色 (变量名为 $ctp-<颜色>)
+COLORS = [
+    "base", "mantle", "crust", "text", "surface0", "surface2", "overlay0",
+    "mauve", "pink", "sky", "blue", "lavender", "green", "yellow", "red",
+]
+
 # Updated template for Container-based Chat Layout
-TEMPLATE = """/* === Catppuccin {flavor_name} === */
-.theme-{flavor_id} {{
-    background: {base};
-    color: {text};
+RULES = """/* Generated Catppuccin Theme - Cyberpunk Container Style */
+/* 颜色由 styles/flavors.json 中当前风味的变量提供 */
+
+/* === 全局 === */
+Screen {
+    background: $ctp-base;
+    color: $ctp-text;
     /* 优化滚动条: 更细、交互更明显 */
-    scrollbar-color: {surface2};
-    scrollbar-color-hover: {blue};
-    scrollbar-color-active: {lavender};
-    scrollbar-background: {base};
-    scrollbar-background-hover: {crust};
-    scrollbar-background-active: {crust};
-    scrollbar-corner-color: {crust};
+    scrollbar-color: $ctp-surface2;
+    scrollbar-color-hover: $ctp-blue;
+    scrollbar-color-active: $ctp-lavender;
+    scrollbar-background: $ctp-base;
+    scrollbar-background-hover: $ctp-crust;
+    scrollbar-background-active: $ctp-crust;
+    scrollbar-corner-color: $ctp-crust;
     scrollbar-size-vertical: 1;
     scrollbar-size-horizontal: 1;
-}}
+}
 
 /* Header Styling */
-.theme-{flavor_id} Header {{
-    background: {mantle};
-    color: {mauve};
-}}
+Header {
+    background: $ctp-mantle;
+    color: $ctp-mauve;
+}
 
-.theme-{flavor_id} HeaderTitle {{
-    color: {mauve};
-}}
+HeaderTitle {
+    color: $ctp-mauve;
+}
 
 /* Status Bar */
-.theme-{flavor_id} #status-bar {{
-    background: {mantle};
-    color: {text};
-    border-top: heavy {overlay0}; 
-}}
+#status-bar {
+    background: $ctp-mantle;
+    color: $ctp-text;
+    border-top: heavy $ctp-overlay0; 
+}
 
 /* Common Bubble Container */
-.theme-{flavor_id} .user-bubble-container, 
-.theme-{flavor_id} .ai-bubble-container, 
-.theme-{flavor_id} .system-bubble-container,
-.theme-{flavor_id} .input-container {{
+.user-bubble-container, 
+.ai-bubble-container, 
+.system-bubble-container,
+.input-container {
     margin: 1 2;
     padding: 0 0; 
-    border: heavy {overlay0}; 
+    border: heavy $ctp-overlay0; 
     background: transparent;
     height: auto;
     width: 100%; /* 恢复满宽，避免坍缩 */
-}}
+}
 
-.theme-{flavor_id} .bubble-content {{
+.bubble-content {
     height: auto;
     width: 100%;
     text-wrap: wrap; 
     overflow: hidden;
     padding: 0 1;
-}}
+}
 
 /* Bubble Headers */
-.theme-{flavor_id} .bubble-header {{
+.bubble-header {
     dock: top;
     width: 100%;
-    background: {surface0};
-    color: {text};
+    background: $ctp-surface0;
+    color: $ctp-text;
     padding: 0 1;
     margin-bottom: 1; /* 标题栏与内容间距 */
     text-style: bold;
-}}
+}
 
 /* Specific Styles per Role */
 
 /* User */
-.theme-{flavor_id} .user-bubble-container {{
-    border: heavy {pink};
-}}
-.theme-{flavor_id} .user-header {{
-    background: {pink};
-    color: {base}; /* Contrast text */
-}}
-.theme-{flavor_id} .user-bubble-container .bubble-content {{
-    color: {pink};
+.user-bubble-container {
+    border: heavy $ctp-pink;
+}
+.user-header {
+    background: $ctp-pink;
+    color: $ctp-base; /* Contrast text */
+}
+.user-bubble-container .bubble-content {
+    color: $ctp-pink;
     padding: 0 1;
-}}
+}
 
 /* AI */
-.theme-{flavor_id} .ai-bubble-container {{
-    border: heavy {cyan};
-}}
-.theme-{flavor_id} .ai-header {{
-    background: {cyan};
-    color: {base};
-}}
-.theme-{flavor_id} .ai-bubble-container .bubble-content {{
-    color: {cyan};
+.ai-bubble-container {
+    border: heavy $ctp-sky;
+}
+.ai-header {
+    background: $ctp-sky;
+    color: $ctp-base;
+}
+.ai-bubble-container .bubble-content {
+    color: $ctp-sky;
     padding: 0 1;
-}}
+}
 
 /* System */
-.theme-{flavor_id} .system-bubble-container {{
-    border: dashed {overlay0};
-}}
-.theme-{flavor_id} .system-header {{
-    background: {overlay0};
-    color: {base};
-}}
-.theme-{flavor_id} .system-bubble-container .bubble-content {{
-    color: {overlay0};
+.system-bubble-container {
+    border: dashed $ctp-overlay0;
+}
+.system-header {
+    background: $ctp-overlay0;
+    color: $ctp-base;
+}
+.system-bubble-container .bubble-content {
+    color: $ctp-overlay0;
     padding: 0 1;
-}}
+}
 
 /* ERROR */
-.theme-{flavor_id} .error-bubble {{
-    color: {red};
-}}
+.error-bubble {
+    color: $ctp-red;
+}
 
 
 /* Input Container */
-.theme-{flavor_id} .input-container {{
-    border: heavy {green};
-}}
-.theme-{flavor_id} .input-header {{
-    background: {green};
-    color: {base};
-}}
+.input-container {
+    border: heavy $ctp-green;
+}
+.input-header {
+    background: $ctp-green;
+    color: $ctp-base;
+}
 
 /* Inline Input Widget inside container */
-.theme-{flavor_id} .inline-input {{
+.inline-input {
     background: transparent;
     border: none;
-    color: {green};
+    color: $ctp-green;
     height: auto;
     min-height: 1; /* 默认一行，输入多了自动扩展 */
     padding: 0 0; /* TextArea 自带 padding */
-}}
-.theme-{flavor_id} .inline-input:focus {{
+}
+.inline-input:focus {
     background: transparent; 
-}}
+}
 
 /* TextArea 内部去黑底 */
-.theme-{flavor_id} .inline-input > .text-area--cursor-line {{
+.inline-input > .text-area--cursor-line {
     background: transparent;
-}}
-.theme-{flavor_id} .inline-input > .text-area--content {{
+}
+.inline-input > .text-area--content {
     background: transparent;
-}}
+}
 
 /* TextArea specific styling */
-.theme-{flavor_id} .inline-input .text-area--cursor {{
-    background: {green};
-    color: {base};
-}}
+.inline-input .text-area--cursor {
+    background: $ctp-green;
+    color: $ctp-base;
+}
 
 /* Reconnecting Animation specific */
-.theme-{flavor_id} .reconnecting {{
-    color: {yellow};
-}}
+.reconnecting {
+    color: $ctp-yellow;
+}
 """
 
+
 def generate():
     flavors = [PALETTE.latte, PALETTE.frappe, PALETTE.macchiato, PALETTE.mocha]
-    
-    full_content = "/* Generated Catppuccin Themes - Cyberpunk Container Style */\n\n"
-    
+
+    with open("styles/themes.tcss", "w", encoding="utf-8") as f:
+        f.write(RULES)
+    print("Generated styles/themes.tcss")
+
+    variables = {}
     for flavor in flavors:
         c = flavor.colors
-        content = TEMPLATE.format(
-            flavor_name=flavor.name,
-            flavor_id=flavor.identifier,
-            base=c.base.hex,
-            mantle=c.mantle.hex,
-            text=c.text.hex,
-            overlay0=c.overlay0.hex,
-            mauve=c.mauve.hex,
-            pink=c.pink.hex,
-            sky=c.sky.hex,
-            green=c.green.hex,
-            peach=c.peach.hex,
-            red=c.red.hex,
-            yellow=c.yellow.hex,
-            teal=c.teal.hex,
-            surface0=c.surface0.hex,
-            cyan=c.sky.hex,
-            blue=c.blue.hex,
-            lavender=c.lavender.hex,
-            surface2=c.surface2.hex,
-            crust=c.crust.hex,
-        )
-        full_content += content + "\n"
-        
-    filename = "styles/all_themes.tcss"
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(full_content)
-    print(f"Generated {filename}")
+        variables[flavor.identifier] = {
+            "name": flavor.name,
+            "variables": {f"ctp-{color}": getattr(c, color).hex for color in COLORS},
+        }
+    with open("styles/flavors.json", "w", encoding="utf-8") as f:
+        json.dump(variables, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+    print("Generated styles/flavors.json")
+
 
 if __name__ == "__main__":
     generate()
@@ -0,0 +1,224 @@
+"""
+本地 Gemini 替身 - 不消耗真实额度地验证上下文缓存、重试与用量统计
+
+    python mock_gemini.py [--port 8766] [--min-tokens 1024] [--delay 0.05]
+    # 另一个终端:
+    GEMINI_BASE_URL=http://127.0.0.1:8766 GEMINI_API_KEY=test PRIMARY_SERVICE=gemini python app.py
+    # 本机地址 (127.0.0.1 / localhost) 自动加入 NO_PROXY，不经过 PROXY_URL
+
+实现 SDK 用到的接口子集:
+    POST   /v1beta/models/{model}:streamGenerateContent?alt=sse
+    POST   /v1beta/cachedContents
+    PATCH  /v1beta/cachedContents/{id}
+    DELETE /v1beta/cachedContents/{id}
+    GET    /stats                         (缓存与请求计数)
+
+- token 按 0.7 token/char 估算；引用缓存时 usageMetadata 带 cachedContentTokenCount
+- 缓存按 TTL 过期，过期 / 不存在时返回 404 (服务层应回退为完整发送)
+- 低于 --min-tokens 的缓存创建请求返回 400 (与真实服务的最小长度限制一致)
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rich.console import Console
+
+console = Console(stderr=True)
+
+TOKENS_PER_CHAR = 0.7
+
+
+def _tokens(text: str) -> int:
+    return max(1, int(len(text) * TOKENS_PER_CHAR))
+
+
+def _text_of(contents: list[dict] | None) -> str:
+    return "".join(
+        part.get("text", "") for content in contents or [] for part in content.get("parts", [])
+    )
+
+
+def _rfc3339(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class MockState:
+    """替身服务的内存状态"""
+
+    def __init__(self, min_tokens: int, delay: float):
+        self.min_tokens = min_tokens
+        self.delay = delay
+        self.caches: dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "cached_requests": 0, "cache_creates": 0,
+                      "cache_updates": 0, "cache_deletes": 0, "cache_misses": 0}
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.stats[key] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    state: MockState = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    # ============== 工具 ==============
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _json(self, status: int, data: dict) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: int, reason: str, message: str) -> None:
+        self._json(status, {"error": {"code": status, "message": message, "status": reason}})
+
+    def _path(self) -> str:
+        return self.path.split("?", 1)[0]
+
+    # ============== 路由 ==============
+
+    def do_GET(self):
+        if self._path() == "/stats":
+            with self.state.lock:
+                self._json(200, {**self.state.stats, "live_caches": len(self.state.caches)})
+            return
+        self._error(404, "NOT_FOUND", self.path)
+
+    def do_POST(self):
+        path = self._path()
+        if path.endswith(":streamGenerateContent"):
+            self._generate(path.rsplit("/", 1)[-1].split(":")[0])
+        elif path.endswith("/cachedContents"):
+            self._create_cache()
+        else:
+            self._error(404, "NOT_FOUND", path)
+
+    def do_PATCH(self):
+        name = self._path().split("/v1beta/", 1)[-1]
+        body = self._body()
+        with self.state.lock:
+            cache = self.state.caches.get(name)
+            if cache is None or cache["expire_at"] <= time.time():
+                self._error(404, "NOT_FOUND", f"CachedContent not found: {name}")
+                return
+            cache["expire_at"] = time.time() + float(body.get("ttl", "600s").rstrip("s"))
+            self.state.stats["cache_updates"] += 1
+            self._json(200, self._cache_json(name, cache))
+
+    def do_DELETE(self):
+        name = self._path().split("/v1beta/", 1)[-1]
+        with self.state.lock:
+            self.state.caches.pop(name, None)
+            self.state.stats["cache_deletes"] += 1
+        self._json(200, {})
+
+    # ============== 缓存 ==============
+
+    @staticmethod
+    def _cache_json(name: str, cache: dict) -> dict:
+        return {
+            "name": name, "model": cache["model"], "displayName": cache["display_name"],
+            "expireTime": _rfc3339(cache["expire_at"]),
+            "usageMetadata": {"totalTokenCount": cache["tokens"]},
+        }
+
+    def _create_cache(self) -> None:
+        body = self._body()
+        system = _text_of([body["systemInstruction"]]) if body.get("systemInstruction") else ""
+        tokens = _tokens(system + _text_of(body.get("contents")))
+        if tokens < self.state.min_tokens:
+            self._error(400, "INVALID_ARGUMENT",
+                        f"Cached content is too small. total_token_count={tokens}, min_total_token_count={self.state.min_tokens}")
+            return
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        cache = {
+            "model": body.get("model", ""), "display_name": body.get("displayName", ""),
+            "expire_at": time.time() + float(body.get("ttl", "600s").rstrip("s")), "tokens": tokens,
+        }
+        with self.state.lock:
+            self.state.caches[name] = cache
+            self.state.stats["cache_creates"] += 1
+        console.print(f"[green]+ 缓存[/] {name} {tokens} tokens")
+        self._json(200, self._cache_json(name, cache))
+
+    # ============== 生成 ==============
+
+    def _generate(self, model: str) -> None:
+        body = self._body()
+        self.state.count("requests")
+        cached_tokens = 0
+        name = body.get("cachedContent")
+        if name:
+            with self.state.lock:
+                cache = self.state.caches.get(name)
+                alive = cache is not None and cache["expire_at"] > time.time()
+            if not alive:
+                self.state.count("cache_misses")
+                self._error(404, "NOT_FOUND", f"CachedContent not found (or expired): {name}")
+                return
+            self.state.count("cached_requests")
+            cached_tokens = cache["tokens"]
+        system = _text_of([body["systemInstruction"]]) if body.get("systemInstruction") else ""
+        contents = body.get("contents") or []
+        prompt_tokens = cached_tokens + _tokens(system + _text_of(contents))
+        question = _text_of(contents[-1:])
+        reply = f"[{model}] 收到: {question}\n\n前文 {len(contents) - 1} 条 | 缓存 {cached_tokens} tokens"
+        console.print(f"→ {model} 消息 {len(contents)} 条 | 缓存 {cached_tokens} | 输入 {prompt_tokens}")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        pieces = [reply[i:i + 8] for i in range(0, len(reply), 8)]
+        for i, piece in enumerate(pieces):
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": piece}]}}]}
+            if i == len(pieces) - 1:
+                chunk["candidates"][0]["finishReason"] = "STOP"
+                chunk["usageMetadata"] = {
+                    "promptTokenCount": prompt_tokens,
+                    "cachedContentTokenCount": cached_tokens,
+                    "candidatesTokenCount": _tokens(reply),
+                    "totalTokenCount": prompt_tokens + _tokens(reply),
+                }
+            try:
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return  # 客户端中断
+            time.sleep(self.state.delay)
+        self.close_connection = True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地 Gemini 替身 (上下文缓存测试)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--min-tokens", type=int, default=1024, help="缓存最小 token 数 (默认 1024)")
+    parser.add_argument("--delay", type=float, default=0.05, help="每个 chunk 的间隔秒数")
+    args = parser.parse_args()
+
+    Handler.state = MockState(args.min_tokens, args.delay)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    console.print(f"🧪 Gemini 替身: http://{args.host}:{args.port}  (GEMINI_BASE_URL 指向此地址)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,10 @@
 """Services package"""
 from .gemini_service import GeminiService
+from .zhipu_service import ZhipuService
+from .session import ChatSession, MessageRecord, StreamLimiter
+from .compare import CompareRun, CompareResult
 
-__all__ = ["GeminiService"]
+__all__ = [
+    "GeminiService", "ZhipuService", "ChatSession", "MessageRecord", "StreamLimiter",
+    "CompareRun", "CompareResult",
+]
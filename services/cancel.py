@@ -0,0 +1,86 @@
+"""
+协作式取消 - 中断进行中的生成
+- UI 线程调用 cancel()，立即执行已登记的关闭回调 (如关闭 HTTP 流，连接归还连接池)
+- 服务层在 chunk 之间检查 cancelled，保留已生成的部分并提交历史
+"""
+import threading
+from typing import Callable
+
+from utils.logger import get_logger
+
+logger = get_logger("cancel")
+
+# 写入对话历史的截断标记，让模型知道上一条回答不完整
+TRUNCATED_MARK = "\n\n[回答被用户中断]"
+
+
+class StreamCancelled(Exception):
+    """请求在开始前 (排队时) 被取消"""
+
+
+class CancelToken:
+    """单次生成的取消令牌 (跨线程)"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._closers: list[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        """请求取消，并立即执行关闭回调 (重复调用无副作用)"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            closers, self._closers = self._closers, []
+        for closer in closers:
+            try:
+                closer()
+            except Exception as e:
+                logger.debug("取消回调失败: %s", e)
+
+    def on_cancel(self, closer: Callable[[], None]) -> None:
+        """登记关闭回调；已取消时立即执行"""
+        with self._lock:
+            if not self._event.is_set():
+                self._closers.append(closer)
+                return
+        closer()
+
+    def clear_callbacks(self) -> None:
+        """请求结束后清理回调 (避免关闭已复用的连接)"""
+        with self._lock:
+            self._closers.clear()
+
+    def wait(self, timeout: float) -> bool:
+        """等待取消，返回是否已取消"""
+        return self._event.wait(timeout)
+
+
+# ============== 节省用量估算 ==============
+
+# 没有历史样本时假定的单轮输出长度 (tokens)
+TYPICAL_OUTPUT_TOKENS = 500
+# 指数滑动平均系数
+_EWMA_ALPHA = 0.2
+
+
+class AvoidedTokenEstimator:
+    """按模型记录完整回答的平均输出长度，估算中断省下的 token"""
+
+    def __init__(self):
+        self._avg: dict[str, float] = {}
+
+    def observe(self, model: str, output_tokens: int) -> None:
+        """记录一次完整回答的输出长度"""
+        avg = self._avg.get(model)
+        self._avg[model] = output_tokens if avg is None else avg + _EWMA_ALPHA * (output_tokens - avg)
+
+    def estimate(self, model: str, produced_tokens: int) -> int:
+        """中断时已输出 produced_tokens，估算还剩多少没有生成"""
+        expected = self._avg.get(model, TYPICAL_OUTPUT_TOKENS)
+        return max(0, round(expected - produced_tokens))
@@ -0,0 +1,185 @@
+"""
+多模型对比 (/compare)
+- 同一问题 + 同一上下文并发发给多个模型，各自独立的服务实例，不污染会话历史
+- 整次对比只占一个全局并发名额，其中各模型同时请求 (计时互不排队)
+- 记录 TTFT / 总耗时 / 生成速度 / token 用量
+- 结果追加写入 data/compare_results.jsonl，供 /compare stats 汇总选型
+"""
+import hashlib
+import json
+import statistics
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+
+from config.settings import ENABLE_WEB_SEARCH, ZHIPU_MODELS
+from utils.logger import get_logger
+from .gemini_service import GeminiService
+from .router import provider_of
+from .zhipu_service import ZhipuService
+
+logger = get_logger("compare")
+
+RESULTS_FILE = Path(__file__).parent.parent / "data" / "compare_results.jsonl"
+
+# 结果文件写入锁 (多个模型线程同时完成)
+_write_lock = threading.Lock()
+
+
+@dataclass
+class CompareResult:
+    """单个模型的一次对比结果 (流式过程中实时更新)"""
+    model: str
+    content: str = ""
+    state: str = "pending"          # pending / streaming / done / error
+    error: str = ""
+    ttft_ms: float | None = None
+    total_ms: float | None = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    estimated: bool = True          # 用量是否为估算值
+
+    @property
+    def tokens_per_s(self) -> float | None:
+        """生成速度 (首字之后的输出 token / 秒)"""
+        if self.total_ms is None or self.ttft_ms is None or not self.output_tokens:
+            return None
+        gen_ms = self.total_ms - self.ttft_ms
+        return self.output_tokens / (gen_ms / 1000) if gen_ms > 0 else None
+
+
+@dataclass
+class CompareRun:
+    """一次 /compare 的全部结果"""
+    prompt: str
+    history: list
+    results: list[CompareResult] = field(default_factory=list)
+    started_at: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return all(r.state in ("done", "error") for r in self.results)
+
+
+def build_service(model: str, history: list):
+    """为单个模型创建独立服务实例，并载入会话上下文"""
+    if provider_of(model) == "zhipu":
+        service = ZhipuService(enable_web_search=ENABLE_WEB_SEARCH)
+    else:
+        service = GeminiService()
+    service.set_history(history)
+    return service
+
+
+def run_model(run: CompareRun, result: CompareResult) -> None:
+    """在当前线程流式请求一个模型，实时写入 result (供 Worker 线程调用)"""
+    service = build_service(result.model, run.history)
+    result.state = "streaming"
+    started = time.perf_counter()
+    try:
+        for chunk in service.stream_chat_sync(run.prompt, result.model):
+            # 控制信号不计入内容
+            if chunk.startswith("__RECONNECTING__:") or chunk.startswith("__TOKEN_STATS__:"):
+                continue
+            if result.ttft_ms is None:
+                result.ttft_ms = (time.perf_counter() - started) * 1000
+            result.content += chunk
+        result.total_ms = (time.perf_counter() - started) * 1000
+        usage = service.last_usage or {}
+        result.input_tokens = usage.get("input_tokens", 0)
+        result.output_tokens = usage.get("output_tokens", 0)
+        result.estimated = usage.get("estimated", True)
+        result.state = "done"
+    except Exception as e:
+        result.total_ms = (time.perf_counter() - started) * 1000
+        result.error = str(e)
+        result.state = "error"
+    save_result(run, result)
+
+
+def run_models(run: CompareRun, on_result=None) -> None:
+    """所有模型各开一个线程同时请求，全部完成后返回；on_result(result) 在各自线程中回调"""
+    def target(result: CompareResult) -> None:
+        run_model(run, result)
+        if on_result is not None:
+            on_result(result)
+
+    threads = [
+        threading.Thread(target=target, args=(result,), name=f"compare-{result.model}", daemon=True)
+        for result in run.results
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# ============== 结果持久化 ==============
+
+def save_result(run: CompareRun, result: CompareResult) -> None:
+    """追加一条精简结果 (不含回答正文)"""
+    tps = result.tokens_per_s
+    row = {
+        "ts": round(run.started_at, 3),
+        "prompt_sha1": hashlib.sha1(run.prompt.encode("utf-8")).hexdigest()[:12],
+        "prompt_chars": len(run.prompt),
+        "context_turns": len(run.history) // 2,
+        "model": result.model,
+        "ok": result.state == "done",
+        "ttft_ms": round(result.ttft_ms, 1) if result.ttft_ms is not None else None,
+        "total_ms": round(result.total_ms, 1) if result.total_ms is not None else None,
+        "input_tokens": result.input_tokens,
+        "output_tokens": result.output_tokens,
+        "estimated": result.estimated,
+        "tokens_per_s": round(tps, 1) if tps else None,
+    }
+    if result.error:
+        row["error"] = result.error[:200]
+    try:
+        RESULTS_FILE.parent.mkdir(exist_ok=True)
+        with _write_lock, open(RESULTS_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.warning("对比结果写入失败: %s", e)
+
+
+def load_results() -> list[dict]:
+    """读取历史对比结果 (跳过损坏的行)"""
+    if not RESULTS_FILE.exists():
+        return []
+    rows = []
+    with open(RESULTS_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return rows
+
+
+def summarize(rows: list[dict]) -> list[dict]:
+    """按模型汇总：成功率、TTFT / 总耗时中位数、平均生成速度与用量"""
+    by_model: dict[str, list[dict]] = {}
+    for row in rows:
+        by_model.setdefault(row["model"], []).append(row)
+
+    summary = []
+    for model, items in by_model.items():
+        ok = [r for r in items if r.get("ok")]
+        ttft = [r["ttft_ms"] for r in ok if r.get("ttft_ms") is not None]
+        total = [r["total_ms"] for r in ok if r.get("total_ms") is not None]
+        tps = [r["tokens_per_s"] for r in ok if r.get("tokens_per_s")]
+        summary.append({
+            "model": model,
+            "runs": len(items),
+            "ok_rate": len(ok) / len(items),
+            "ttft_p50": statistics.median(ttft) if ttft else None,
+            "total_p50": statistics.median(total) if total else None,
+            "tokens_per_s": statistics.fmean(tps) if tps else None,
+            "output_tokens": statistics.fmean([r["output_tokens"] for r in ok]) if ok else None,
+            "tier": ZHIPU_MODELS.get(model, {}).get("type", "gemini"),
+        })
+    # 首字延迟低的排前面，没有成功记录的排最后
+    summary.sort(key=lambda s: (s["ttft_p50"] is None, s["ttft_p50"] or 0))
+    return summary
@@ -0,0 +1,332 @@
+"""
+Gemini 上下文缓存 - 系统指令 + 稳定的历史前缀放进服务端缓存 (CachedContent)
+- 前缀 = 系统指令 + 按 GEMINI_CACHE_STEP 轮对齐的较早历史，每轮请求只发送其后的新增部分
+- 按 (Key, 模型, 前缀哈希) 索引：跨轮次、跨会话复用；临近过期时续期 (TTL)
+- 会话的前缀变化 (撤销 / 切换分支 / 历史滑出窗口) 时释放旧缓存，无人使用即删除
+- 网关 / 批处理等每次请求新建的服务实例回收后自动解除登记，其缓存留到过期供同前缀请求复用
+- 低于服务端最小长度的前缀不创建；创建失败的前缀一段时间内不再尝试
+- 统计缓存命中的输入 token 与新发送的输入 token
+"""
+import hashlib
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+
+from config.settings import (
+    GEMINI_CACHE_ENABLED, GEMINI_CACHE_TTL, GEMINI_CACHE_MIN_TOKENS, GEMINI_CACHE_STEP,
+)
+from utils.logger import get_logger
+from utils.tracing import tracer
+
+logger = get_logger("context_cache")
+
+# 剩余寿命低于 TTL 的该比例时续期
+REFRESH_RATIO = 0.2
+# 创建失败的前缀多久内不再尝试 (秒)
+REJECT_SECONDS = 300
+# token 估算：中英文混合约 0.7 token/char (与服务层一致)
+TOKENS_PER_CHAR = 0.7
+
+
+@dataclass
+class CacheEntry:
+    """一份服务端缓存"""
+    name: str               # cachedContents/xxx
+    client: object          # 创建它的客户端 (缓存只对该 Key 可见)
+    expire_at: float        # time.time() 时间戳
+    tokens: int             # 缓存的 token 数 (服务端未返回时为估算)
+    owners: set[int] = field(default_factory=set)  # 当前使用它的服务实例 (登记序号)
+    uses: int = 0
+    refreshing: bool = False  # 正在续期 (避免并发请求重复续期)
+
+
+@dataclass
+class CachePlan:
+    """一次请求的缓存安排"""
+    name: str | None = None  # cached_content (None = 不使用缓存)
+    cached: int = 0          # 缓存覆盖的历史条数 (请求只发送其后的部分)
+
+
+class ContextCache:
+    """进程内的缓存登记表 (所有会话共享)"""
+
+    def __init__(
+        self, ttl: int = GEMINI_CACHE_TTL, min_tokens: int = GEMINI_CACHE_MIN_TOKENS,
+        step: int = GEMINI_CACHE_STEP, enabled: bool = GEMINI_CACHE_ENABLED,
+    ):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.step = max(1, step)
+        self.enabled = enabled
+        self._entries: dict[tuple[int, str, str], CacheEntry] = {}
+        self._owners: dict[int, tuple[int, str, str]] = {}
+        # 服务实例 -> 登记序号 (不用 id()：实例回收后 id 会被新实例复用)
+        self._tokens: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._next_token = 0
+        # 已被回收、尚未释放缓存的实例序号 (网关 / 批处理 / 对比 / 探测每次请求新建的实例)
+        self._dead: list[int] = []
+        self._rejected: dict[tuple[int, str, str], float] = {}
+        # 正在创建的前缀 (远程调用不持锁；期间同一前缀的其他请求不等待，本次不用缓存)
+        self._pending: set[tuple[int, str, str]] = set()
+        self._lock = threading.Lock()
+        # 统计
+        self.created = 0
+        self.reused = 0
+        self.refreshed = 0
+        self.deleted = 0
+        self.failures = 0
+        self.cached_tokens = 0   # 命中缓存的输入 token (服务端返回)
+        self.fresh_tokens = 0    # 实际新发送的输入 token
+
+    # ============== 前缀 ==============
+
+    def prefix_length(self, history: list[dict]) -> int:
+        """可缓存的历史条数：按 step 轮对齐，前缀在 step 轮内保持不变"""
+        turns = len(history) // 2
+        return turns // self.step * self.step * 2
+
+    def trim(self, history: list, limit: int) -> list:
+        """
+        历史窗口 (最多 limit 条)：启用缓存时达到上限就整块丢弃最早的 step 轮
+        逐轮滑动会让前缀每轮都变 (每轮都要重新创建缓存)；整块丢弃后前缀仍每 step 轮才变一次
+        """
+        cap = limit // 2 // self.step * self.step   # 不超过上限的最大 step 整数倍轮数
+        if not self.enabled or cap <= self.step:
+            return history[-limit:] if len(history) > limit else history
+        if len(history) // 2 < cap:
+            return history
+        return history[-(cap - self.step) * 2:]
+
+    @staticmethod
+    def _digest(model: str, system_instruction: str, prefix: list[dict]) -> str:
+        h = hashlib.sha1()
+        for part in (model, system_instruction, *(f"{m['role']}:{m['content']}" for m in prefix)):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _prefix(self, model: str, system_instruction: str, history: list[dict]) -> tuple[int, str] | None:
+        """(前缀条数, 前缀哈希)；估算长度不足服务端下限时返回 None"""
+        n = self.prefix_length(history)
+        chars = len(system_instruction) + sum(len(m["content"]) for m in history[:n])
+        if chars * TOKENS_PER_CHAR < self.min_tokens:
+            return None
+        return n, self._digest(model, system_instruction, history[:n])
+
+    # ============== 获取 / 释放 ==============
+
+    def preferred_key(self, model: str, system_instruction: str, history: list[dict]) -> int | None:
+        """已有该前缀缓存的 Key 序号 (请求固定走这个 Key 才能复用)"""
+        if not self.enabled:
+            return None
+        prefix = self._prefix(model, system_instruction, history)
+        if prefix is None:
+            return None
+        now = time.time()
+        with self._lock:
+            for (key_index, entry_model, digest), entry in self._entries.items():
+                if entry_model == model and digest == prefix[1] and entry.expire_at > now + 1:
+                    return key_index
+        return None
+
+    def acquire(
+        self, client, key_index: int, model: str, system_instruction: str,
+        history: list[dict], owner: object,
+    ) -> CachePlan:
+        """为一次请求取得 (必要时创建 / 续期) 前缀缓存"""
+        if not self.enabled:
+            return CachePlan()
+        prefix = self._prefix(model, system_instruction, history)
+        if prefix is None:
+            self.release(owner)
+            return CachePlan()
+        n, digest = prefix
+        key = (key_index, model, digest)
+        refresh = create = False
+        with self._lock:
+            now = time.time()
+            self._reap()
+            stale: list[CacheEntry] = []
+            if self._rejected.get(key, 0) > now or key in self._pending:
+                entry = None
+            else:
+                self._prune(now)
+                entry = self._entries.get(key)
+                if entry is None:
+                    self._pending.add(key)
+                    create = True
+                else:
+                    self.reused += 1
+                    if entry.expire_at - now < self.ttl * REFRESH_RATIO and not entry.refreshing:
+                        entry.refreshing = refresh = True
+                    entry.uses += 1
+                    stale += self._assign(owner, key)
+        if create:
+            # 远程创建不持锁：慢请求不阻塞其他会话 / 网关 / 批处理的请求
+            entry = self._create(client, key, system_instruction, history[:n])
+            with self._lock:
+                self._pending.discard(key)
+                if entry is None:
+                    self.failures += 1
+                    self._rejected[key] = time.time() + REJECT_SECONDS
+                else:
+                    self._entries[key] = entry
+                    self.created += 1
+                    entry.uses += 1
+                    stale += self._assign(owner, key)
+        elif refresh:
+            self._refresh(entry)
+        self._delete_remote(stale)
+        return CachePlan(entry.name, n) if entry is not None else CachePlan()
+
+    def release(self, owner: object) -> None:
+        """服务实例不再使用其缓存 (清空历史 / 前缀过短)"""
+        with self._lock:
+            self._reap()
+            token = self._tokens.get(owner)
+            stale = self._assign_token(token, None) if token is not None else []
+        self._delete_remote(stale)
+
+    def invalidate(self, name: str) -> None:
+        """请求使用缓存失败 (过期 / 已被删除)：丢弃登记，下次重新创建"""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.name == name:
+                    del self._entries[key]
+                    for owner, owned in list(self._owners.items()):
+                        if owned == key:
+                            del self._owners[owner]
+        logger.info("上下文缓存失效: %s", name)
+
+    def record_usage(self, usage) -> None:
+        """累计服务端返回的缓存命中 / 新发送输入 token"""
+        prompt = getattr(usage, "prompt_token_count", None) or 0
+        cached = getattr(usage, "cached_content_token_count", None) or 0
+        with self._lock:
+            self.cached_tokens += cached
+            self.fresh_tokens += max(0, prompt - cached)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.cached_tokens + self.fresh_tokens
+        return self.cached_tokens / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # ============== 内部 ==============
+
+    def _assign(self, owner: object, key: tuple) -> list[CacheEntry]:
+        """记录服务实例当前使用的缓存，返回已无人使用、需要删除的旧缓存 (持锁调用)"""
+        token = self._tokens.get(owner)
+        if token is None:
+            self._next_token += 1
+            token = self._tokens[owner] = self._next_token
+            # 实例被回收时只记下序号 (回收可能发生在任意线程、任意时刻，不能在这里取锁)
+            weakref.finalize(owner, self._dead.append, token)
+        return self._assign_token(token, key)
+
+    def _reap(self) -> None:
+        """
+        解除已回收实例的登记 (持锁调用)
+        不删除远程缓存：一次性实例用完即回收，其缓存留到过期，供下一个同前缀的请求复用
+        """
+        while self._dead:
+            self._assign_token(self._dead.pop(), None, drop_unused=False)
+
+    def _assign_token(self, owner_id: int, key: tuple | None, drop_unused: bool = True) -> list[CacheEntry]:
+        """按登记序号记录 / 清除 (key 为 None) 实例使用的缓存 (持锁调用)"""
+        old = self._owners.get(owner_id)
+        if old == key:
+            return []
+        if key is None:
+            self._owners.pop(owner_id, None)
+        else:
+            self._owners[owner_id] = key
+            self._entries[key].owners.add(owner_id)
+        entry = self._entries.get(old) if old is not None else None
+        if entry is None:
+            return []
+        entry.owners.discard(owner_id)
+        if entry.owners or not drop_unused:
+            return []
+        del self._entries[old]
+        return [entry]
+
+    def _prune(self, now: float) -> None:
+        """移除已过期的登记 (服务端会自行删除；持锁调用)"""
+        expired = [key for key, entry in self._entries.items() if entry.expire_at <= now + 1]
+        for key in expired:
+            del self._entries[key]
+        for owner, key in list(self._owners.items()):
+            if key not in self._entries:
+                del self._owners[owner]
+        for key, until in list(self._rejected.items()):
+            if until <= now:
+                del self._rejected[key]
+
+    def _create(self, client, key: tuple, system_instruction: str, prefix: list[dict]) -> CacheEntry | None:
+        """远程创建缓存 (不持锁；登记由调用方完成)"""
+        from google.genai import types
+
+        contents = [
+            types.Content(role=m["role"], parts=[types.Part(text=m["content"])]) for m in prefix
+        ]
+        try:
+            with tracer.span("cache.create", turns=len(prefix) // 2):
+                cached = client.caches.create(
+                    model=key[1],
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_instruction,
+                        contents=contents or None,
+                        ttl=f"{self.ttl}s",
+                        display_name="chatbot-prefix",
+                    ),
+                )
+        except Exception as e:
+            # 常见原因：前缀低于模型的最小缓存长度、模型不支持缓存
+            logger.warning("创建上下文缓存失败 (%d 轮前缀): %s", len(prefix) // 2, e)
+            return None
+        usage = getattr(cached, "usage_metadata", None)
+        tokens = getattr(usage, "total_token_count", None) or int(
+            (len(system_instruction) + sum(len(m["content"]) for m in prefix)) * TOKENS_PER_CHAR
+        )
+        entry = CacheEntry(cached.name, client, self._expire_at(cached), tokens)
+        logger.info("已创建上下文缓存 %s: %d 轮前缀, %d tokens", cached.name, len(prefix) // 2, tokens)
+        return entry
+
+    def _refresh(self, entry: CacheEntry) -> None:
+        """远程续期 (不持锁)"""
+        from google.genai import types
+
+        try:
+            with tracer.span("cache.refresh"):
+                cached = entry.client.caches.update(
+                    name=entry.name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl}s"),
+                )
+        except Exception as e:
+            logger.warning("上下文缓存续期失败 %s: %s", entry.name, e)
+            return
+        finally:
+            entry.refreshing = False
+        with self._lock:
+            entry.expire_at = self._expire_at(cached)
+            self.refreshed += 1
+
+    def _expire_at(self, cached) -> float:
+        expire_time = getattr(cached, "expire_time", None)
+        return expire_time.timestamp() if expire_time is not None else time.time() + self.ttl
+
+    def _delete_remote(self, entries: list[CacheEntry]) -> None:
+        """删除无人使用的缓存 (不持锁；失败无妨，到期后服务端自行删除)"""
+        for entry in entries:
+            try:
+                entry.client.caches.delete(name=entry.name)
+                self.deleted += 1
+            except Exception as e:
+                logger.debug("删除上下文缓存失败 %s: %s", entry.name, e)
+
+
+# 全局单例
+context_cache = ContextCache()
@@ -2,9 +2,18 @@
 Gemini 异步 API 服务层
 封装 ClientPool，提供同步/异步流式接口
 """
-from core.client import get_client, rotate_api_key
-from config.settings import SYSTEM_INSTRUCTION
-from utils.logger import get_logger
+import itertools
+import time
+
+from core.client import get_client
+from config.settings import SYSTEM_INSTRUCTION, STREAM_MAX_ATTEMPTS
+from utils.logger import get_logger, request_scoped
+from utils.tracing import tracer
+from .cancel import CancelToken, TRUNCATED_MARK
+from .context_cache import CachePlan, context_cache
+from .quota import quota_ledger, key_id
+from .retry import CONTINUE_PROMPT, resumable_stream
+from .router import router
 
 logger = get_logger("gemini_service")
 
@@ -15,6 +24,8 @@ class GeminiService:
     def __init__(self):
         self._client = None
         self._history = []
+        # 上一次请求的 token 用量 (优先取 API 返回值，缺失时为估算)
+        self.last_usage: dict | None = None
     
     @property
     def client(self):
@@ -27,87 +38,194 @@ class GeminiService:
         """获取当前历史"""
         # 转换为 (role, text) 元组列表供 MessageLog 恢复 (如果需要)
         return [(msg["role"], msg["content"]) for msg in self._history]
+
+    def set_history(self, history):
+        """载入 (role, text) 历史 (可来自智谱，角色自动转换)"""
+        self._history = context_cache.trim([
+            {"role": "model" if role in ("model", "assistant") else "user", "content": text}
+            for role, text in history
+        ], 40)
     
-    def stream_chat_sync(self, message: str, model_name: str):
+    def stream_chat_sync(self, message: str, model_name: str, cancel: CancelToken | None = None):
         """
         同步流式聊天 (供 Worker 线程调用)
+        cancel 被触发时在下一个 chunk 处停止并关闭流，保留已生成的部分
         """
+        return request_scoped(self._stream_chat(message, model_name, cancel))
+
+    def _pick_client(self, model_name: str, first: bool):
+        """选择本次尝试的客户端：首次尝试优先用已有前缀缓存的 Key，否则从密钥池轮询"""
+        pool = self.client
+        if not hasattr(pool, "lease"):
+            return pool
+        if first:
+            key_index = context_cache.preferred_key(model_name, SYSTEM_INSTRUCTION, self._history)
+            if key_index is not None:
+                return pool.client_at(key_index)
+        # 每次尝试从密钥池轮询取一个 Key，并发会话因此均匀分摊
+        return pool.lease()
+
+    def _key_id(self, client) -> str:
+        """发出请求的 Key 的指纹 (额度账本按 模型 + Key 记账)"""
+        pool = self.client
+        index = pool.key_index(client) if client is not None and hasattr(pool, "key_index") else -1
+        return key_id(pool.api_keys[index]) if index >= 0 else "-"
+
+    def _cache_plan(self, client, model_name: str) -> CachePlan:
+        """系统指令 + 稳定历史前缀的服务端缓存 (失败时不用缓存，不影响请求)"""
+        pool = self.client
+        key_index = pool.key_index(client) if hasattr(pool, "key_index") else 0
+        try:
+            return context_cache.acquire(client, key_index, model_name, SYSTEM_INSTRUCTION, self._history, self)
+        except Exception as e:
+            logger.warning("上下文缓存不可用: %s", e)
+            return CachePlan()
+
+    def _stream_chat(self, message: str, model_name: str, cancel: CancelToken | None = None):
         from google.genai import types
 
-        logger.info(f"发起请求: model={model_name}, message_len={len(message)}")
+        started = time.perf_counter()
+        first_chunk_at = None
+        logger.info("发起请求: model=%s, message_len=%d", model_name, len(message))
         
         # 1. 准备历史消息对象
-        contents = []
-        for msg in self._history:
+        with tracer.span("service.build_payload", turns=len(self._history) // 2):
+            contents = []
+            for msg in self._history:
+                contents.append(types.Content(
+                    role=msg["role"],
+                    parts=[types.Part(text=msg["content"])]
+                ))
+            
+            # 2. 添加当前用户消息
             contents.append(types.Content(
-                role=msg["role"],
-                parts=[types.Part(text=msg["content"])]
+                role="user",
+                parts=[types.Part(text=message)]
             ))
         
-        # 2. 添加当前用户消息
-        contents.append(types.Content(
-            role="user",
-            parts=[types.Part(text=message)]
-        ))
-        
-        # 3. 流式生成与重试逻辑
+        # 3. 流式生成与重试逻辑 (首字前失败换 Key 重发，中途断开从断点续写)
         api_keys = self.client.api_keys if hasattr(self.client, "api_keys") else [1]
-        max_retries = len(api_keys) # 确保能遍历完所有 Key
+        # 首字前的失败逐个轮换 Key，因此上限不少于 Key 数
+        max_attempts = max(STREAM_MAX_ATTEMPTS, len(api_keys))
         full_response = ""
-        
-        for attempt in range(max_retries):
+        # 每次尝试的用量 (中途断开的尝试拿不到 usage，按收到的字数估算)
+        attempts: list[dict] = []
+        use_cache = True
+        client = None
+
+        def open_stream(partial: str, attempt: int):
+            """发起一次请求；partial 非空时是续写请求 (已输出部分作为上一条模型回答)"""
+            nonlocal use_cache, client
+            client = self._pick_client(model_name, first=attempt == 1 and use_cache)
+            plan = self._cache_plan(client, model_name) if use_cache else CachePlan()
+            if plan.name is not None:
+                # 系统指令与前缀已在服务端缓存中，只发送其后的历史与本轮消息
+                config = types.GenerateContentConfig(cached_content=plan.name, temperature=0.7)
+            else:
+                config = types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION, temperature=0.7)
+            request = contents[plan.cached:]
+            if partial:
+                request = request + [
+                    types.Content(role="model", parts=[types.Part(text=partial)]),
+                    types.Content(role="user", parts=[types.Part(text=CONTINUE_PROMPT)]),
+                ]
+            stats = {"usage": None, "chars": 0}
+            attempts.append(stats)
             try:
-                response = self.client.models.generate_content_stream(
+                response = client.models.generate_content_stream(
                     model=model_name,
-                    contents=contents,
-                    config=types.GenerateContentConfig(
-                        system_instruction=SYSTEM_INSTRUCTION,
-                        temperature=0.7,
-                    )
+                    contents=request,
+                    config=config,
                 )
-                
-                full_response = ""
-                for chunk in response:
+                # SDK 的流式调用是惰性的：取第一个 chunk 时才真正发出请求，span 计到首个 chunk 返回
+                with tracer.span("service.sdk_call", provider="gemini", attempt=attempt,
+                                 cached=plan.cached, resumed=len(partial)):
+                    first = next(response, None)
+                for chunk in itertools.chain([] if first is None else [first], response):
+                    if cancel is not None and cancel.cancelled:
+                        # SDK 流是生成器，关闭它会在 finally 中释放 HTTP 连接
+                        response.close()
+                        break
+                    # 用量随 chunk 累计更新，以最后一次为准
+                    if getattr(chunk, "usage_metadata", None):
+                        stats["usage"] = chunk.usage_metadata
                     if chunk.text:
-                        full_response += chunk.text
+                        stats["chars"] += len(chunk.text)
                         yield chunk.text
-                
-                # Generation Success
-                break
-                
             except Exception as e:
-                error_msg = str(e).upper()
-                logger.warning(f"请求失败 (attempt {attempt + 1}/{max_retries}): {error_msg}")
-                # 捕获 429 限流、网络超时、连接错误等所有可恢复异常
-                is_recoverable = any(x in error_msg for x in [
-                    "429", "RESOURCE_EXHAUSTED", "TIMEOUT", "CONNECTION",
-                    "NETWORK", "UNAVAILABLE", "503", "REMOTE_HOST"
-                ])
-
-                if is_recoverable and attempt < max_retries - 1:
-                    if rotate_api_key():
-                        logger.info(f"切换 API Key 并重试...")
-                        # yield 特殊信号通知 UI 显示重连动画
-                        yield f"__RECONNECTING__:{attempt + 1}:{max_retries}"
-                        continue  # 切换 Key 并立即重试
-                logger.error(f"API 请求最终失败: {error_msg}")
-                raise e # 彻底失败或不可恢复错误时抛出
-        
-        # 4. 更新历史
+                if plan.name is None or stats["chars"] or (cancel is not None and cancel.cancelled):
+                    raise
+                # 缓存被提前删除 / 已过期：丢弃登记，本次请求不用缓存立即重发 (不计入尝试次数)
+                logger.warning("使用上下文缓存失败，改为完整发送: %s", e)
+                attempts.remove(stats)
+                context_cache.invalidate(plan.name)
+                use_cache = False
+                yield from open_stream(partial, attempt)
+
+        try:
+            for text in resumable_stream(open_stream, cancel, max_attempts, "Gemini"):
+                if text.startswith("__RECONNECTING__:"):
+                    # 通知 UI 显示重连动画 (下一次尝试会轮询到下一个 Key)
+                    yield text
+                    continue
+                if first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+                    tracer.instant("service.first_chunk")
+                full_response += text
+                yield text
+        except Exception as e:
+            logger.error("API 请求最终失败: %s", e)
+            router.fail(model_name, e)
+            raise  # 彻底失败或不可恢复错误时抛出
+
+        cancelled = cancel is not None and cancel.cancelled
+        if cancelled:
+            logger.info("请求已中断: 已生成 %d 字", len(full_response))
+
+        # 4. 更新历史 (中断的回答保留已生成部分并标记截断)
         self._history.append({"role": "user", "content": message})
-        self._history.append({"role": "model", "content": full_response})
+        self._history.append({
+            "role": "model",
+            "content": full_response + TRUNCATED_MARK if cancelled else full_response,
+        })
         
-        # 限制历史长度 (保留最近 20 轮 = 40 条)
-        if len(self._history) > 40:
-            self._history = self._history[-40:]
+        # 限制历史长度 (最多 20 轮 = 40 条；启用缓存时按缓存步长整块丢弃，前缀保持稳定)
+        self._history = context_cache.trim(self._history, 40)
         
-        # 5. 估算 Token 消耗并通知 UI
-        # 简易估算: 中英文混合约 0.7 token/char
-        prompt_tokens = max(1, int(len(message) * 0.7))
-        output_tokens = max(1, int(len(full_response) * 0.7))
+        # 5. 统计 Token 消耗并通知 UI
+        # 优先使用 API 返回的用量；缺失时简易估算: 中英文混合约 0.7 token/char；续写的各次尝试累加
+        prompt_tokens = output_tokens = cached_tokens = 0
+        estimated = False
+        for stats in attempts:
+            usage = stats["usage"]
+            if usage is not None and getattr(usage, "candidates_token_count", None):
+                prompt_tokens += usage.prompt_token_count or 0
+                output_tokens += usage.candidates_token_count
+                # 输入中命中上下文缓存的部分 (按缓存价计费)
+                cached_tokens += usage.cached_content_token_count or 0
+                context_cache.record_usage(usage)
+            else:
+                prompt_tokens += max(1, int(len(message) * 0.7))
+                output_tokens += int(stats["chars"] * 0.7)
+                estimated = True
+        output_tokens = max(1, output_tokens)
         turn_tokens = prompt_tokens + output_tokens
+        self.last_usage = {
+            "input_tokens": prompt_tokens, "output_tokens": output_tokens,
+            "cached_tokens": cached_tokens,
+            "estimated": estimated, "cancelled": cancelled,
+        }
+        quota_ledger.record(model_name, self._key_id(client), prompt_tokens, output_tokens, estimated)
 
-        logger.info(f"响应完成: input_tokens={prompt_tokens}, output_tokens={output_tokens}")
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        ttft_ms = (first_chunk_at - started) * 1000 if first_chunk_at else None
+        logger.info(
+            "响应完成: input_tokens=%d (缓存 %d), output_tokens=%d", prompt_tokens, cached_tokens, output_tokens,
+            extra={"model": model_name, "elapsed_ms": round(elapsed_ms, 1),
+                   "ttft_ms": round(ttft_ms, 1) if ttft_ms else None},
+        )
+        if not cancelled or ttft_ms is not None:
+            router.observe(model_name, ttft_ms, elapsed_ms, output_tokens, complete=not cancelled)
 
         # yield Token 统计信号 (UI 会捕获并更新)
         yield f"__TOKEN_STATS__:{turn_tokens}"
@@ -116,13 +234,4 @@ class GeminiService:
         """清空对话历史"""
         logger.info("清空对话历史")
         self._history = []
-
-    def undo_last_turn(self) -> bool:
-        """撤销上一轮对话 (删除最后的一组 User+Model 消息)"""
-        if len(self._history) >= 2:
-            # 弹出最后两条 (User + Model)
-            self._history.pop()
-            self._history.pop()
-            return True
-        return False
-
+        context_cache.release(self)
@@ -0,0 +1,343 @@
+"""
+额度账本 - 按 (模型, Key) 持久化记录真实 token 用量，据此计算剩余额度并自动选择模型
+- 追加写入 data/quota_ledger.jsonl：每条记录单独一行，写入后 fsync，进程崩溃最多丢失正在写的一行
+- 累计到一定行数时压缩：合计写入快照 data/quota_snapshot.json (临时文件 + 原子替换)，再清空账本
+- 记录带递增序号，快照保存已合并的最大序号：压缩中途崩溃时重放账本也不会重复计数
+- 剩余额度 = ZHIPU_MODELS 中的额度 - 账本累计用量；服务端报告余额不足时该 (模型, Key) 直接记为用尽
+- 模型选择：当前赠送模型未用尽时保持不变，用尽后切换到剩余最多的赠送模型，全部用尽再回退付费模型
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from config.settings import ZHIPU_MODELS, ZHIPU_QUOTA_RESERVE, load_zhipu_api_keys
+from utils.logger import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = get_logger("quota")
+
+DATA_DIR = Path(__file__).parent.parent / "data"
+LEDGER_FILE = DATA_DIR / "quota_ledger.jsonl"
+SNAPSHOT_FILE = DATA_DIR / "quota_snapshot.json"
+# 账本超过该行数时压缩进快照
+COMPACT_LINES = 500
+
+
+@contextmanager
+def _file_lock(path: Path, shared: bool = False):
+    """跨进程文件锁 (应用 / 网关 / 批处理共用同一份账本)"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            # msvcrt 只有排他锁；LK_LOCK 约 10 秒后放弃，这里一直重试
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _stamp(path: Path) -> tuple | None:
+    """文件的变化标记 (不存在时为 None)"""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def key_id(api_key: str) -> str:
+    """Key 指纹 (账本中不保存明文 Key)"""
+    if not api_key:
+        return "-"
+    return hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:10]
+
+
+def zhipu_key_id() -> str:
+    """当前智谱 Key 的指纹"""
+    keys = load_zhipu_api_keys()
+    return key_id(keys[0]) if keys else "-"
+
+
+def allowance(model: str) -> int | None:
+    """模型的总额度 (tokens)；非智谱模型返回 None"""
+    info = ZHIPU_MODELS.get(model)
+    return info["tokens"] if info else None
+
+
+def format_tokens(tokens: int) -> str:
+    """额度显示：万为单位"""
+    return f"{tokens / 10000:.0f}万" if abs(tokens) >= 10000 else str(tokens)
+
+
+class QuotaLedger:
+    """额度账本 (进程内单例，所有会话共享)"""
+
+    def __init__(self, ledger: Path = LEDGER_FILE, snapshot: Path = SNAPSHOT_FILE,
+                 compact_lines: int = COMPACT_LINES, reserve: int = ZHIPU_QUOTA_RESERVE):
+        self.ledger = ledger
+        self.snapshot = snapshot
+        self.lock_file = ledger.with_suffix(".lock")
+        self.compact_lines = compact_lines
+        self.reserve = reserve
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._snapshot_stamp = None  # 已加载快照的变化标记
+        self._snapshot_seq = 0       # 快照的序号 (账本中不大于它的记录已计入快照)
+        self._offset = 0             # 账本已读到的字节位置
+        self._reset()
+
+    def _reset(self) -> None:
+        self._seq = 0            # 最后一条记录的序号
+        self._file_lines = 0     # 账本当前行数
+        # (模型, Key) -> [输入, 输出, 请求数]
+        self._used: dict[tuple[str, str], list[int]] = {}
+        # (模型, Key) -> 报告用尽时的额度 (额度配置变化后失效)
+        self._exhausted: dict[tuple[str, str], int] = {}
+
+    # ============== 加载 / 持久化 ==============
+    # 应用、网关、批处理各自持有一份内存合计，磁盘上的快照 + 账本才是准数：
+    # 写入 (追加 / 压缩) 持排他文件锁，先合并其他进程写入的内容再落盘
+
+    def _ledger_size(self) -> int:
+        try:
+            return self.ledger.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _ensure_loaded(self) -> None:
+        """与磁盘同步 (文件未变化时不加文件锁)"""
+        if (self._loaded and _stamp(self.snapshot) == self._snapshot_stamp
+                and self._ledger_size() == self._offset):
+            return
+        with self._lock:
+            try:
+                with _file_lock(self.lock_file, shared=True):
+                    self._sync()
+            except OSError as e:
+                logger.warning("额度账本读取失败: %s", e)
+
+    def _sync(self) -> None:
+        """合并磁盘上的新内容 (持两把锁调用)"""
+        stamp = _stamp(self.snapshot)
+        if not self._loaded or stamp != self._snapshot_stamp or self._ledger_size() < self._offset:
+            # 首次加载，或其他进程已压缩：从快照重新计算
+            self._reset()
+            self._offset = 0
+            self._snapshot_stamp = stamp
+            try:
+                state = json.loads(self.snapshot.read_text(encoding="utf-8"))
+                self._seq = state.get("seq", 0)
+                for item in state.get("used", []):
+                    self._used[(item["model"], item["key"])] = [item["in"], item["out"], item["requests"]]
+                for item in state.get("exhausted", []):
+                    self._exhausted[(item["model"], item["key"])] = item["allowance"]
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError) as e:
+                logger.warning("额度快照损坏，仅按账本计算: %s", e)
+            self._snapshot_seq = self._seq
+            self._loaded = True
+        try:
+            with open(self.ledger, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # 只消费完整的行；末尾写到一半的行由下次追加补上换行后跳过
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            self._file_lines += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 写到一半的行
+            if record.get("seq", 0) > self._snapshot_seq:
+                self._apply(record)
+        self._offset += end
+
+    def _apply(self, record: dict) -> None:
+        """把一条账本记录合并进内存合计 (持锁调用)"""
+        key = (record["model"], record["key"])
+        self._seq = max(self._seq, record["seq"])
+        if record.get("exhausted"):
+            self._exhausted[key] = record["allowance"]
+            return
+        used = self._used.setdefault(key, [0, 0, 0])
+        used[0] += record["in"]
+        used[1] += record["out"]
+        used[2] += 1
+
+    def _append(self, record: dict) -> None:
+        """追加一条记录并落盘 (持两把锁、且刚同步过时调用，序号不会与其他进程冲突)"""
+        self._seq += 1
+        record = {"seq": self._seq, "ts": round(time.time(), 3), **record}
+        self._apply(record)
+        self.ledger.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.ledger, "ab") as f:
+            torn = f.tell() > self._offset  # 末尾是写到一半的行
+            f.write((b"\n" if torn else b"") + json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+            self._offset = f.tell()
+        self._file_lines += 1
+        if self._file_lines >= self.compact_lines:
+            self._compact()
+
+    def _compact(self) -> None:
+        """合计写入快照 (原子替换) 后清空账本 (持两把锁、且刚同步过时调用)"""
+        state = {
+            "seq": self._seq,
+            "updated_at": round(time.time(), 3),
+            "used": [
+                {"model": model, "key": key, "in": used[0], "out": used[1], "requests": used[2]}
+                for (model, key), used in self._used.items()
+            ],
+            "exhausted": [
+                {"model": model, "key": key, "allowance": value}
+                for (model, key), value in self._exhausted.items()
+            ],
+        }
+        tmp = self.snapshot.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(self.snapshot)
+        # 快照已落盘：此后崩溃时账本中的旧记录按序号跳过
+        with open(self.ledger, "w", encoding="utf-8") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self._snapshot_stamp = _stamp(self.snapshot)
+        self._snapshot_seq = self._seq
+        self._offset = 0
+        self._file_lines = 0
+        logger.info("额度账本已压缩: seq=%d, %d 组用量", self._seq, len(self._used))
+
+    def _write(self, record: dict | None = None) -> None:
+        """持排他文件锁：合并磁盘内容后追加记录 (record 为 None 时立即压缩)"""
+        with _file_lock(self.lock_file):
+            self._sync()
+            if record is not None:
+                self._append(record)
+            elif self._file_lines:
+                self._compact()
+
+    # ============== 记账 ==============
+
+    def record(self, model: str, key: str, input_tokens: int, output_tokens: int,
+               estimated: bool = False) -> None:
+        """记录一次请求的用量"""
+        if input_tokens <= 0 and output_tokens <= 0:
+            return
+        with self._lock:
+            try:
+                self._write({"model": model, "key": key, "in": input_tokens,
+                             "out": output_tokens, "est": estimated})
+            except OSError as e:
+                logger.warning("额度账本写入失败: %s", e)  # 记账失败不影响聊天
+
+    def mark_exhausted(self, model: str, key: str) -> None:
+        """服务端报告额度用尽：账本与实际不符时以服务端为准"""
+        total = allowance(model)
+        if total is None:
+            return
+        self._ensure_loaded()
+        with self._lock:
+            if self._exhausted.get((model, key)) == total:
+                return
+            try:
+                self._write({"model": model, "key": key, "exhausted": True, "allowance": total})
+            except OSError as e:
+                logger.warning("额度账本写入失败: %s", e)
+        logger.warning("模型额度已用尽: %s", model)
+
+    # ============== 查询 ==============
+
+    def used(self, model: str, key: str | None = None) -> int:
+        """已用 tokens (key 为 None 时合计所有 Key)"""
+        self._ensure_loaded()
+        with self._lock:
+            return sum(
+                used[0] + used[1] for (m, k), used in self._used.items()
+                if m == model and (key is None or k == key)
+            )
+
+    def requests(self, model: str, key: str | None = None) -> int:
+        """已记账的请求次数"""
+        self._ensure_loaded()
+        with self._lock:
+            return sum(
+                used[2] for (m, k), used in self._used.items()
+                if m == model and (key is None or k == key)
+            )
+
+    def remaining(self, model: str, key: str | None = None) -> int | None:
+        """剩余额度 (tokens)；非智谱模型返回 None"""
+        total = allowance(model)
+        if total is None:
+            return None
+        key = key or zhipu_key_id()
+        self._ensure_loaded()
+        if self._exhausted.get((model, key)) == total:
+            return 0
+        return max(0, total - self.used(model, key))
+
+    def available(self, model: str, key: str | None = None) -> bool:
+        """剩余额度是否高于保留量 (低于保留量视为用尽，避免请求中途耗尽)"""
+        remaining = self.remaining(model, key)
+        return remaining is None or remaining > self.reserve
+
+    def pick_model(self, current: str | None = None, key: str | None = None) -> str:
+        """
+        选择智谱模型
+        - 当前为赠送模型且未用尽：保持 (避免来回切换)
+        - 否则：剩余最多的赠送模型；全部用尽时回退付费模型
+        - 当前为付费模型 (手动选择)：保持
+        """
+        key = key or zhipu_key_id()
+        info = ZHIPU_MODELS.get(current or "")
+        if info is not None:
+            if info["type"] != "free" or self.available(current, key):
+                return current
+        free = [
+            (self.remaining(model, key), model)
+            for model, info in ZHIPU_MODELS.items() if info["type"] == "free"
+        ]
+        free = [(remaining, model) for remaining, model in free if remaining > self.reserve]
+        if free:
+            return max(free, key=lambda item: item[0])[1]
+        return next(model for model, info in ZHIPU_MODELS.items() if info["type"] == "paid")
+
+    def compact(self) -> None:
+        """立即压缩 (退出时调用，下次启动只读快照)"""
+        with self._lock:
+            try:
+                self._write()
+            except OSError as e:
+                logger.warning("额度账本压缩失败: %s", e)
+
+
+# 全局单例
+quota_ledger = QuotaLedger()
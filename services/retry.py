@@ -0,0 +1,187 @@
+"""
+流式重试 - 中途断开时续写，而不是整段重新生成
+- 首字之前失败：原样重发 (Gemini 同时换 Key)
+- 已输出部分内容后失败：把已输出的部分作为模型自己的回答放回上下文，要求从断点继续
+  (已显示的内容不重复，也不再为这段输出重复付费；重发的只是按输入计费的前文)
+- 续写开头常会重复断点前的一小段，甚至从头再来：缓冲开头若干字符，与已输出内容对齐后去掉重复部分
+- 每轮尝试次数有上限；不可恢复的错误 (鉴权 / 参数 / 额度) 直接抛出
+"""
+from typing import Callable, Iterable, Iterator
+
+from config.settings import STREAM_MAX_ATTEMPTS
+from utils.logger import get_logger
+from .cancel import CancelToken
+
+logger = get_logger("retry")
+
+# 续写请求里的用户指令 (已输出部分作为上一条模型回答放在它之前)
+CONTINUE_PROMPT = (
+    "你的上一条回答因网络中断被截断了，用户已经看到截断前的全部内容。"
+    "请从截断处直接接着写完剩余部分：不要重复已输出的内容，不要重新开头，不要加任何说明。"
+)
+# 可恢复错误的特征 (限流、超时、连接中断、服务端暂时不可用)
+RECOVERABLE_MARKERS = (
+    "429", "RESOURCE_EXHAUSTED", "TIMEOUT", "TIMED OUT", "CONNECTION", "NETWORK",
+    "UNAVAILABLE", "500", "502", "503", "504", "REMOTE_HOST", "REMOTEPROTOCOL",
+    "PEER CLOSED", "INCOMPLETE", "RESET BY PEER",
+)
+# 续写开头缓冲多少字符后再判断重复
+PROBE_CHARS = 48
+# 与已输出内容对齐时锚点的最小长度 (过短容易误判)
+MIN_ANCHOR = 8
+# 续写从断点前重新开始时，起点只在断点前这么多字符内查找 (或正好是回答开头)：
+# 内容有重复段落时，更早的相同句子不是续写的起点
+RESTART_WINDOW = 200
+# 只按 "已输出结尾 = 续写开头" 去重时的最小重叠长度
+MIN_OVERLAP = 4
+# 重叠恰好是断点处被截断的单词 (如 "Hello wor" + "world") 时允许的最小长度
+MIN_WORD_OVERLAP = 2
+
+
+def is_recoverable(error: BaseException) -> bool:
+    message = str(error).upper()
+    return any(marker in message for marker in RECOVERABLE_MARKERS)
+
+
+class Stitcher:
+    """把续写输出拼到已输出内容之后，去掉开头与已输出内容重复的部分"""
+
+    def __init__(self, emitted: str):
+        self.emitted = emitted
+        self._buffer = ""
+        # 跳过模式：续写正与 emitted[p:] 逐字重合的各个候选位置 p (内容有重复时可能不止一个)
+        self._skip_at: list[int] = []
+        self._held = ""                    # 跳过模式中暂扣的文本 (确认重复到断点才丢弃)
+        self._resolved = False
+
+    def feed(self, chunk: str) -> str:
+        """送入续写的一段，返回可以输出的部分"""
+        if self._skip_at:
+            return self._skip(chunk)
+        if self._resolved:
+            return chunk
+        self._buffer += chunk
+        if len(self._buffer) < PROBE_CHARS:
+            return ""
+        return self._resolve()
+
+    def flush(self) -> str:
+        """续写结束 (或再次中断)：输出仍在缓冲中的部分"""
+        if self._resolved:
+            # 结束时仍与前文逐字重合的暂扣文本视为重复，丢弃
+            self._held, self._skip_at = "", []
+            return ""
+        return self._resolve()
+
+    def _resolve(self) -> str:
+        buffer, emitted = self._buffer, self.emitted
+        self._buffer = ""
+        self._resolved = True
+        # 1. 续写从断点前不远处 (或从头) 重新开始：用开头作锚点在已输出内容中对齐
+        if len(buffer) >= MIN_ANCHOR:
+            for start in _anchors(emitted, buffer[:MIN_ANCHOR]):
+                matched = _common_prefix(emitted, start, buffer)
+                if matched == len(emitted) - start:
+                    # 重合部分一直延续到断点：其后才是新内容
+                    return buffer[matched:]
+                if matched == len(buffer):
+                    # 缓冲全部重合但还没到断点：暂扣，继续逐字比对
+                    self._skip_at.append(start + matched)
+            if self._skip_at:
+                self._held = buffer
+                return ""
+        # 2. 只是开头重复了断点前的一小段
+        for size in range(min(len(buffer), len(emitted)), MIN_WORD_OVERLAP - 1, -1):
+            if emitted.endswith(buffer[:size]) and (size >= MIN_OVERLAP or _word_tail(emitted, size)):
+                return buffer[size:]
+        return buffer
+
+    def _skip(self, chunk: str) -> str:
+        emitted = self.emitted
+        for i, char in enumerate(chunk):
+            if len(emitted) in self._skip_at:
+                # 某个候选一路重合到断点：暂扣的确实是重复内容，丢弃，其后是新内容
+                self._skip_at, self._held = [], ""
+                return chunk[i:]
+            alive = [pos + 1 for pos in self._skip_at if emitted[pos] == char]
+            if not alive:
+                # 没到断点就分叉：不是重新开头，而是恰好与前文相同的新内容，暂扣的部分照常输出
+                held, self._skip_at, self._held = self._held, [], ""
+                return held + chunk
+            self._skip_at = alive
+        self._held += chunk
+        return ""
+
+
+def _anchors(emitted: str, anchor: str) -> Iterator[int]:
+    """锚点在已输出内容中可作为续写起点的位置：断点前 RESTART_WINDOW 内 (由近及远)，以及回答开头"""
+    floor = max(0, len(emitted) - RESTART_WINDOW)
+    start = emitted.rfind(anchor, floor)
+    while start >= 0:
+        yield start
+        start = emitted.rfind(anchor, floor, start + len(anchor) - 1)
+    if floor > 0 and emitted.startswith(anchor):
+        yield 0
+
+
+def _word_tail(text: str, size: int) -> bool:
+    """text 末尾 size 个字符是否是一个完整的西文单词片段 (前面是单词边界)"""
+    start = len(text) - size
+    tail = text[start:]
+    return tail.isascii() and tail.isalnum() and (start == 0 or not text[start - 1].isalnum())
+
+
+def _common_prefix(text: str, start: int, other: str) -> int:
+    """text[start:] 与 other 的公共前缀长度"""
+    limit = min(len(text) - start, len(other))
+    i = 0
+    while i < limit and text[start + i] == other[i]:
+        i += 1
+    return i
+
+
+def resumable_stream(
+    open_stream: Callable[[str, int], Iterable[str]],
+    cancel: CancelToken | None = None,
+    max_attempts: int = STREAM_MAX_ATTEMPTS,
+    label: str = "",
+) -> Iterator[str]:
+    """
+    带续写的流式重试
+    open_stream(partial, attempt) 发起一次请求并逐段返回文本：partial 为空时是原始请求，
+    否则是续写请求 (partial 为截至目前已输出的全部内容)
+    产出去重后的文本，以及重试前的 "__RECONNECTING__:<第几次>:<上限>" 信号
+    尝试用尽或错误不可恢复时抛出最后一次的异常；被取消时直接结束
+    """
+    emitted = ""
+    attempt = 0
+    while True:
+        attempt += 1
+        stitcher = Stitcher(emitted) if emitted else None
+        try:
+            for chunk in open_stream(emitted, attempt):
+                if stitcher is not None:
+                    chunk = stitcher.feed(chunk)
+                if chunk:
+                    emitted += chunk
+                    yield chunk
+            if stitcher is not None:
+                tail = stitcher.flush()
+                if tail:
+                    emitted += tail
+                    yield tail
+            return
+        except Exception as e:
+            if stitcher is not None:
+                # 续写再次中断：已收到的部分仍然有效
+                tail = stitcher.flush()
+                if tail:
+                    emitted += tail
+                    yield tail
+            if cancel is not None and cancel.cancelled:
+                return
+            if attempt >= max_attempts or not is_recoverable(e):
+                raise
+            mode = f"续写 (已输出 {len(emitted)} 字)" if emitted else "重发"
+            logger.warning("%s请求中断 (attempt %d/%d)，%s: %s", label, attempt, max_attempts, mode, e)
+            yield f"__RECONNECTING__:{attempt}:{max_attempts}"
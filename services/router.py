@@ -0,0 +1,317 @@
+"""
+服务路由 - 按策略为每次请求选择 (服务, 模型)
+- 每个候选项统计：滚动错误率 (按时间衰减，带先验成功次数)、首字延迟 (EWMA)、输出速度 (EWMA)；服务层在请求结束时上报
+- 评分 (越低越好) = 错误率 + 延迟 + 速度 + 额度消耗 + 成本 - 偏好 (用户所选模型 / 同一服务)
+- 赠送额度用尽的模型不参与选择；连续失败 / 错误率过高的候选项标记为不健康，暂不选择
+- 最近一次失败的候选项 (流量已被绕开，没有新数据) 由后台线程用极短请求探测 (退避间隔)，成功即恢复，无需手动切回
+- 最近的路由决策保留在内存中，供 /stats 与网关指标展示
+"""
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from config.settings import (
+    ZHIPU_MODELS, GEMINI_MODELS, PRIMARY_SERVICE, ROUTER_PROBE_INTERVAL,
+    load_api_keys, load_zhipu_api_keys,
+)
+from utils.logger import get_logger
+from .quota import quota_ledger
+
+logger = get_logger("router")
+
+# 错误率统计窗口：最近 N 次请求且不早于 N 秒；越早的结果权重越低 (半衰期)
+WINDOW_SIZE = 20
+WINDOW_SECONDS = 600
+ERROR_HALF_LIFE = 120
+# 先验：相当于几次 "刚刚成功" 的请求 (单次偶发失败不至于让错误率接近 50%，旧失败随衰减趋近 0)
+PRIOR_SUCCESSES = 3.0
+# EWMA 平滑系数
+EWMA_ALPHA = 0.3
+# 连续失败次数 / 窗口错误率 (样本足够时) 达到阈值即判为不健康
+UNHEALTHY_FAILURES = 2
+UNHEALTHY_ERROR_RATE = 0.5
+UNHEALTHY_MIN_SAMPLES = 4
+# 探测退避上限 (秒)
+PROBE_MAX_BACKOFF = 300
+PROBE_PROMPT = "ping，只回复 pong"
+# 未指定首选模型时使用的服务
+PRIMARY_PROVIDER = "zhipu" if PRIMARY_SERVICE == "zhipu" else "gemini"
+
+# 评分权重与参照值 (无样本时按参照值计，即中性)
+ERROR_WEIGHT = 4.0
+TTFT_WEIGHT = 0.5
+TTFT_REF_MS = 1500.0
+SPEED_WEIGHT = 0.5
+SPEED_REF_TPS = 40.0
+QUOTA_WEIGHT = 0.5
+COST_WEIGHT = 1.0
+PREFERRED_BONUS = 1.0     # 用户所选模型
+PROVIDER_BONUS = 0.5      # 与所选模型同一服务 (保持上下文与人格风格一致)
+
+
+def provider_of(model: str) -> str:
+    return "zhipu" if model.startswith("glm-") else "gemini"
+
+
+@dataclass
+class OptionStats:
+    """单个 (服务, 模型) 候选项的运行统计"""
+    provider: str
+    model: str
+    outcomes: deque = field(default_factory=lambda: deque(maxlen=WINDOW_SIZE))  # (时间戳, 成功)
+    ttft_ms: float | None = None
+    tps: float | None = None
+    failures: int = 0              # 连续失败次数 (> 0 时等待探测)
+    healthy: bool = True
+    last_error: str = ""
+    probes: int = 0
+    next_probe: float = 0.0        # 下次探测的时间戳
+    backoff: float = 0.0
+
+    @property
+    def cost(self) -> float:
+        """相对成本：付费模型 1，赠送额度 / 免费层 0"""
+        info = ZHIPU_MODELS.get(self.model)
+        return 1.0 if info is not None and info["type"] == "paid" else 0.0
+
+    def error_rate(self, now: float) -> float:
+        """
+        窗口内按时间衰减加权的错误率，带先验成功次数
+        先验权重不衰减：失败越旧权重越小，错误率随时间趋近 0 (不必等它滑出窗口)
+        """
+        total, failed = PRIOR_SUCCESSES, 0.0
+        for ts, ok in self.outcomes:
+            age = now - ts
+            if age > WINDOW_SECONDS:
+                continue
+            weight = 0.5 ** (age / ERROR_HALF_LIFE)
+            total += weight
+            if not ok:
+                failed += weight
+        return failed / total
+
+    def samples(self, now: float) -> int:
+        return sum(1 for ts, _ in self.outcomes if now - ts <= WINDOW_SECONDS)
+
+
+@dataclass
+class Decision:
+    """一次路由决策"""
+    at: float
+    preferred: str
+    model: str
+    reason: str              # 首选 / 额度用尽 / 不健康 / 评分更优
+    score: float
+    candidates: list[str]    # 按评分排序的可选模型 (首个即 model)
+
+    @property
+    def provider(self) -> str:
+        return provider_of(self.model)
+
+
+class Router:
+    """路由器 (进程内单例，所有会话共享统计)"""
+
+    def __init__(self, probe_interval: float = ROUTER_PROBE_INTERVAL):
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._options: dict[str, OptionStats] = {}
+        for model in self._configured_models():
+            self._options[model] = OptionStats(provider_of(model), model)
+        self.decisions: deque[Decision] = deque(maxlen=20)
+        self._probe_thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _configured_models() -> list[str]:
+        """已配置 Key 的服务的模型 (都未配置时全部列出，请求时再报错)"""
+        zhipu = list(ZHIPU_MODELS) if load_zhipu_api_keys() else []
+        gemini = list(GEMINI_MODELS) if load_api_keys() else []
+        return zhipu + gemini or list(ZHIPU_MODELS) + list(GEMINI_MODELS)
+
+    @property
+    def options(self) -> list[OptionStats]:
+        return list(self._options.values())
+
+    def _option(self, model: str) -> OptionStats:
+        option = self._options.get(model)
+        if option is None:
+            # 未登记的模型 (如网关请求指定)：按需加入
+            option = self._options.setdefault(model, OptionStats(provider_of(model), model))
+        return option
+
+    # ============== 上报 ==============
+
+    def observe(self, model: str, ttft_ms: float | None, elapsed_ms: float, output_tokens: int,
+                complete: bool = True) -> None:
+        """请求成功 (complete=False 表示被用户中断，只计首字延迟)"""
+        with self._lock:
+            option = self._option(model)
+            if not option.healthy:
+                # 从不健康恢复 (探测或真实请求成功)：旧的失败不再计入，立即重新参与竞争
+                option.outcomes.clear()
+            elif option.failures:
+                # 成功结束了一串失败 (多为探测)：这串失败按旧了一个半衰期计，权重减半
+                _age_streak(option.outcomes, ERROR_HALF_LIFE)
+            option.outcomes.append((time.time(), True))
+            option.failures = 0
+            option.backoff = 0.0
+            if ttft_ms is not None:
+                option.ttft_ms = _ewma(option.ttft_ms, ttft_ms)
+                gen_ms = elapsed_ms - ttft_ms
+                if complete and gen_ms > 50 and output_tokens > 0:
+                    option.tps = _ewma(option.tps, output_tokens / (gen_ms / 1000))
+            if not option.healthy:
+                option.healthy = True
+                logger.info("路由候选项已恢复: %s", model)
+
+    def fail(self, model: str, error: object) -> None:
+        """请求失败 (服务层已完成自身的重试)"""
+        now = time.time()
+        with self._lock:
+            option = self._option(model)
+            option.outcomes.append((now, False))
+            option.failures += 1
+            option.last_error = str(error)[:200]
+            # 探测退避：首次失败按探测间隔，之后 (含探测失败) 逐次翻倍
+            option.backoff = min(PROBE_MAX_BACKOFF, option.backoff * 2) if option.backoff else self.probe_interval
+            option.next_probe = now + option.backoff
+            if option.healthy and (
+                option.failures >= UNHEALTHY_FAILURES
+                or (option.samples(now) >= UNHEALTHY_MIN_SAMPLES
+                    and option.error_rate(now) >= UNHEALTHY_ERROR_RATE)
+            ):
+                option.healthy = False
+                logger.warning("路由候选项不健康: %s (%s)", model, option.last_error)
+
+    # ============== 评分 / 选择 ==============
+
+    def score(self, option: OptionStats, preferred: str, now: float | None = None) -> float:
+        now = now or time.time()
+        ttft = option.ttft_ms if option.ttft_ms is not None else TTFT_REF_MS
+        tps = option.tps if option.tps is not None else SPEED_REF_TPS
+        score = (
+            ERROR_WEIGHT * option.error_rate(now)
+            + TTFT_WEIGHT * ttft / TTFT_REF_MS
+            + SPEED_WEIGHT * SPEED_REF_TPS / (SPEED_REF_TPS + tps)
+            + QUOTA_WEIGHT * self._quota_used(option.model)
+            + COST_WEIGHT * option.cost
+        )
+        if option.model == preferred:
+            score -= PREFERRED_BONUS
+        if option.provider == provider_of(preferred):
+            score -= PROVIDER_BONUS
+        return score
+
+    @staticmethod
+    def _quota_used(model: str) -> float:
+        """额度消耗程度 0~1 (剩余越多越低；相对最大的赠送额度，剩余多的模型优先)"""
+        remaining = quota_ledger.remaining(model)
+        if remaining is None or ZHIPU_MODELS[model]["type"] != "free":
+            return 0.0
+        largest = max(info["tokens"] for info in ZHIPU_MODELS.values() if info["type"] == "free")
+        return 1.0 - min(1.0, remaining / largest)
+
+    def rank(self, preferred: str, provider: str | None = None) -> list[tuple[float, OptionStats]]:
+        """可选的候选项按评分排序 (额度用尽的排除；不健康的仅在没有健康项时保留)"""
+        now = time.time()
+        with self._lock:
+            options = [
+                option for option in self._options.values()
+                if (provider is None or option.provider == provider)
+                and quota_ledger.available(option.model)
+            ]
+            if (preferred and preferred not in self._options and quota_ledger.available(preferred)
+                    and (provider is None or provider_of(preferred) == provider)):
+                options.append(self._option(preferred))
+            healthy = [option for option in options if option.healthy]
+            ranked = sorted(
+                ((self.score(option, preferred, now), option) for option in healthy or options),
+                key=lambda item: item[0],
+            )
+        return ranked
+
+    def choose(self, preferred: str | None = None) -> Decision:
+        """为一次请求选择模型 (preferred 为用户所选；为空时按配置的主服务)"""
+        preferred = preferred or self.best(PRIMARY_PROVIDER)
+        ranked = self.rank(preferred)
+        if not ranked:
+            # 全部赠送额度用尽且没有其他候选：只能按用户所选发送
+            decision = Decision(time.time(), preferred, preferred, "首选", 0.0, [preferred])
+        else:
+            score, best = ranked[0]
+            if best.model == preferred:
+                reason = "首选"
+            elif not quota_ledger.available(preferred):
+                reason = "额度用尽"
+            elif not self._options[preferred].healthy:
+                reason = "不健康"
+            else:
+                reason = "评分更优"
+            decision = Decision(
+                time.time(), preferred, best.model, reason, score,
+                [option.model for _, option in ranked],
+            )
+        self.decisions.append(decision)
+        return decision
+
+    def best(self, provider: str) -> str:
+        """某个服务当前评分最好的模型 (切换服务时的默认模型)"""
+        ranked = self.rank("", provider)
+        if ranked:
+            return ranked[0][1].model
+        return quota_ledger.pick_model() if provider == "zhipu" else GEMINI_MODELS[0]
+
+    # ============== 探测 ==============
+
+    def start_probes(self) -> None:
+        """启动后台探测线程 (ROUTER_PROBE_INTERVAL <= 0 时不探测，仅靠真实请求恢复)"""
+        if self.probe_interval <= 0 or self._probe_thread is not None:
+            return
+        self._probe_thread = threading.Thread(target=self._probe_loop, name="router-probe", daemon=True)
+        self._probe_thread.start()
+
+    def stop_probes(self) -> None:
+        self._stop.set()
+
+    def _probe_loop(self) -> None:
+        while not self._stop.wait(min(self.probe_interval, 5)):
+            now = time.time()
+            with self._lock:
+                due = [o for o in self._options.values() if o.failures and o.next_probe <= now]
+            for option in due:
+                self._probe(option)
+
+    def _probe(self, option: OptionStats) -> None:
+        """发一个极短请求 (成功 / 失败由服务层上报，据此恢复或延长退避)"""
+        from .gemini_service import GeminiService
+        from .zhipu_service import ZhipuService
+
+        with self._lock:
+            option.probes += 1
+            # 服务层没能上报时 (如初始化异常) 也不立即重复探测
+            option.next_probe = time.time() + max(option.backoff, self.probe_interval)
+        service = ZhipuService(enable_web_search=False) if option.provider == "zhipu" else GeminiService()
+        try:
+            for _ in service.stream_chat_sync(PROBE_PROMPT, option.model):
+                pass
+        except Exception as e:
+            logger.debug("探测失败 %s: %s", option.model, e)
+
+
+def _age_streak(outcomes: deque, seconds: float) -> None:
+    """把末尾连续的失败记录提前 seconds 秒 (衰减后权重更低)"""
+    streak = []
+    while outcomes and not outcomes[-1][1]:
+        streak.append(outcomes.pop())
+    for ts, ok in reversed(streak):
+        outcomes.append((ts - seconds, ok))
+
+
+def _ewma(old: float | None, value: float) -> float:
+    return value if old is None else old + EWMA_ALPHA * (value - old)
+
+
+# 全局单例
+router = Router()
@@ -0,0 +1,418 @@
+"""
+会话模型 - 多标签并发会话
+- ChatSession: 一个标签页 = 独立的消息记录 + 对话历史 + 模型 + 在途流
+- Turn: 对话树的节点 (一轮对话 + 父节点)，各分支共享公共前缀，分叉只新增一个指针
+- Branch: 指向树上某个节点的分支；当前分支的路径决定消息区、代码块索引与服务历史
+  撤销 / 重做 / 删除 / 切换分支都只是移动 tip，界面与记忆按新旧路径的差异同步
+- StreamLimiter: 全局并发上限，FIFO 排队保证各会话公平轮到
+"""
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from config.settings import ENABLE_WEB_SEARCH
+from .gemini_service import GeminiService
+from .zhipu_service import ZhipuService
+from .router import router, provider_of, PRIMARY_PROVIDER
+from .cancel import CancelToken, StreamCancelled
+from utils.code_index import CodeIndex
+from utils.markdown_stream import MarkdownStream, parse_blocks
+
+
+@dataclass
+class MessageRecord:
+    """一条消息的数据 (与是否挂载组件无关)"""
+    role: str                   # user / ai / system / compare
+    content: str = ""
+    model: str = ""
+    state: str = "done"         # streaming / done / error / cancelled
+    turn: int = 0               # 所属轮次 id (用户消息与 AI 回答共用，0 = 不属于任何轮次)
+    # 当前挂载的气泡组件 (只有活动标签页才有)，不属于会话数据
+    bubble: object = field(default=None, repr=False, compare=False)
+    # 附加数据 (如 /compare 的 CompareRun)
+    payload: object = field(default=None, repr=False, compare=False)
+    # AI 回答的流式 Markdown 分块器 (渲染与代码块索引共同订阅)
+    md_stream: MarkdownStream | None = field(default=None, repr=False, compare=False)
+
+
+# 每个服务保留的历史条数 (最近 20 轮，与服务层截断一致)
+MAX_HISTORY_MESSAGES = 40
+
+
+@dataclass(eq=False)
+class Turn:
+    """对话树节点：一轮对话 + 父节点 + 该轮写入服务历史的条目
+
+    节点之间的结构创建后不再修改 (删除中间轮次时复制其后的路径)，
+    多个分支可以安全地共享同一段前缀。
+    """
+    id: int
+    user: MessageRecord
+    ai: MessageRecord
+    parent: "Turn | None" = None
+    service: str = ""   # 历史所在服务 (zhipu / gemini)，空 = 未进入历史 (出错 / 生成中)
+    history: list[tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def records(self) -> tuple[MessageRecord, MessageRecord]:
+        return self.user, self.ai
+
+    def path(self) -> list["Turn"]:
+        """根 -> 本节点"""
+        nodes = []
+        node = self
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        nodes.reverse()
+        return nodes
+
+    def rebased(self, parent: "Turn | None") -> "Turn":
+        """换父节点的副本 (记录与历史条目共享)"""
+        return Turn(self.id, self.user, self.ai, parent, self.service, self.history)
+
+
+def path_of(tip: Turn | None) -> list[Turn]:
+    return tip.path() if tip is not None else []
+
+
+@dataclass(eq=False)
+class Branch:
+    """对话分支：指向最后一轮的指针"""
+    name: str
+    tip: Turn | None = None
+    # 撤销 / 删除前的 tip，/redo 从栈顶恢复
+    redo: list[Turn | None] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(path_of(self.tip))
+
+
+@dataclass
+class PathChange:
+    """切换路径后的差异：需要卸载 / 挂载气泡的轮次"""
+    removed: list[Turn]
+    added: list[Turn]
+
+
+class ChatSession:
+    """单个聊天会话 (对应一个标签页)"""
+
+    def __init__(self, session_id: int, title: str = ""):
+        self.id = session_id
+        self.title = title or f"会话 {session_id}"
+
+        # 每个会话独立的服务实例 (各自持有历史)，底层客户端 / 连接池全局共享
+        self.zhipu_service = ZhipuService(enable_web_search=ENABLE_WEB_SEARCH)
+        self.gemini_service = GeminiService()
+
+        # 用户所选模型 (路由首选)；默认为主服务当前评分最好的模型 (智谱即剩余赠送额度最多的)
+        self.current_model = router.best(PRIMARY_PROVIDER)
+        self.routed_model = self.current_model  # 上一轮实际使用的模型 (路由变化时提示)
+        self.messages: list[MessageRecord] = []
+        self.queue: list[str] = []  # 生成期间提交的待发送问题
+        self.turn_count = 0
+        self.branches: list[Branch] = [Branch("main")]
+        self.branch = self.branches[0]  # 当前分支
+        self.code_index = CodeIndex()  # 整个会话的代码块索引 (随流式增量更新)
+        self.total_tokens = 0
+        self.tokens_avoided = 0  # 中断生成省下的 token (估算)
+        self.worker = None  # 在途的流式 Worker
+        self.cancel_token: CancelToken | None = None
+
+    @property
+    def tab_id(self) -> str:
+        return f"session-{self.id}"
+
+    # ============== 轮次 (撤销 / 重做 / 删除) ==============
+
+    @property
+    def turns(self) -> dict[int, Turn]:
+        """当前分支的各轮 (id -> 节点，旧 -> 新)"""
+        return {turn.id: turn for turn in path_of(self.branch.tip)}
+
+    def new_turn(self, user_input: str, model: str) -> Turn:
+        """在当前分支末尾开始新一轮 (新的提问使重做栈失效)"""
+        self.turn_count += 1
+        turn = Turn(
+            self.turn_count,
+            MessageRecord("user", user_input, turn=self.turn_count),
+            MessageRecord("ai", model=model, state="streaming", turn=self.turn_count),
+            parent=self.branch.tip,
+        )
+        self.branch.tip = turn
+        self.branch.redo.clear()
+        return turn
+
+    def commit_turn(self, turn_id: int, service) -> None:
+        """流结束后记录该轮写入的历史条目 (Worker 线程；生成期间不允许切换分支)"""
+        turn = self.turns.get(turn_id)
+        if turn is not None:
+            turn.service = "zhipu" if service is self.zhipu_service else "gemini"
+            turn.history = service.get_history()[-2:]
+
+    def remove_turn(self, turn_id: int, undoable: bool = True) -> PathChange | None:
+        """从当前分支移除一轮 (其后各轮复制到新路径上，旧路径仍可 /redo 或被其他分支共享)"""
+        path = path_of(self.branch.tip)
+        idx = next((i for i, turn in enumerate(path) if turn.id == turn_id), None)
+        if idx is None:
+            return None
+        tip = path[idx - 1] if idx else None
+        for turn in path[idx + 1:]:
+            tip = turn.rebased(tip)
+        if undoable:
+            self.branch.redo.append(self.branch.tip)
+        return self._move_tip(tip)
+
+    def restore_turn(self) -> PathChange | None:
+        """恢复最近一次撤销 / 删除前的路径"""
+        if not self.branch.redo:
+            return None
+        return self._move_tip(self.branch.redo.pop())
+
+    def _move_tip(self, tip: Turn | None) -> PathChange:
+        change = self._apply_path(self.branch.tip, tip)
+        self.branch.tip = tip
+        return change
+
+    def _apply_path(self, old_tip: Turn | None, new_tip: Turn | None) -> PathChange:
+        """按新旧路径的差异同步消息列表与代码块索引，并重建服务历史"""
+        old_path, new_path = path_of(old_tip), path_of(new_tip)
+        # 复制出的节点与原节点共享记录：按记录判断是否为同一轮
+        old_users = {id(turn.user) for turn in old_path}
+        new_users = {id(turn.user) for turn in new_path}
+        removed = [turn for turn in old_path if id(turn.user) not in new_users]
+        added = [turn for turn in new_path if id(turn.user) not in old_users]
+
+        if removed:
+            # /clear 后记录可能已不在消息列表中
+            dropped = {id(record) for turn in removed for record in turn.records}
+            self.messages = [m for m in self.messages if id(m) not in dropped]
+            for turn in removed:
+                self.code_index.drop_turn(turn.id)
+        for turn in added:
+            # 插到后续轮次的消息之前 (没有则放到最后)
+            idx = next(
+                (i for i, m in enumerate(self.messages) if m.turn > turn.id),
+                len(self.messages),
+            )
+            self.messages[idx:idx] = list(turn.records)
+            if turn.ai.state != "error":
+                self.code_index.restore_turn(turn.id, parse_blocks(turn.ai.content))
+        if removed or added:
+            for name in ("zhipu", "gemini"):
+                self.rebuild_history(name, new_tip)
+        return PathChange(removed, added)
+
+    def next_turn_record(self, turn: Turn) -> MessageRecord | None:
+        """该轮之后第一条属于后续轮次的消息 (恢复时气泡挂在它之前)"""
+        for record in self.messages:
+            if record.turn > turn.id:
+                return record
+        return None
+
+    def history_for(self, tip: Turn | None) -> list[tuple[str, str]]:
+        """任一分支的对话历史 (沿共享节点拼出，不复制整段对话；各轮由哪个服务回答都计入)"""
+        history = [entry for turn in path_of(tip) for entry in turn.history]
+        return history[-MAX_HISTORY_MESSAGES:]
+
+    def rebuild_history(self, service_name: str, tip: Turn | None = None) -> None:
+        """按当前 (或指定) 路径重建某个服务的对话历史"""
+        service = self.zhipu_service if service_name == "zhipu" else self.gemini_service
+        service.set_history(self.history_for(tip if tip is not None else self.branch.tip))
+
+    def prepare_turn(self, turn_id: int, model: str):
+        """Worker 线程：路由到的服务若没回答上一轮 (历史缺了别的服务的轮次)，先按路径补齐历史"""
+        turn = self.turns.get(turn_id)
+        provider = provider_of(model)
+        if turn is not None and turn.parent is not None and turn.parent.service != provider:
+            self.rebuild_history(provider, turn.parent)
+        return self.service_for(model)
+
+    def reset_history(self) -> None:
+        """清空记忆 (两个服务的历史、全部分支、代码块索引)"""
+        self.zhipu_service.clear_history()
+        self.gemini_service.clear_history()
+        self.branches = [Branch("main")]
+        self.branch = self.branches[0]
+        self.code_index = CodeIndex()
+
+    # ============== 分支 ==============
+
+    def find_branch(self, key: str) -> Branch | None:
+        """按序号 (从 1 开始) 或名称查找分支"""
+        if key.isdigit() and 1 <= int(key) <= len(self.branches):
+            return self.branches[int(key) - 1]
+        return next((b for b in self.branches if b.name == key), None)
+
+    def fork(self, at: Turn | None, name: str = "") -> Branch:
+        """从某个节点分叉出新分支 (只新增一个指针，前缀与原分支共享)"""
+        if not name:
+            number = len(self.branches) + 1
+            while self.find_branch(f"branch-{number}"):
+                number += 1
+            name = f"branch-{number}"
+        branch = Branch(name, at)
+        self.branches.append(branch)
+        return branch
+
+    def switch_branch(self, branch: Branch) -> PathChange:
+        change = self._apply_path(self.branch.tip, branch.tip)
+        self.branch = branch
+        return change
+
+    def delete_branch(self, branch: Branch) -> None:
+        """删除分支指针 (只被它引用的节点随之释放)"""
+        self.branches.remove(branch)
+
+    @staticmethod
+    def diverge(a: Branch, b: Branch) -> tuple[list[Turn], list[Turn], list[Turn]]:
+        """两个分支的公共前缀与各自独有的轮次"""
+        path_a, path_b = path_of(a.tip), path_of(b.tip)
+        common = 0
+        while common < min(len(path_a), len(path_b)) and path_a[common].user is path_b[common].user:
+            common += 1
+        return path_a[:common], path_a[common:], path_b[common:]
+
+    # ============== 序列化 (开发模式重启时保留会话) ==============
+
+    def to_state(self) -> dict:
+        """导出可 JSON 序列化的会话数据 (在途回答按中断保存，对比视图不保留)"""
+        messages = [self._record_state(record) for record in self.messages if record.role != "compare"]
+        return {
+            "id": self.id,
+            "title": self.title,
+            "current_model": self.current_model,
+            "routed_model": self.routed_model,
+            "turn_count": self.turn_count,
+            "total_tokens": self.total_tokens,
+            "tokens_avoided": self.tokens_avoided,
+            "queue": list(self.queue),
+            "messages": messages,
+            **self._tree_state(),
+        }
+
+    @staticmethod
+    def _record_state(record: MessageRecord) -> dict:
+        state = "cancelled" if record.state == "streaming" else record.state
+        return {"role": record.role, "content": record.content,
+                "model": record.model, "state": state, "turn": record.turn}
+
+    def _tree_state(self) -> dict:
+        """对话树：各分支可达的节点按父节点在前的顺序编号 (重做栈不保留)"""
+        keys: dict[int, int] = {}
+        nodes = []
+        for branch in self.branches:
+            for turn in path_of(branch.tip):
+                if id(turn) in keys:
+                    continue
+                keys[id(turn)] = len(nodes)
+                nodes.append({
+                    "id": turn.id,
+                    "parent": keys[id(turn.parent)] if turn.parent is not None else None,
+                    "user": self._record_state(turn.user),
+                    "ai": self._record_state(turn.ai),
+                    "service": turn.service,
+                    "history": turn.history,
+                })
+        return {
+            "nodes": nodes,
+            "branches": [
+                {"name": b.name, "tip": keys[id(b.tip)] if b.tip is not None else None}
+                for b in self.branches
+            ],
+            "branch": self.branches.index(self.branch),
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "ChatSession":
+        """按 to_state() 的数据重建会话 (代码块索引从回答内容重新分块)"""
+        session = cls(state["id"], state["title"])
+        session.current_model = state["current_model"]
+        session.routed_model = state.get("routed_model", session.current_model)
+        session.turn_count = state["turn_count"]
+        session.total_tokens = state["total_tokens"]
+        session.tokens_avoided = state["tokens_avoided"]
+        session.queue = list(state["queue"])
+        session.messages = [MessageRecord(**data) for data in state["messages"]]
+        # 同一轮 (含路径复制出的节点) 共用一份记录，消息列表里的记录就是树节点的记录
+        records = {(m.turn, m.role): m for m in session.messages if m.turn}
+        nodes: list[Turn] = []
+        for data in state["nodes"]:
+            user = records.setdefault((data["id"], "user"), MessageRecord(**data["user"]))
+            ai = records.setdefault((data["id"], "ai"), MessageRecord(**data["ai"]))
+            parent = nodes[data["parent"]] if data["parent"] is not None else None
+            history = [tuple(entry) for entry in data["history"]]
+            nodes.append(Turn(data["id"], user, ai, parent, data["service"], history))
+        session.branches = [
+            Branch(b["name"], nodes[b["tip"]] if b["tip"] is not None else None)
+            for b in state["branches"]
+        ]
+        session.branch = session.branches[state["branch"]]
+        for name in ("zhipu", "gemini"):
+            session.rebuild_history(name)
+        for record in session.messages:
+            if record.role == "ai" and record.state != "error":
+                for block in parse_blocks(record.content):
+                    session.code_index.add_block(record.turn, block)
+        return session
+
+    @property
+    def is_streaming(self) -> bool:
+        return self.worker is not None
+
+    def service_for(self, model: str):
+        """模型所属服务的实例"""
+        return self.zhipu_service if provider_of(model) == "zhipu" else self.gemini_service
+
+    @property
+    def active_service(self):
+        """用户所选模型的服务"""
+        return self.service_for(self.current_model)
+
+    @property
+    def service_name(self) -> str:
+        """获取当前服务名称"""
+        return "智谱 GLM" if provider_of(self.current_model) == "zhipu" else "Gemini"
+
+
+class StreamLimiter:
+    """全局流式并发上限 - 先到先得，排队中的会话按提交顺序依次放行"""
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self._active = 0
+        self._waiters: deque = deque()
+        self._cond = threading.Condition()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @contextmanager
+    def slot(self, cancel: CancelToken | None = None):
+        """占用一个并发名额 (阻塞直到轮到自己；排队中被取消则抛出 StreamCancelled)"""
+        ticket = object()
+        with self._cond:
+            self._waiters.append(ticket)
+            while self._waiters[0] is not ticket or self._active >= self.limit:
+                if cancel is not None and cancel.cancelled:
+                    self._waiters.remove(ticket)
+                    self._cond.notify_all()
+                    raise StreamCancelled()
+                # 有取消令牌时定期醒来检查
+                self._cond.wait(0.1 if cancel is not None else None)
+            self._waiters.popleft()
+            self._active += 1
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
@@ -1,13 +1,23 @@
 """
 智谱 API 服务层
-支持联网搜索，优先使用赠送额度
+支持联网搜索，优先使用赠送额度 (用量记入额度账本)
 """
+import time
+
 from core.zhipu_client import get_zhipu_client
-from config.settings import SYSTEM_INSTRUCTION
-from utils.logger import get_logger
+from config.settings import SYSTEM_INSTRUCTION, ZHIPU_MODELS, DEFAULT_ZHIPU_MODEL, STREAM_MAX_ATTEMPTS
+from utils.logger import get_logger, request_scoped
+from utils.tracing import tracer
+from .cancel import CancelToken, TRUNCATED_MARK
+from .quota import quota_ledger, key_id
+from .retry import CONTINUE_PROMPT, resumable_stream
+from .router import router
 
 logger = get_logger("zhipu_service")
 
+# 服务端报告额度用尽的错误特征 (1113: 余额不足或无可用资源包)
+EXHAUSTED_MARKERS = ("1113", "余额不足", "欠费", "资源包")
+
 
 class ZhipuService:
     """智谱 API 服务 - 联网搜索 + 赠送额度优先"""
@@ -16,8 +26,10 @@ class ZhipuService:
         self._client = None
         self._history = []
         self._enable_web_search = enable_web_search
-        # 默认使用赠送额度最多的模型
-        self._model = "glm-4.6v"  # 赠送 600万 tokens
+        # 未指定模型时的默认模型 (会话按剩余额度自动选择后传入 model_name)
+        self._model = DEFAULT_ZHIPU_MODEL
+        # 上一次请求的 token 用量 (优先取 API 返回值，缺失时为估算)
+        self.last_usage: dict | None = None
 
     @property
     def client(self):
@@ -36,17 +48,29 @@ class ZhipuService:
 
     def set_model(self, model: str):
         """切换模型"""
-        if hasattr(self.client, "MODELS") and model in self.client.MODELS:
+        if model in ZHIPU_MODELS:
             self._model = model
-            model_info = self.client.MODELS[model]
-            logger.info(f"智谱模型: {model_info['name']} ({model_info['desc']})")
+            model_info = ZHIPU_MODELS[model]
+            logger.info("智谱模型: %s (%s)", model_info['name'], model_info['desc'])
             return True
         return False
 
+    @property
+    def key_id(self) -> str:
+        """当前 Key 的指纹 (额度账本按 模型 + Key 记账)"""
+        return key_id(getattr(self.client, "api_key", ""))
+
     def get_history(self):
         """获取当前历史"""
         return [(msg["role"], msg["content"]) for msg in self._history]
 
+    def set_history(self, history):
+        """载入 (role, text) 历史 (可来自 Gemini，角色自动转换)"""
+        self._history = [
+            {"role": "assistant" if role in ("model", "assistant") else "user", "content": text}
+            for role, text in history
+        ]
+
     def _build_tools(self):
         """构建工具列表（联网搜索）"""
         if not self._enable_web_search:
@@ -79,8 +103,11 @@ class ZhipuService:
         messages.append({"role": "user", "content": user_message})
         return messages
 
-    def stream_chat_sync(self, message: str, model_name: str = None):
-        """同步流式聊天"""
+    def stream_chat_sync(self, message: str, model_name: str = None, cancel: CancelToken | None = None):
+        """同步流式聊天 (cancel 被触发时关闭 HTTP 流，保留已生成的部分)"""
+        return request_scoped(self._stream_chat(message, model_name, cancel))
+
+    def _stream_chat(self, message: str, model_name: str = None, cancel: CancelToken | None = None):
         if not self.is_available:
             error_detail = ""
             try:
@@ -89,63 +116,123 @@ class ZhipuService:
                     error_detail = f" ({self.client._init_error})"
             except:
                 pass
+            router.fail(model_name or self._model, f"不可用{error_detail}")
             raise RuntimeError(f"智谱 API 不可用{error_detail}，请检查 ZHIPU_API_KEY 配置")
 
         model = model_name or self._model
-        logger.info(f"智谱请求: model={model}, len={len(message)}, web_search={self._enable_web_search}")
+        started = time.perf_counter()
+        first_chunk_at = None
+        logger.info("智谱请求: model=%s, len=%d, web_search=%s", model, len(message), self._enable_web_search)
 
-        messages = self._convert_history_to_messages(message)
-        tools = self._build_tools()
+        with tracer.span("service.build_payload", turns=len(self._history) // 2):
+            messages = self._convert_history_to_messages(message)
+            tools = self._build_tools()
 
         full_response = ""
+        # 每次尝试的用量 (中途断开的尝试拿不到 usage，按收到的字数估算)
+        attempts: list[dict] = []
+
+        def open_stream(partial: str, attempt: int):
+            """发起一次请求；partial 非空时是续写请求 (已输出部分作为上一条模型回答)"""
+            request = messages if not partial else messages + [
+                {"role": "assistant", "content": partial},
+                {"role": "user", "content": CONTINUE_PROMPT},
+            ]
+            stats = {"usage": None, "chars": 0}
+            attempts.append(stats)
+            with tracer.span("service.sdk_call", provider="zhipu", attempt=attempt, resumed=len(partial)):
+                response = self.client.chat.completions.create(
+                    model=model,
+                    messages=request,
+                    tools=tools,
+                    stream=True,
+                    temperature=0.7,
+                )
+            if cancel is not None:
+                # 直接关闭底层 HTTP 响应：阻塞中的读取立即返回，连接归还连接池
+                cancel.on_cancel(response.response.close)
+            try:
+                for chunk in response:
+                    if cancel is not None and cancel.cancelled:
+                        break
+                    # 最后一个 chunk 携带本次真实用量
+                    if getattr(chunk, "usage", None):
+                        stats["usage"] = chunk.usage
+                    if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
+                        delta = chunk.choices[0].delta
+                        if hasattr(delta, 'content') and delta.content:
+                            stats["chars"] += len(delta.content)
+                            yield delta.content
+            finally:
+                if cancel is not None:
+                    cancel.clear_callbacks()
 
         try:
-            # 智谱流式调用
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                tools=tools,
-                stream=True,
-                temperature=0.7,
-            )
-
-            for chunk in response:
-                if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
-                    delta = chunk.choices[0].delta
-                    if hasattr(delta, 'content') and delta.content:
-                        content_text = delta.content
-                        full_response += content_text
-                        yield content_text
+            # 智谱流式调用 (中途断开时从断点续写)
+            for content_text in resumable_stream(open_stream, cancel, STREAM_MAX_ATTEMPTS, "智谱"):
+                if content_text.startswith("__RECONNECTING__:"):
+                    yield content_text
+                    continue
+                if first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+                    tracer.instant("service.first_chunk")
+                full_response += content_text
+                yield content_text
 
         except Exception as e:
-            logger.error(f"智谱 API 失败: {str(e)}")
+            logger.error("智谱 API 失败: %s", e)
+            router.fail(model, e)
+            if any(marker in str(e) for marker in EXHAUSTED_MARKERS):
+                quota_ledger.mark_exhausted(model, self.key_id)
             raise RuntimeError(f"智谱 API 调用失败: {str(e)}")
 
-        # 更新历史
+        cancelled = cancel is not None and cancel.cancelled
+        if cancelled:
+            logger.info("智谱请求已中断: 已生成 %d 字", len(full_response))
+
+        # 更新历史 (中断的回答保留已生成部分并标记截断)
         self._history.append({"role": "user", "content": message})
-        self._history.append({"role": "assistant", "content": full_response})
+        self._history.append({
+            "role": "assistant",
+            "content": full_response + TRUNCATED_MARK if cancelled else full_response,
+        })
 
         # 限制历史长度 (保留最近 20 轮)
         if len(self._history) > 40:
             self._history = self._history[-40:]
 
-        # Token 估算（0.7 token/char）
-        prompt_tokens = max(1, int(len(message) * 0.7))
-        output_tokens = max(1, int(len(full_response) * 0.7))
+        # Token 统计：优先使用 API 返回的用量，否则估算（0.7 token/char）；续写的各次尝试累加
+        prompt_tokens = output_tokens = 0
+        estimated = False
+        for stats in attempts:
+            usage = stats["usage"]
+            if usage is not None and getattr(usage, "completion_tokens", None):
+                prompt_tokens += usage.prompt_tokens or 0
+                output_tokens += usage.completion_tokens
+            else:
+                prompt_tokens += max(1, int(len(message) * 0.7))
+                output_tokens += int(stats["chars"] * 0.7)
+                estimated = True
+        output_tokens = max(1, output_tokens)
         turn_tokens = prompt_tokens + output_tokens
-
-        logger.info(f"智谱响应: in={prompt_tokens}, out={output_tokens}")
+        self.last_usage = {
+            "input_tokens": prompt_tokens, "output_tokens": output_tokens,
+            "estimated": estimated, "cancelled": cancelled,
+        }
+        quota_ledger.record(model, self.key_id, prompt_tokens, output_tokens, estimated)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        ttft_ms = (first_chunk_at - started) * 1000 if first_chunk_at else None
+        logger.info(
+            "智谱响应: in=%d, out=%d", prompt_tokens, output_tokens,
+            extra={"model": model, "elapsed_ms": round(elapsed_ms, 1),
+                   "ttft_ms": round(ttft_ms, 1) if ttft_ms else None},
+        )
+        if not cancelled or ttft_ms is not None:
+            router.observe(model, ttft_ms, elapsed_ms, output_tokens, complete=not cancelled)
         yield f"__TOKEN_STATS__:{turn_tokens}"
 
     def clear_history(self):
         """清空对话历史"""
         logger.info("清空智谱对话历史")
         self._history = []
-
-    def undo_last_turn(self) -> bool:
-        """撤销上一轮对话"""
-        if len(self._history) >= 2:
-            self._history.pop()
-            self._history.pop()
-            return True
-        return False
@@ -1,7 +1,13 @@
 # Utils module
 # 原有模块已移至 /参考代码 文件夹
 
-from .logger import get_logger, debug, info, warning, error, exception
+from .logger import (
+    get_logger, debug, info, warning, error, exception,
+    request_context, request_scoped, new_request_id, current_request_id, shutdown_logging,
+)
 
-__all__ = ["get_logger", "debug", "info", "warning", "error", "exception"]
+__all__ = [
+    "get_logger", "debug", "info", "warning", "error", "exception",
+    "request_context", "request_scoped", "new_request_id", "current_request_id", "shutdown_logging",
+]
 
@@ -0,0 +1,142 @@
+"""
+代码块索引 - 订阅流式 Markdown 分块器的代码块事件
+- 围栏识别由 utils.markdown_stream 完成，这里不再扫描文本
+- 记录语言 / 所属轮次 / 字节偏移 / sha1，覆盖整个会话
+- 按编号、按语言 O(1) 定位；内容相同的代码块只索引一次
+"""
+import hashlib
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from utils.markdown_stream import MdBlock
+
+# 语言 -> 文件扩展名
+EXTENSIONS = {
+    "python": "py", "py": "py", "python3": "py",
+    "javascript": "js", "js": "js", "jsx": "jsx", "typescript": "ts", "ts": "ts", "tsx": "tsx",
+    "bash": "sh", "sh": "sh", "shell": "sh", "zsh": "sh", "console": "sh",
+    "powershell": "ps1", "ps1": "ps1", "pwsh": "ps1", "bat": "bat", "cmd": "bat",
+    "json": "json", "jsonl": "jsonl", "yaml": "yaml", "yml": "yaml", "toml": "toml", "ini": "ini",
+    "html": "html", "xml": "xml", "css": "css", "tcss": "tcss", "scss": "scss",
+    "sql": "sql", "go": "go", "rust": "rs", "rs": "rs", "c": "c", "h": "h",
+    "cpp": "cpp", "c++": "cpp", "csharp": "cs", "cs": "cs", "java": "java", "kotlin": "kt",
+    "swift": "swift", "ruby": "rb", "rb": "rb", "php": "php", "lua": "lua", "r": "r",
+    "markdown": "md", "md": "md", "dockerfile": "dockerfile", "makefile": "mk", "diff": "diff",
+}
+
+
+def extension_for(lang: str) -> str:
+    return EXTENSIONS.get(lang.lower(), "txt")
+
+
+@dataclass
+class CodeBlock:
+    """一个已闭合 (或随回答中断) 的代码块"""
+    number: int             # 会话内编号 (从 1 开始)
+    lang: str
+    turn: int               # 所属对话轮次
+    start: int              # 代码块 (含围栏) 在该轮回答中的 UTF-8 字节偏移
+    end: int
+    sha1: str
+    code: str
+    complete: bool = True   # False = 回答中断时围栏未闭合
+
+    @property
+    def extension(self) -> str:
+        return extension_for(self.lang)
+
+
+@dataclass
+class CodeIndex:
+    """会话级代码块索引"""
+    blocks: list[CodeBlock] = field(default_factory=list)
+    by_lang: dict[str, list[CodeBlock]] = field(default_factory=dict)
+    by_hash: dict[str, CodeBlock] = field(default_factory=dict)
+
+    # ============== 流式输入 ==============
+
+    def add_block(self, turn: int, block: MdBlock) -> CodeBlock | None:
+        """Markdown 块闭合事件：只索引代码块，返回新索引的代码块"""
+        if block.kind != "code" or not block.code.strip():
+            return None
+        digest = hashlib.sha1(block.code.encode("utf-8")).hexdigest()
+        if digest in self.by_hash:
+            return None  # 重复代码块只保留第一次出现
+        code_block = CodeBlock(
+            len(self.blocks) + 1, block.lang, turn, block.start, block.end,
+            digest, block.code, block.complete,
+        )
+        self.blocks.append(code_block)
+        self.by_lang.setdefault(block.lang or "text", []).append(code_block)
+        self.by_hash[digest] = code_block
+        return code_block
+
+    # ============== 查询 ==============
+
+    def get(self, number: int) -> CodeBlock | None:
+        if 1 <= number <= len(self.blocks):
+            return self.blocks[number - 1]
+        return None
+
+    def last_turn_blocks(self) -> list[CodeBlock]:
+        """最近一轮含代码的回答中的代码块"""
+        if not self.blocks:
+            return []
+        turn = self.blocks[-1].turn
+        return [b for b in self.blocks if b.turn == turn]
+
+    def drop_turn(self, turn: int) -> None:
+        """撤销某一轮：移除其代码块并重新编号"""
+        kept = [b for b in self.blocks if b.turn != turn]
+        if len(kept) != len(self.blocks):
+            self._rebuild(kept)
+
+    def restore_turn(self, turn: int, blocks: list[MdBlock]) -> None:
+        """重做某一轮：按轮次顺序插回其代码块并重新编号"""
+        self.drop_turn(turn)
+        restored = [
+            CodeBlock(0, b.lang, turn, b.start, b.end,
+                      hashlib.sha1(b.code.encode("utf-8")).hexdigest(), b.code, b.complete)
+            for b in blocks if b.kind == "code" and b.code.strip()
+        ]
+        if restored:
+            self._rebuild(sorted(self.blocks + restored, key=lambda b: (b.turn, b.start)))
+
+    def _rebuild(self, blocks: list[CodeBlock]) -> None:
+        self.blocks, self.by_lang, self.by_hash = [], {}, {}
+        for block in blocks:
+            if block.sha1 in self.by_hash:
+                continue  # 重复代码块只保留第一次出现
+            block.number = len(self.blocks) + 1
+            self.blocks.append(block)
+            self.by_lang.setdefault(block.lang or "text", []).append(block)
+            self.by_hash[block.sha1] = block
+
+    # ============== 导出 ==============
+
+    @staticmethod
+    def save(blocks: list[CodeBlock], directory: str | Path) -> tuple[list[Path], int]:
+        """每个代码块写一个文件；目录中已有相同内容的文件则跳过。返回 (写入的文件, 跳过数)"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        existing = set()
+        for path in directory.iterdir():
+            if path.is_file():
+                try:
+                    existing.add(hashlib.sha1(path.read_bytes()).hexdigest())
+                except OSError:
+                    continue
+
+        written, skipped = [], 0
+        for block in blocks:
+            data = (block.code + "\n").encode("utf-8")
+            digest = hashlib.sha1(data).hexdigest()
+            if digest in existing:
+                skipped += 1
+                continue
+            name = f"block_{block.number:02d}_turn{block.turn}_{block.sha1[:6]}.{block.extension}"
+            path = directory / name
+            path.write_bytes(data)
+            existing.add(digest)
+            written.append(path)
+        return written, skipped
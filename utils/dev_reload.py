@@ -0,0 +1,186 @@
+"""
+开发模式热重载 - dev.py 与应用进程之间的约定
+- dev.py 监控文件 (按内容哈希判断是否真的变了)，把变更分类后写入命令文件
+- 应用进程 (DEV_HOT_RELOAD=1) 轮询命令文件：
+  css      -> 重新读取样式表并 refresh_css
+  widgets  -> 进程内重载气泡组件模块，按会话数据重建消息区
+  restart  -> 保存会话状态到 .dev/，以退出码 3 退出，由 dev.py 重新拉起后恢复
+"""
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+DEV_DIR = PROJECT_DIR / ".dev"
+COMMAND_FILE = DEV_DIR / "command.json"
+STATE_FILE = DEV_DIR / "session.json"
+FIRST_PAINT_FILE = DEV_DIR / "first_paint.json"
+
+# 应用请求 dev.py 重启时使用的退出码
+RESTART_EXIT_CODE = 3
+ENV_FLAG = "DEV_HOT_RELOAD"
+# dev.py 触发重启的时刻 (time.time())，应用首帧后据此计算重启耗时
+RESTART_AT_ENV = "DEV_RESTART_AT"
+
+# 可在进程内重载的模块：其组件实例都能从会话数据重建 (消息区整体重新挂载)
+HOT_MODULES = {
+    "widgets/glitch_label.py": "widgets.glitch_label",
+    "widgets/compare_view.py": "widgets.compare_view",
+}
+# 样式与风味变量：直接重新应用
+CSS_SUFFIXES = {".tcss", ".css"}
+CSS_FILES = {"styles/flavors.json"}
+
+
+def is_dev_mode() -> bool:
+    return os.environ.get(ENV_FLAG) == "1"
+
+
+def content_hash(path: Path) -> str | None:
+    """文件内容哈希 (文件不存在 / 读失败时返回 None)"""
+    try:
+        return hashlib.sha1(path.read_bytes()).hexdigest()
+    except OSError:
+        return None
+
+
+def classify(paths: list[str]) -> str:
+    """变更分类：css / widgets / restart (取代价最高的一类)"""
+    kinds = set()
+    for rel in paths:
+        if rel in CSS_FILES or Path(rel).suffix in CSS_SUFFIXES:
+            kinds.add("css")
+        elif rel in HOT_MODULES:
+            kinds.add("widgets")
+        else:
+            kinds.add("restart")
+    for kind in ("restart", "widgets", "css"):
+        if kind in kinds:
+            return kind
+    return "css"
+
+
+# ============== 命令通道 ==============
+
+def _write_json(path: Path, data) -> None:
+    """原子写入 (避免对方读到半个文件)"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def send_command(seq: int, action: str, paths: list[str]) -> None:
+    """dev.py 侧：发出一条命令"""
+    _write_json(COMMAND_FILE, {"seq": seq, "action": action, "paths": paths})
+
+
+class CommandReader:
+    """应用侧：只处理启动后新写入的命令 (先比较 mtime，不变时不读文件)"""
+
+    def __init__(self):
+        self._mtime = self._stat()
+        self._seq = None
+        command = self._read()
+        if command:
+            self._seq = command.get("seq")  # 启动前的旧命令不再执行
+
+    @staticmethod
+    def _stat() -> float:
+        try:
+            return COMMAND_FILE.stat().st_mtime
+        except OSError:
+            return 0.0
+
+    @staticmethod
+    def _read() -> dict | None:
+        try:
+            return json.loads(COMMAND_FILE.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def poll(self) -> dict | None:
+        mtime = self._stat()
+        if mtime == self._mtime:
+            return None
+        self._mtime = mtime
+        command = self._read()
+        if not command or command.get("seq") == self._seq:
+            return None
+        self._seq = command.get("seq")
+        return command
+
+
+# ============== 模块重载 ==============
+
+def reload_modules(names: list[str]) -> list[str]:
+    """重载模块，并把其他项目模块里通过 from-import 持有的旧类 / 函数换成新的"""
+    replaced: dict[int, tuple[str, str]] = {}
+    keep_alive = []  # 旧对象在替换完成前不能被回收 (否则 id 可能被复用)
+    reloaded = []
+    for name in names:
+        module = sys.modules.get(name)
+        if module is None:
+            continue
+        before = {
+            attr: value for attr, value in vars(module).items()
+            if getattr(value, "__module__", None) == name
+        }
+        keep_alive.append(before)
+        importlib.reload(module)
+        for attr, value in before.items():
+            replaced[id(value)] = (name, attr)
+        reloaded.append(name)
+
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if not path or not Path(path).resolve().is_relative_to(PROJECT_DIR):
+            continue
+        for attr, value in list(vars(module).items()):
+            target = replaced.get(id(value))
+            if target is not None:
+                name, new_attr = target
+                setattr(module, attr, getattr(sys.modules[name], new_attr, value))
+    return reloaded
+
+
+# ============== 会话状态 ==============
+
+def save_state(state: dict) -> None:
+    _write_json(STATE_FILE, state)
+
+
+def load_state() -> dict | None:
+    """读取并删除上次保存的会话状态 (只恢复一次)"""
+    try:
+        state = json.loads(STATE_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    try:
+        STATE_FILE.unlink()
+    except OSError:
+        pass
+    return state
+
+
+# ============== 重启耗时 ==============
+
+def record_first_paint() -> float | None:
+    """应用首帧绘制后调用：返回并记录从触发重启到首帧的毫秒数"""
+    started = os.environ.get(RESTART_AT_ENV)
+    if not started:
+        return None
+    elapsed_ms = (time.time() - float(started)) * 1000
+    _write_json(FIRST_PAINT_FILE, {"restart_at": float(started), "first_paint_ms": round(elapsed_ms, 1)})
+    return elapsed_ms
+
+
+def read_first_paint() -> dict | None:
+    try:
+        return json.loads(FIRST_PAINT_FILE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,133 @@
+"""
+代码高亮缓存 - 按 (代码哈希, 词法器, 主题, 宽度) 缓存高亮结果
+- 词法器查找结果做记忆化，不再每次按语言名重新搜索 Pygments
+- LRU 上限，气泡重渲染 / 切换标签页恢复时直接命中
+- 线程安全：大代码块可在工作线程中高亮
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from rich.cells import cell_len
+from rich.console import Console
+from rich.syntax import Syntax
+from rich.text import Text
+
+# 缓存条目上限
+CACHE_SIZE = 256
+# 超过该行数的代码块放到工作线程高亮
+LARGE_BLOCK_LINES = 300
+DEFAULT_THEME = "monokai"
+
+_local = threading.local()
+
+
+@lru_cache(maxsize=128)
+def lexer_for(lang: str):
+    """语言名 -> Pygments 词法器 (记忆化；未知语言返回纯文本词法器)"""
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    try:
+        return get_lexer_by_name(lang or "text")
+    except ClassNotFound:
+        return get_lexer_by_name("text")
+
+
+def _console(width: int) -> Console:
+    """每个线程一个离屏 Console (Console 渲染不是线程安全的)"""
+    console = getattr(_local, "console", None)
+    if console is None or console.width != width:
+        console = _local.console = Console(force_terminal=True, width=width, no_color=False)
+    return console
+
+
+def _render(code: str, lexer, theme: str, width: int) -> Text:
+    """按 Rich Markdown 代码块的样式渲染 (padding=1，自动换行)"""
+    syntax = Syntax(code, lexer, theme=theme, word_wrap=True, padding=1)
+    rendered = Text()
+    for segment in _console(width).render(syntax):
+        if segment.text:
+            rendered.append(segment.text, style=segment.style)
+    return rendered
+
+
+class HighlightCache:
+    """LRU 高亮缓存"""
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self._items: OrderedDict[tuple, Text] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(code: str, lang: str, theme: str, width: int) -> tuple:
+        digest = hashlib.sha1(code.encode("utf-8")).hexdigest()
+        return digest, lexer_for(lang).name, theme, width
+
+    def get(self, key: tuple) -> Text | None:
+        with self._lock:
+            text = self._items.get(key)
+            if text is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def put(self, key: tuple, text: Text) -> None:
+        with self._lock:
+            self._items[key] = text
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    # ============== 渲染入口 ==============
+
+    def cached(self, code: str, lang: str, theme: str = DEFAULT_THEME, width: int = 100) -> Text | None:
+        """只查缓存，不渲染"""
+        return self.get(self.key(code, lang, theme, width))
+
+    def highlight(self, code: str, lang: str, theme: str = DEFAULT_THEME, width: int = 100) -> Text:
+        """高亮 (命中缓存直接返回)"""
+        key = self.key(code, lang, theme, width)
+        text = self.get(key)
+        if text is None:
+            text = _render(code, lexer_for(lang), theme, width)
+            self.put(key, text)
+        return text
+
+
+def plain(code: str, theme: str = DEFAULT_THEME, width: int = 100) -> Text:
+    """
+    未高亮的占位渲染 (与高亮结果等高，替换时不跳动)
+    不经过 Syntax / 词法器，也不计入缓存统计：按与 _render 相同的方式折行、补左右与上下留白
+    """
+    background = Syntax.get_theme(theme).get_background_style()
+    code_width = max(1, width - 2)
+    # 与 Syntax 一致：词法器去掉首尾换行 (stripnl)，原文以换行结尾时末尾保留一个空行
+    code = code.expandtabs(4).strip("\n") + ("\n" if code.endswith("\n") else "")
+    blank = " " * width
+    rows = [blank]
+    for line in code.split("\n"):
+        if cell_len(line) <= code_width:
+            rows.append(f" {line}{' ' * (code_width - cell_len(line))} ")
+            continue
+        # 只有超宽的行才需要按单词折行
+        for part in Text(line).wrap(_console(width), code_width, overflow="fold"):
+            rows.append(f" {part.plain}{' ' * (code_width - part.cell_len)} ")
+    rows.append(blank)
+    return Text("\n".join(rows) + "\n", style=background)
+
+
+def is_large(code: str) -> bool:
+    return code.count("\n") + 1 > LARGE_BLOCK_LINES
+
+
+# 全局单例
+highlight_cache = HighlightCache()
@@ -0,0 +1,33 @@
+"""
+共享异步 HTTP 会话 (httpx)
+- 进程内复用连接池，不再每次请求重建 opener
+- 直连 / 走系统代理 各维护一个会话
+"""
+import httpx
+
+# use_proxy -> AsyncClient
+_clients: dict[bool, httpx.AsyncClient] = {}
+
+
+def get_async_client(use_proxy: bool = False) -> httpx.AsyncClient:
+    """获取共享的异步 HTTP 会话 (需在同一个事件循环中使用)"""
+    client = _clients.get(use_proxy)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            trust_env=use_proxy,  # False = 绕过 HTTP(S)_PROXY 环境变量
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            headers={"User-Agent": "Mozilla/5.0"},
+            follow_redirects=True,
+        )
+        _clients[use_proxy] = client
+    return client
+
+
+async def close_async_clients() -> None:
+    """关闭所有共享会话 (应用退出时调用)"""
+    for client in list(_clients.values()):
+        try:
+            await client.aclose()
+        except Exception:
+            pass
+    _clients.clear()
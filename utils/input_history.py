@@ -0,0 +1,232 @@
+"""
+输入历史 - 持久化 + 索引
+- 追加写入 data/input_history.jsonl，超过上限时压缩重写；重复输入只保留最近一次
+- 首次使用时才加载 (不拖慢启动)
+- 前缀检索：有序列表 + bisect (上键按已输入内容过滤)
+- 子串检索：三字组倒排索引；模糊检索：字符倒排索引 + 子序列匹配 (Ctrl+R 增量搜索)
+"""
+import bisect
+import json
+import re
+import threading
+from pathlib import Path
+
+HISTORY_FILE = Path(__file__).parent.parent / "data" / "input_history.jsonl"
+# 保留的历史条数上限
+HISTORY_LIMIT = 100_000
+# 文件行数超过 上限 x 该倍数 时压缩 (重复 / 过期条目)
+COMPACT_FACTOR = 1.5
+
+
+def _trigrams(text: str) -> set[str]:
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class InputHistory:
+    """输入历史：条目按时间排序，id 越大越新"""
+
+    def __init__(self, path: Path = HISTORY_FILE, limit: int = HISTORY_LIMIT):
+        self.path = path
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._next_id = 0
+        self._file_lines = 0
+        self._by_id: dict[int, str] = {}
+        self._by_text: dict[str, int] = {}
+        self._sorted: list[str] = []                 # 前缀检索用
+        self._trigram: dict[str, set[int]] = {}      # 子串检索用
+        self._chars: dict[str, set[int]] = {}        # 模糊检索用
+        self._ordered: list[str] | None = None       # 按时间排序的缓存 (变动后失效)
+
+    # ============== 加载 / 持久化 ==============
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            texts: dict[str, None] = {}
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        self._file_lines += 1
+                        try:
+                            text = json.loads(line)
+                        except ValueError:
+                            continue  # 写到一半的行
+                        if isinstance(text, str) and text:
+                            texts.pop(text, None)  # 重复的以最后一次为准
+                            texts[text] = None
+            except FileNotFoundError:
+                pass
+            # 批量建索引 (比逐条插入快得多)
+            for text in list(texts)[-self.limit:]:
+                self._by_id[self._next_id] = text
+                self._by_text[text] = self._next_id
+                self._index(self._next_id, text)
+                self._next_id += 1
+            self._sorted = sorted(self._by_text)
+            self._loaded = True
+
+    def preload(self) -> None:
+        """后台线程预加载 (首次 Ctrl+R 时无需等待)"""
+        self._ensure_loaded()
+
+    def _append_line(self, text: str) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(text, ensure_ascii=False) + "\n")
+            self._file_lines += 1
+            if self._file_lines > self.limit * COMPACT_FACTOR:
+                self._compact()
+        except OSError:
+            pass  # 历史写失败不影响聊天
+
+    def _compact(self) -> None:
+        """按当前内容重写文件 (去掉重复与超限条目)"""
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for text in self.entries():
+                f.write(json.dumps(text, ensure_ascii=False) + "\n")
+        tmp.replace(self.path)
+        self._file_lines = len(self._by_id)
+
+    # ============== 索引维护 ==============
+
+    def _insert(self, text: str) -> None:
+        old = self._by_text.pop(text, None)
+        if old is not None:
+            # 重复输入：移到最新
+            self._by_id.pop(old)
+            self._unindex(old, text, keep_sorted=True)
+        else:
+            bisect.insort(self._sorted, text)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._by_id[entry_id] = text
+        self._by_text[text] = entry_id
+        self._index(entry_id, text)
+        self._ordered = None
+
+    def _index(self, entry_id: int, text: str) -> None:
+        lowered = text.lower()
+        trigram = self._trigram
+        for i in range(len(lowered) - 2):
+            gram = lowered[i:i + 3]
+            ids = trigram.get(gram)
+            if ids is None:
+                trigram[gram] = {entry_id}
+            else:
+                ids.add(entry_id)
+        chars = self._chars
+        for char in set(lowered):
+            ids = chars.get(char)
+            if ids is None:
+                chars[char] = {entry_id}
+            else:
+                ids.add(entry_id)
+
+    def _unindex(self, entry_id: int, text: str, keep_sorted: bool = False) -> None:
+        for gram in _trigrams(text):
+            ids = self._trigram.get(gram)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._trigram[gram]
+        for char in set(text.lower()):
+            ids = self._chars.get(char)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._chars[char]
+        if not keep_sorted:
+            idx = bisect.bisect_left(self._sorted, text)
+            if idx < len(self._sorted) and self._sorted[idx] == text:
+                del self._sorted[idx]
+
+    def _evict(self) -> None:
+        """超过上限时淘汰最旧的条目 (dict 按插入顺序，最旧的在最前)"""
+        while len(self._by_id) > self.limit:
+            entry_id = next(iter(self._by_id))
+            text = self._by_id.pop(entry_id)
+            del self._by_text[text]
+            self._unindex(entry_id, text)
+        self._ordered = None
+
+    # ============== 公共接口 ==============
+
+    def add(self, text: str) -> None:
+        """记录一条输入 (重复的只保留最近一次)"""
+        text = text.strip()
+        if not text:
+            return
+        self._ensure_loaded()
+        with self._lock:
+            if self._by_id and self._by_id[self._next_id - 1] == text:
+                return  # 与上一条相同：不动文件
+            self._insert(text)
+            self._evict()
+            self._append_line(text)
+
+    def entries(self) -> list[str]:
+        """全部条目 (旧 -> 新)"""
+        self._ensure_loaded()
+        if self._ordered is None:
+            self._ordered = list(self._by_id.values())
+        return self._ordered
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._by_id)
+
+    def with_prefix(self, prefix: str) -> list[str]:
+        """以 prefix 开头的条目 (旧 -> 新)"""
+        self._ensure_loaded()
+        lo = bisect.bisect_left(self._sorted, prefix)
+        hi = bisect.bisect_left(self._sorted, prefix + "\U0010ffff")
+        return sorted(self._sorted[lo:hi], key=self._by_text.__getitem__)
+
+    def search(self, query: str, limit: int = 200) -> list[str]:
+        """增量搜索 (新 -> 旧)：先子串匹配，不足时补充模糊 (子序列) 匹配"""
+        self._ensure_loaded()
+        if not query:
+            return self.entries()[::-1][:limit]
+        needle = query.lower()
+
+        # 子串：三字组求交集缩小候选，再逐条确认
+        if len(needle) >= 3:
+            grams = sorted((self._trigram.get(g, set()) for g in _trigrams(needle)), key=len)
+            candidates = set(grams[0]).intersection(*grams[1:]) if grams else set()
+        else:
+            candidates = self._candidates(needle)
+        exact = [i for i in sorted(candidates, reverse=True) if needle in self._by_id[i].lower()]
+        results = [self._by_id[i] for i in exact[:limit]]
+        if len(results) >= limit:
+            return results
+
+        # 模糊：包含所有字符的条目里按顺序出现的
+        pattern = re.compile(".*?".join(map(re.escape, needle)), re.IGNORECASE)
+        seen = set(exact)
+        for entry_id in sorted(self._candidates(needle), reverse=True):
+            if entry_id in seen:
+                continue
+            if pattern.search(self._by_id[entry_id]):
+                results.append(self._by_id[entry_id])
+                if len(results) >= limit:
+                    break
+        return results
+
+    def _candidates(self, needle: str) -> set[int]:
+        """包含 needle 全部字符的条目 id"""
+        sets = sorted((self._chars.get(c, set()) for c in set(needle)), key=len)
+        if not sets:
+            return set()
+        return set(sets[0]).intersection(*sets[1:])
+
+
+# 全局单例
+input_history = InputHistory()
@@ -1,22 +1,217 @@
 """
 日志配置模块
 提供统一的日志接口，支持文件和控制台输出
+- 非阻塞：业务线程只把记录丢进队列，由后台 QueueListener 线程写盘
+- 轮转：按大小 / 按天切分，旧文件自动 gzip 压缩
+- 结构化：可选 JSON Lines 格式，自动带上请求 ID 与耗时等字段
+- 关闭的级别几乎零开销 (Logger 级别过滤 + 惰性 % 格式化)
 """
+import atexit
+import contextvars
+import gzip
+import json
 import logging
+import os
+import queue
+import shutil
 import sys
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
+from config.settings import (
+    LOG_LEVEL, LOG_FORMAT, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_DAILY
+)
+
 # 日志目录
 LOG_DIR = Path(__file__).parent.parent / "logs"
 LOG_DIR.mkdir(exist_ok=True)
 
 # 日志文件路径
-LOG_FILE = LOG_DIR / "app.log"
+LOG_FILE = LOG_DIR / ("app.jsonl" if LOG_FORMAT == "json" else "app.log")
+
+# 当前请求 ID (按线程 / 协程上下文隔离)
+_request_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("request_id", default=None)
+
+# LogRecord 自带字段，JSON 输出时其余字段视为 extra
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+
+# ============== 请求上下文 ==============
+
+def new_request_id() -> str:
+    """生成短请求 ID"""
+    return uuid.uuid4().hex[:8]
+
+
+def current_request_id() -> str | None:
+    """当前上下文的请求 ID"""
+    return _request_id.get()
+
+
+@contextmanager
+def request_context(request_id: str | None = None):
+    """在上下文内为所有日志附加请求 ID"""
+    rid = request_id or new_request_id()
+    token = _request_id.set(rid)
+    try:
+        yield rid
+    finally:
+        _request_id.reset(token)
+
+
+def request_scoped(iterator, request_id: str | None = None):
+    """
+    生成器版的 request_context：每一步都在独立的 Context 中执行
+    ContextVar 不跨 yield 持有，生成器换线程 / 换 Context 恢复或被回收时也不会 reset 失败
+    """
+    ctx = contextvars.copy_context()
+    ctx.run(_request_id.set, request_id or new_request_id())
+    iterator = iter(iterator)
+    try:
+        while True:
+            try:
+                item = ctx.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            ctx.run(close)
+
+
+class RequestIdFilter(logging.Filter):
+    """把请求 ID 写入记录 (在调用方线程执行，才能读到正确的上下文)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get() or "-"
+        return True
+
+
+# ============== 格式化 ==============
+
+class JsonLineFormatter(logging.Formatter):
+    """JSON Lines 格式：一行一条记录，extra 字段原样输出"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def _build_formatter() -> logging.Formatter:
+    if LOG_FORMAT == "json":
+        return JsonLineFormatter()
+    return logging.Formatter(
+        fmt="%(asctime)s | %(levelname)-8s | %(name)s | %(request_id)s | %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+
+# ============== 轮转 ==============
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """按大小或按天轮转，轮转出的旧文件 gzip 压缩"""
+
+    def __init__(self, filename, max_bytes: int, backup_count: int, daily: bool):
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backup_count,
+            encoding="utf-8", delay=True
+        )
+        self._daily = daily
+        self._next_rollover = self._compute_next_rollover()
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compute_next_rollover() -> float:
+        """下一个本地零点"""
+        now = time.localtime()
+        midnight = time.mktime((now.tm_year, now.tm_mon, now.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+        return midnight
+
+    @staticmethod
+    def _compress(source: str, dest: str) -> None:
+        if not os.path.exists(source):
+            # delay=True 且尚未写入 (如零点后的第一条日志)：没有可轮转的文件
+            return
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self._daily and time.time() >= self._next_rollover:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        try:
+            super().doRollover()
+        finally:
+            # 轮转失败也推进到下一个零点，否则之后每条日志都会重试并报错
+            self._next_rollover = self._compute_next_rollover()
+
+
+# ============== 后台写盘 ==============
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    原样入队：标准 QueueHandler.prepare 会在调用方线程格式化消息与异常堆栈，
+    进程内队列无需序列化，格式化全部留给后台线程的 Handler
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_queue: queue.SimpleQueue = queue.SimpleQueue()
+_listener: QueueListener | None = None
+
+
+def _ensure_listener() -> None:
+    """启动唯一的后台写盘线程 (所有 Logger 共用)"""
+    global _listener
+    if _listener is not None:
+        return
+    file_handler = CompressedRotatingFileHandler(
+        LOG_FILE,
+        max_bytes=LOG_MAX_BYTES,
+        backup_count=LOG_BACKUP_COUNT,
+        daily=LOG_ROTATE_DAILY,
+    )
+    file_handler.setFormatter(_build_formatter())
+    _listener = QueueListener(_queue, file_handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """停止后台线程并刷完队列中剩余的日志"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
 
 
 def setup_logger(
     name: str = "gemini_chat",
-    level: int = logging.INFO,
+    level: int | None = None,
     log_to_file: bool = True,
     log_to_console: bool = False
 ) -> logging.Logger:
@@ -25,8 +220,8 @@ def setup_logger(
 
     Args:
         name: 日志记录器名称
-        level: 日志级别 (DEBUG, INFO, WARNING, ERROR)
-        log_to_file: 是否记录到文件
+        level: 日志级别 (DEBUG, INFO, WARNING, ERROR)，默认取 LOG_LEVEL
+        log_to_file: 是否记录到文件 (经队列异步写入)
         log_to_console: 是否输出到控制台
 
     Returns:
@@ -38,31 +233,27 @@ def setup_logger(
     if logger.handlers:
         return logger
 
+    if level is None:
+        level = logging.getLevelName(LOG_LEVEL)
+        if not isinstance(level, int):
+            level = logging.INFO
+
+    # Logger 级别过滤发生在创建 LogRecord 之前，关闭的级别几乎没有开销
     logger.setLevel(level)
     logger.propagate = False
 
-    # 日志格式
-    formatter = logging.Formatter(
-        fmt="%(asctime)s | %(levelname)-8s | %(name)s | %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
-    )
-
-    # 文件处理器
+    # 文件处理器 (队列 -> 后台线程)
     if log_to_file:
-        file_handler = logging.FileHandler(
-            LOG_FILE,
-            encoding="utf-8",
-            mode="a"  # 追加模式
-        )
-        file_handler.setLevel(level)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        _ensure_listener()
+        queue_handler = DeferredQueueHandler(_queue)
+        queue_handler.addFilter(RequestIdFilter())
+        logger.addHandler(queue_handler)
 
     # 控制台处理器
     if log_to_console:
         console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setLevel(level)
-        console_handler.setFormatter(formatter)
+        console_handler.addFilter(RequestIdFilter())
+        console_handler.setFormatter(_build_formatter())
         logger.addHandler(console_handler)
 
     return logger
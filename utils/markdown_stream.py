@@ -0,0 +1,198 @@
+"""
+流式 Markdown 分块器 - 增量状态机
+- 直接消费流式 delta，按行推进，只在块闭合时发出事件
+- 块类型: heading / paragraph / list / quote / code / hr / table
+- 渲染器、代码块索引、导出等订阅同一个流，每个字符只扫描一次
+"""
+import re
+from dataclasses import dataclass
+from typing import Callable
+
+_HEADING = re.compile(r"^ {0,3}(#{1,6})(\s|$)")
+_HR = re.compile(r"^ {0,3}([-*_])(\s*\1){2,}\s*$")
+_LIST_ITEM = re.compile(r"^ {0,3}([-*+]|\d{1,9}[.)])(\s|$)")
+_SETEXT = re.compile(r"^ {0,3}(=+|-+)\s*$")
+
+
+@dataclass
+class MdBlock:
+    """一个已闭合的 Markdown 块"""
+    kind: str               # heading / paragraph / list / quote / code / hr / table
+    text: str               # 块的原始 Markdown (含围栏)
+    start: int              # 在整段回答中的 UTF-8 字节偏移
+    end: int
+    index: int              # 块序号 (从 0 开始)
+    lang: str = ""          # 代码块语言
+    code: str = ""          # 代码块正文 (不含围栏)
+    complete: bool = True   # False = 围栏未闭合就结束了 (回答中断)
+
+
+class MarkdownStream:
+    """增量 Markdown 块状态机"""
+
+    def __init__(self):
+        self.blocks: list[MdBlock] = []
+        self._subscribers: list[Callable[[MdBlock], None]] = []
+        self._partial = ""              # 尚未换行的残行
+        self._pos = 0                   # 已消费的字节数
+        # 当前打开的块
+        self._kind: str | None = None
+        self._lines: list[str] = []
+        self._start = 0
+        self._fence = ""                # 代码围栏标记
+        self._lang = ""
+        self._pending_blank = False     # 列表中遇到的空行 (看下一行决定是否结束列表)
+
+    # ============== 订阅 ==============
+
+    def subscribe(self, callback: Callable[[MdBlock], None]) -> None:
+        """订阅块闭合事件"""
+        self._subscribers.append(callback)
+
+    @property
+    def pending_text(self) -> str:
+        """尚未闭合的内容 (用于实时预览)"""
+        text = "\n".join(self._lines)
+        if self._partial:
+            text = f"{text}\n{self._partial}" if text else self._partial
+        return text
+
+    # ============== 输入 ==============
+
+    def feed(self, chunk: str) -> list[MdBlock]:
+        """输入一段 delta，返回本次闭合的块"""
+        self._partial += chunk
+        if "\n" not in chunk:
+            return []
+        *lines, self._partial = self._partial.split("\n")
+        closed: list[MdBlock] = []
+        for line in lines:
+            self._line(line, closed)
+        return closed
+
+    def flush(self) -> list[MdBlock]:
+        """结束当前内容：处理残行并闭合所有打开的块 (之后仍可继续 feed)"""
+        closed: list[MdBlock] = []
+        if self._partial:
+            line, self._partial = self._partial, ""
+            self._line(line, closed, newline=False)
+        self._close(closed, complete=self._kind != "code")
+        return closed
+
+    close = flush
+
+    # ============== 状态机 ==============
+
+    def _line(self, line: str, closed: list[MdBlock], newline: bool = True) -> None:
+        line_start = self._pos
+        self._pos += len(line.encode("utf-8")) + (1 if newline else 0)
+        stripped = line.strip()
+
+        # 代码块内只找结束围栏
+        if self._kind == "code":
+            self._lines.append(line)
+            if stripped.startswith(self._fence) and not stripped.strip(self._fence[0]):
+                self._close(closed)
+            return
+
+        if not stripped:
+            if self._kind == "list":
+                self._pending_blank = True  # 松散列表：等下一行再决定
+                self._lines.append(line)
+            else:
+                self._close(closed)
+            return
+
+        if self._pending_blank:
+            self._pending_blank = False
+            if not (_LIST_ITEM.match(line) or line.startswith(("  ", "\t"))):
+                self._lines.pop()  # 列表尾部的空行不属于列表
+                self._close(closed)
+
+        fence = self._fence_of(stripped)
+        if fence:
+            self._close(closed)
+            info = stripped[len(fence):].strip()
+            self._open("code", line_start)
+            self._fence = fence
+            self._lang = info.split()[0].lower() if info else ""
+            self._lines.append(line)
+            return
+
+        if _HEADING.match(line):
+            self._close(closed)
+            self._open("heading", line_start)
+            self._lines.append(line)
+            self._close(closed)
+            return
+
+        # Setext 标题：段落下一行是 === / ---
+        if self._kind == "paragraph" and _SETEXT.match(line):
+            self._kind = "heading"
+            self._lines.append(line)
+            self._close(closed)
+            return
+
+        if _HR.match(line):
+            self._close(closed)
+            self._open("hr", line_start)
+            self._lines.append(line)
+            self._close(closed)
+            return
+
+        if _LIST_ITEM.match(line):
+            kind = "list"
+        elif stripped.startswith(">"):
+            kind = "quote"
+        elif stripped.startswith("|"):
+            kind = "table"
+        elif self._kind in ("list", "quote", "paragraph"):
+            kind = self._kind  # 续行 (惰性延续)
+        else:
+            kind = "paragraph"
+
+        if kind != self._kind:
+            self._close(closed)
+            self._open(kind, line_start)
+        self._lines.append(line)
+
+    @staticmethod
+    def _fence_of(stripped: str) -> str:
+        for char in ("`", "~"):
+            if stripped.startswith(char * 3):
+                return char * (len(stripped) - len(stripped.lstrip(char)))
+        return ""
+
+    def _open(self, kind: str, start: int) -> None:
+        self._kind = kind
+        self._lines = []
+        self._start = start
+
+    def _close(self, closed: list[MdBlock], complete: bool = True) -> None:
+        """闭合当前块并通知订阅者"""
+        if self._kind is None:
+            return
+        text = "\n".join(self._lines)
+        end = self._start + len(text.encode("utf-8"))
+        block = MdBlock(self._kind, text, self._start, end, len(self.blocks))
+        if self._kind == "code":
+            body = self._lines[1:-1] if complete else self._lines[1:]
+            block.lang = self._lang
+            block.code = "\n".join(body)
+            block.complete = complete
+        self._kind = None
+        self._lines = []
+        self._fence = ""
+        self._pending_blank = False
+        self.blocks.append(block)
+        closed.append(block)
+        for callback in self._subscribers:
+            callback(block)
+
+
+def parse_blocks(text: str) -> list[MdBlock]:
+    """一次性分块 (用于从已保存的内容恢复)"""
+    stream = MarkdownStream()
+    stream.feed(text)
+    stream.flush()
+    return stream.blocks
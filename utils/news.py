@@ -1,46 +1,67 @@
 """
-新闻获取器 - Google News RSS + AI 翻译
-- 使用 Google News RSS (免费无需 Key)
-- Gemini 批量翻译 (省流)
+新闻获取器 - Google News RSS + AI 翻译 (增量异步管线)
+- 使用 Google News RSS (免费无需 Key)，后台异步抓取
+- 翻译结果按标题哈希持久化，只把没见过的标题一次性批量交给 Gemini
+- 读取接口 (get_ticker / get_scrolling_text) 只读内存，永不阻塞在网络上
 - 本地缓存 (30分钟有效)
 - 支持滚动效果
 """
-import urllib.request
+import asyncio
+import hashlib
 import json
 import time
 import re
 from pathlib import Path
 from html import unescape
 
+from utils.http import get_async_client
+from utils.text_width import display_width, fit
+
 # 缓存配置
 CACHE_DIR = Path(__file__).parent.parent / "data"
 CACHE_FILE = CACHE_DIR / "news_cache.json"
+TRANSLATION_FILE = CACHE_DIR / "news_translations.json"
 CACHE_TTL = 30 * 60  # 30分钟
+TRANSLATION_CACHE_SIZE = 500  # 翻译缓存最多保留条数
 
 # Google News RSS (中国科技新闻)
 GOOGLE_NEWS_RSS = "https://news.google.com/rss/topics/CAAqJggKIiBDQkFTRWdvSUwyMHZNRGRqTVhZU0FtVnVHZ0pWVXlnQVAB?hl=en-US&gl=US&ceid=US:en"
 
 
+def headline_key(title: str) -> str:
+    """标题哈希 (翻译缓存的键)"""
+    normalized = " ".join(title.lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
 class NewsFetcher:
     """新闻获取器 (Google News + AI 翻译)"""
     
     def __init__(self):
         self._news_list = []
+        self._news_timestamp = 0.0
         self._current_index = 0
         self._scroll_offset = 0
+        self._flip_index = 0
+        self._last_flip_time: float | None = None
+        self._translations: dict[str, str] | None = None  # 懒加载
+        self._refresh_task: asyncio.Task | None = None
         CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        self._load_cache()
+    
+    # ============== 缓存 ==============
     
     def _load_cache(self) -> list | None:
-        """加载缓存"""
+        """加载新闻缓存 (过期也保留，供读取端先显示)"""
         if not CACHE_FILE.exists():
             return None
         try:
             with open(CACHE_FILE, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-            if time.time() - data.get('timestamp', 0) > CACHE_TTL:
-                return None
-            return data.get('news', [])
-        except (json.JSONDecodeError, OSError, KeyError) as e:
+            self._news_list = data.get('news', [])
+            self._news_timestamp = data.get('timestamp', 0)
+            return self._news_list
+        except (json.JSONDecodeError, OSError, KeyError, AttributeError):
             return None
     
     def _save_cache(self, news_list: list):
@@ -48,22 +69,62 @@ class NewsFetcher:
         try:
             with open(CACHE_FILE, 'w', encoding='utf-8') as f:
                 json.dump({
-                    'timestamp': time.time(),
+                    'timestamp': self._news_timestamp,
                     'news': news_list
                 }, f, ensure_ascii=False)
-        except (OSError, IOError) as e:
+        except (OSError, IOError):
             pass  # 缓存保存失败不影响主流程
     
-    def _fetch_google_news(self, limit: int = 10) -> list:
-        """从 Google News RSS 获取新闻"""
+    def _get_translations(self) -> dict[str, str]:
+        """加载翻译缓存 {标题哈希: 中文}"""
+        if self._translations is not None:
+            return self._translations
+        self._translations = {}
+        try:
+            with open(TRANSLATION_FILE, 'r', encoding='utf-8') as f:
+                self._translations = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError, OSError):
+            # 首次运行：用旧新闻缓存里已有的翻译做种子
+            for s in self._news_list:
+                if s.get('summary') and s['summary'] != s['title'][:50]:
+                    self._translations[headline_key(s['title'])] = s['summary']
+        return self._translations
+    
+    def _save_translations(self):
+        """保存翻译缓存 (只保留最近用到的 N 条)"""
+        translations = self._get_translations()
+        if len(translations) > TRANSLATION_CACHE_SIZE:
+            keys = list(translations)[-TRANSLATION_CACHE_SIZE:]
+            self._translations = translations = {k: translations[k] for k in keys}
+        try:
+            with open(TRANSLATION_FILE, 'w', encoding='utf-8') as f:
+                json.dump(translations, f, ensure_ascii=False)
+        except (OSError, IOError):
+            pass
+    
+    # ============== 抓取 ==============
+    
+    async def _fetch_google_news(self, limit: int = 10) -> list:
+        """从 Google News RSS 获取新闻 (走代理，复用共享会话)"""
+        try:
+            client = get_async_client(use_proxy=True)
+            resp = await client.get(GOOGLE_NEWS_RSS, timeout=10)
+            resp.raise_for_status()
+            content = resp.content
+        except Exception:
+            return []
+        # 解析放到线程里，避免大 XML 卡住事件循环
+        return await asyncio.to_thread(self._parse_rss, content, limit)
+    
+    def _parse_rss(self, content: bytes, limit: int) -> list:
+        """解析 RSS (优先 feedparser，缺失时退回正则)"""
         try:
             import feedparser
         except ImportError:
-            # 如果没有 feedparser，使用简单解析
-            return self._fetch_google_news_simple(limit)
+            return self._parse_rss_simple(content.decode('utf-8', errors='replace'), limit)
         
         try:
-            feed = feedparser.parse(GOOGLE_NEWS_RSS)
+            feed = feedparser.parse(content)
             stories = []
             for entry in feed.entries[:limit]:
                 title = unescape(entry.title)
@@ -79,107 +140,128 @@ class NewsFetcher:
         except Exception:
             return []
     
-    def _fetch_google_news_simple(self, limit: int = 10) -> list:
+    def _parse_rss_simple(self, content: str, limit: int) -> list:
         """简单 RSS 解析 (无 feedparser 时)"""
-        try:
-            req = urllib.request.Request(
-                GOOGLE_NEWS_RSS,
-                headers={'User-Agent': 'Mozilla/5.0'}
-            )
-            with urllib.request.urlopen(req, timeout=10) as resp:
-                content = resp.read().decode('utf-8')
-            
-            # 简单正则提取
-            items = re.findall(r'<item>.*?<title>(.*?)</title>.*?<link>(.*?)</link>.*?</item>', content, re.DOTALL)
-            stories = []
-            for title, link in items[:limit]:
-                title = unescape(re.sub(r'<!\[CDATA\[(.*?)\]\]>', r'\1', title))
-                title = re.sub(r'\s*-\s*[^-]+$', '', title)
-                stories.append({
-                    'title': title,
-                    'source': 'Google News',
-                    'link': link,
-                    'summary': '',
-                })
-            return stories
-        except (urllib.error.URLError, ValueError) as e:
-            return []
+        items = re.findall(r'<item>.*?<title>(.*?)</title>.*?<link>(.*?)</link>.*?</item>', content, re.DOTALL)
+        stories = []
+        for title, link in items[:limit]:
+            title = unescape(re.sub(r'<!\[CDATA\[(.*?)\]\]>', r'\1', title))
+            title = re.sub(r'\s*-\s*[^-]+$', '', title)
+            stories.append({
+                'title': title,
+                'source': 'Google News',
+                'link': link,
+                'summary': '',
+            })
+        return stories
     
-    def _translate_batch(self, stories: list) -> list:
-        """批量翻译新闻标题 (省流: 一次 API 调用)"""
+    # ============== 翻译 ==============
+    
+    async def _translate_batch(self, stories: list) -> list:
+        """增量翻译：命中缓存的直接填充，未见过的标题一次 API 调用批量翻译"""
         if not stories:
             return stories
         
-        try:
-            from core.client import get_client
-            client = get_client()
-            
-            # 构建批量翻译请求
-            titles = [f"{i+1}. {s['title']}" for i, s in enumerate(stories)]
-            prompt = (
-                "将以下英文科技新闻标题翻译成简洁的中文（每条不超过50字）。\n"
-                "格式：序号|中文翻译\n"
-                "只返回翻译结果，不要其他内容。\n\n"
-                + "\n".join(titles)
-            )
-            
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=prompt
-            )
-            
-            # 解析结果
-            lines = response.text.strip().split('\n')
-            for line in lines:
-                if '|' in line:
-                    parts = line.split('|', 1)
-                    try:
-                        idx = int(parts[0].strip().rstrip('.')) - 1
-                        translation = parts[1].strip()[:50]
-                        if 0 <= idx < len(stories):
-                            stories[idx]['summary'] = translation
-                    except (ValueError, IndexError):
-                        pass  # 解析失败时跳过此条
-            
-            # 未翻译的保留原标题
-            for s in stories:
-                if not s['summary']:
-                    s['summary'] = s['title'][:50]
-            
-            return stories
-            
-        except Exception:
-            # 翻译失败，使用原标题
-            for s in stories:
+        translations = self._get_translations()
+        pending = []
+        for s in stories:
+            key = headline_key(s['title'])
+            cached = translations.pop(key, None)
+            if cached:
+                # 重新插入到末尾：字典顺序即最近使用顺序，淘汰时丢弃最久未用的
+                translations[key] = cached
+                s['summary'] = cached
+            else:
+                pending.append(s)
+        
+        if pending:
+            try:
+                from config.settings import load_api_keys
+                if not load_api_keys():
+                    raise RuntimeError("未配置 GEMINI_API_KEY")
+                from core.client import get_client
+                client = get_client()
+                
+                # 构建批量翻译请求
+                titles = [f"{i+1}. {s['title']}" for i, s in enumerate(pending)]
+                prompt = (
+                    "将以下英文科技新闻标题翻译成简洁的中文（每条不超过50字）。\n"
+                    "格式：序号|中文翻译\n"
+                    "只返回翻译结果，不要其他内容。\n\n"
+                    + "\n".join(titles)
+                )
+                
+                response = await client.aio.models.generate_content(
+                    model="gemini-2.5-flash",
+                    contents=prompt
+                )
+                
+                # 解析结果
+                lines = response.text.strip().split('\n')
+                for line in lines:
+                    if '|' in line:
+                        parts = line.split('|', 1)
+                        try:
+                            idx = int(parts[0].strip().rstrip('.')) - 1
+                            translation = parts[1].strip()[:50]
+                            if 0 <= idx < len(pending) and translation:
+                                pending[idx]['summary'] = translation
+                                translations[headline_key(pending[idx]['title'])] = translation
+                        except (ValueError, IndexError):
+                            pass  # 解析失败时跳过此条
+            except Exception:
+                pass  # 翻译失败，下面使用原标题 (不写入缓存，下次再试)
+        self._save_translations()
+        
+        # 未翻译的保留原标题
+        for s in stories:
+            if not s['summary']:
                 s['summary'] = s['title'][:50]
-            return stories
-    
-    def get_top_stories(self, limit: int = 5) -> list:
-        """获取新闻 (优先使用缓存)"""
-        # 1. 尝试缓存
-        cached = self._load_cache()
-        if cached:
-            self._news_list = cached
-            return cached
         
-        # 2. 抓取新闻
-        stories = self._fetch_google_news(limit=limit * 2)  # 多抓一些
+        return stories
+    
+    # ============== 管线 ==============
+    
+    def _is_stale(self) -> bool:
+        return time.time() - self._news_timestamp > CACHE_TTL
+    
+    async def refresh(self, limit: int = 5) -> list:
+        """后台刷新：抓 RSS -> 增量翻译 -> 落盘"""
+        stories = await self._fetch_google_news(limit=limit * 2)  # 多抓一些
         if not stories:
-            return []
+            return self._news_list
         
-        # 3. 批量翻译 (省流)
-        stories = self._translate_batch(stories[:limit])
+        stories = await self._translate_batch(stories[:limit])
         
-        # 4. 保存缓存
-        self._save_cache(stories)
+        self._news_timestamp = time.time()
         self._news_list = stories
-        
+        self._save_cache(stories)
         return stories
     
+    def request_refresh(self, limit: int = 5) -> None:
+        """缓存过期时在当前事件循环上排一次后台刷新 (不阻塞调用方)"""
+        if not self._is_stale() or self._refresh_task is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # 没有事件循环 (如脚本中同步调用)，只读缓存
+        self._refresh_task = loop.create_task(self.refresh(limit))
+        self._refresh_task.add_done_callback(self._on_refresh_done)
+    
+    def _on_refresh_done(self, task: asyncio.Task) -> None:
+        self._refresh_task = None
+        if not task.cancelled():
+            task.exception()  # 取走异常，避免 "never retrieved" 警告
+    
+    def get_top_stories(self, limit: int = 5) -> list:
+        """获取新闻 (只读内存，过期时后台刷新)"""
+        self.request_refresh(limit)
+        return self._news_list[:limit]
+    
     def get_ticker(self) -> str:
         """获取一条轮播新闻"""
-        if not self._news_list:
-            self.get_top_stories()
+        self.request_refresh()
         
         if not self._news_list:
             return "📰 暂无最新资讯"
@@ -192,63 +274,29 @@ class NewsFetcher:
         source = story.get('source', '')[:10]
         return f"📰 {display} [{source}]"
     
-    def _display_width(self, text: str) -> int:
-        """计算字符串的显示宽度（中文算2，英文算1）"""
-        width = 0
-        for char in text:
-            # 中日韩字符占2格
-            if '\u4e00' <= char <= '\u9fff' or \
-               '\u3400' <= char <= '\u4dbf' or \
-               '\uf900' <= char <= '\ufaff' or \
-               '\U00020000' <= char <= '\U0002a6df':
-                width += 2
-            else:
-                width += 1
-        return width
-    
-    def _truncate_to_width(self, text: str, max_width: int) -> str:
-        """按显示宽度截断字符串"""
-        result = []
-        current_width = 0
-        for char in text:
-            char_width = 2 if ('\u4e00' <= char <= '\u9fff' or 
-                              '\u3400' <= char <= '\u4dbf' or
-                              '\uf900' <= char <= '\ufaff') else 1
-            if current_width + char_width > max_width:
-                break
-            result.append(char)
-            current_width += char_width
-        # 用空格填充到精确宽度
-        while current_width < max_width:
-            result.append(' ')
-            current_width += 1
-        return ''.join(result)
-
     def get_scrolling_text(self, width: int = 60) -> str:
         """
         获取新闻文本 (翻页式轮播，每4秒切换一条)
         """
-        if not self._news_list:
-            self.get_top_stories()
+        self.request_refresh()
         
         prefix = "📰 "
-        prefix_width = 3  # emoji(2) + 空格(1)
-        display_width = max(10, width - prefix_width)
+        text_width = max(10, width - display_width(prefix))
         
         if not self._news_list:
-            return self._truncate_to_width(prefix + "新闻加载中...", width)
+            return fit(prefix + "新闻加载中...", width)
         
         # 检查是否需要切换到下一条 (每4秒切换)
         current_time = time.time()
-        if not hasattr(self, '_last_flip_time'):
+        if self._last_flip_time is None:
             self._last_flip_time = current_time
-            self._flip_index = 0
         
         if current_time - self._last_flip_time >= 4.0:
             self._last_flip_time = current_time
-            self._flip_index = (self._flip_index + 1) % len(self._news_list)
+            self._flip_index += 1
         
-        # 获取当前新闻
+        # 获取当前新闻 (刷新后列表可能变短，取模)
+        self._flip_index %= len(self._news_list)
         story = self._news_list[self._flip_index]
         headline = story.get('summary') or story['title'][:50]
         source = story.get('source', '')[:8]
@@ -256,7 +304,7 @@ class NewsFetcher:
         # 格式: 📰 标题 [来源]
         text = f"{headline} [{source}]"
         
-        return prefix + self._truncate_to_width(text, display_width)
+        return prefix + fit(text, text_width)
 
 
 # 全局单例
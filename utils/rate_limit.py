@@ -0,0 +1,46 @@
+"""
+令牌桶限速 - 批处理 / 网关共用
+- 速率按密钥池大小放大：每个 Key 各有配额，Key 越多允许越快
+- 线程安全，acquire() 阻塞到拿到令牌为止
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """令牌桶：rate 个/秒匀速补充，最多攒 capacity 个 (允许短时突发)"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = max(rate, 1e-6)
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """尝试取令牌：成功返回 0，否则返回还需等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """阻塞直到取到令牌"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+def per_key_bucket(rpm_per_key: float, key_count: int) -> TokenBucket:
+    """按密钥数量放大的每分钟请求数限速"""
+    rate = rpm_per_key * max(1, key_count) / 60.0
+    return TokenBucket(rate, capacity=max(1, key_count))
@@ -0,0 +1,170 @@
+"""
+显示宽度引擎 - CJK / Emoji 终端列宽计算
+- 预生成的东亚宽度 + 零宽字符区间表 (utils/_width_table.py)，bisect 查表
+- 纯 ASCII 快速路径，重复字符串走 LRU 缓存
+- Emoji 按 2 列计算 (含 VS16 变体选择符、ZWJ 组合序列)
+- 提供 O(n) 的 width / truncate / pad / fit，新闻、状态栏、气泡标题共用
+"""
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Iterator
+
+from ._width_table import WIDE_RANGES, ZERO_WIDTH_RANGES
+
+_WIDE_STARTS = [start for start, _ in WIDE_RANGES]
+_ZERO_STARTS = [start for start, _ in ZERO_WIDTH_RANGES]
+
+ZWJ = "\u200d"   # 零宽连接符 (👨‍💻 这类组合 Emoji)
+VS16 = "\ufe0f"  # Emoji 变体选择符 (☀ -> ☀️ 变成 2 列)
+
+
+def _in_ranges(cp: int, starts: list[int], ranges: tuple) -> bool:
+    i = bisect_right(starts, cp) - 1
+    return i >= 0 and cp <= ranges[i][1]
+
+
+@lru_cache(maxsize=4096)
+def char_width(ch: str) -> int:
+    """单个字符的显示宽度 (0 / 1 / 2)"""
+    cp = ord(ch)
+    if cp < 0x7F:
+        return 1 if cp >= 0x20 else 0
+    if cp < 0xA0:
+        return 0
+    if _in_ranges(cp, _ZERO_STARTS, ZERO_WIDTH_RANGES):
+        return 0
+    if _in_ranges(cp, _WIDE_STARTS, WIDE_RANGES):
+        return 2
+    return 1
+
+
+def _iter_widths(text: str) -> Iterator[int]:
+    """逐字符给出上下文相关的宽度 (与 text 一一对应)"""
+    prev = 0
+    joined = False
+    for ch in text:
+        if ch == VS16:
+            # 窄字符 + VS16 = Emoji 呈现，补 1 列
+            w = 1 if prev == 1 else 0
+        elif joined:
+            w = 0  # ZWJ 之后的字符并入前一个字形
+        else:
+            w = char_width(ch)
+        joined = ch == ZWJ
+        if w:
+            prev = w
+        yield w
+
+
+@lru_cache(maxsize=2048)
+def display_width(text: str) -> int:
+    """字符串的显示宽度"""
+    if text.isascii():
+        return len(text)
+    return sum(_iter_widths(text))
+
+
+def truncate(text: str, max_width: int, ellipsis: str = "") -> str:
+    """按显示宽度截断 (超出时末尾接 ellipsis，结果不超过 max_width)"""
+    if max_width <= 0:
+        return ""
+    if text.isascii():
+        if len(text) <= max_width:
+            return text
+        ellipsis = _clip(ellipsis, max_width)
+        return text[:max_width - display_width(ellipsis)] + ellipsis
+
+    ellipsis = _clip(ellipsis, max_width)
+    limit = max_width - display_width(ellipsis)
+    width = 0
+    cut = 0  # 放得下 ellipsis 的最后位置
+    for i, w in enumerate(_iter_widths(text)):
+        if width + w > max_width:
+            return text[:cut] + ellipsis
+        width += w
+        if width <= limit:
+            cut = i + 1
+    return text
+
+
+def _clip(ellipsis: str, max_width: int) -> str:
+    """ellipsis 本身比 max_width 宽时按显示宽度截短"""
+    if display_width(ellipsis) <= max_width:
+        return ellipsis
+    return truncate(ellipsis, max_width)
+
+
+def pad(text: str, width: int, align: str = "left") -> str:
+    """按显示宽度用空格补齐 (不截断)"""
+    gap = width - display_width(text)
+    if gap <= 0:
+        return text
+    if align == "right":
+        return " " * gap + text
+    if align == "center":
+        left = gap // 2
+        return " " * left + text + " " * (gap - left)
+    return text + " " * gap
+
+
+def fit(text: str, width: int, ellipsis: str = "") -> str:
+    """截断 + 补齐到精确宽度 (定宽滚动条 / 跑马灯用)"""
+    return pad(truncate(text, width, ellipsis), width)
+
+
+def _generate_table(path) -> None:
+    """用 unicodedata 重新生成区间表 (升级 Python / Unicode 版本后运行)"""
+    import unicodedata
+
+    def collect(pred):
+        out, start, last = [], None, None
+        for cp in range(0x110000):
+            ch = chr(cp)
+            cat = unicodedata.category(ch)
+            if cat in ("Cn", "Cs", "Co"):
+                continue  # 未分配码位不打断区间
+            if pred(ch, cat):
+                if start is None:
+                    start = cp
+                last = cp
+            elif start is not None:
+                out.append((start, last))
+                start = None
+        if start is not None:
+            out.append((start, last))
+        return out
+
+    wide = collect(lambda ch, cat: cat not in ("Mn", "Me", "Cf")
+                   and unicodedata.east_asian_width(ch) in ("W", "F"))
+    # 补充平面 (SIP / TIP) 整体按宽字符处理
+    wide = [r for r in wide if r[1] < 0x20000 or r[0] > 0x3FFFD]
+    wide += [(0x20000, 0x2FFFD), (0x30000, 0x3FFFD)]
+    wide.sort()
+    zero = collect(lambda ch, cat: (cat in ("Mn", "Me", "Cf") and ch != "\xad")
+                   or 0x1160 <= ord(ch) <= 0x11FF or 0xD7B0 <= ord(ch) <= 0xD7FF)
+
+    def dump(name, ranges):
+        lines = [f"{name} = ("]
+        lines += [f"    (0x{a:05X}, 0x{b:05X})," for a, b in ranges]
+        lines.append(")")
+        return "\n".join(lines)
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            '"""\n'
+            "显示宽度区间表 (自动生成，请勿手改)\n"
+            f"由 utils/text_width.py 根据 Unicode {unicodedata.unidata_version} 生成:\n"
+            "    python -m utils.text_width\n"
+            '"""\n\n'
+            "# 东亚宽度 W/F (含 Emoji 呈现字符)，占 2 列\n"
+            + dump("WIDE_RANGES", wide)
+            + "\n\n# 组合符 / 格式控制符 / 韩文中声终声，占 0 列\n"
+            + dump("ZERO_WIDTH_RANGES", zero)
+            + "\n"
+        )
+    print(f"Generated {path}")
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+    _generate_table(Path(__file__).parent / "_width_table.py")
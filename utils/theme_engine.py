@@ -0,0 +1,136 @@
+"""
+主题引擎 - 变量驱动的 Catppuccin 风味
+- styles/themes.tcss 只有一套规则，颜色引用 $ctp-* 变量
+- styles/flavors.json 每个风味一张变量表，只加载当前风味
+- CachedStylesheet: 解析结果按 (CSS 内容, 变量) 缓存到磁盘，下次启动直接反序列化
+"""
+import hashlib
+import json
+import os
+import pickle
+import threading
+from pathlib import Path
+
+import textual
+from textual.css.stylesheet import Stylesheet
+
+from utils.logger import get_logger
+
+logger = get_logger("theme")
+
+FLAVORS_PATH = Path(__file__).resolve().parent.parent / "styles" / "flavors.json"
+CACHE_DIR = Path(__file__).resolve().parent.parent / ".cache" / "tcss"
+DEFAULT_FLAVOR = "mocha"
+
+_flavors: dict | None = None
+
+
+def load_flavors(reload: bool = False) -> dict[str, dict]:
+    """风味表 {id: {"name": 显示名, "variables": {...}}} (只读一次，reload=True 时重新读取)"""
+    global _flavors
+    if _flavors is None or reload:
+        with open(FLAVORS_PATH, "r", encoding="utf-8") as f:
+            _flavors = json.load(f)
+    return _flavors
+
+
+def flavor_variables(flavor: str) -> dict[str, str]:
+    flavors = load_flavors()
+    return flavors.get(flavor, flavors[DEFAULT_FLAVOR])["variables"]
+
+
+def _digest(*parts) -> str:
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class CachedStylesheet(Stylesheet):
+    """带磁盘缓存的样式表：每组变量一个缓存包，包内按源 CSS 内容索引解析结果"""
+
+    # 同一进程内各组变量的缓存包 (切换回已用过的风味时不再读盘)
+    _bundles: dict[str, dict] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, *, variables: dict[str, str] | None = None) -> None:
+        super().__init__(variables=variables)
+        self._dirty = False
+        self._used: set[str] = set()
+        self.disk_hits = 0
+        self.disk_misses = 0
+
+    def copy(self) -> "CachedStylesheet":
+        stylesheet = CachedStylesheet(variables=self._variables.copy())
+        stylesheet.source = self.source.copy()
+        return stylesheet
+
+    # ============== 缓存包 ==============
+
+    def _bundle_key(self) -> str:
+        # 解析结果已代入变量值，textual 版本变化时格式也可能变化
+        return _digest(textual.__version__, sorted(self._variables.items()))
+
+    def _bundle(self) -> dict:
+        key = self._bundle_key()
+        with self._lock:
+            bundle = self._bundles.get(key)
+            if bundle is None:
+                bundle = {}
+                path = CACHE_DIR / f"{key}.pickle"
+                try:
+                    with open(path, "rb") as f:
+                        bundle = pickle.load(f)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    # 缓存损坏：丢弃重建
+                    logger.warning("样式缓存读取失败 %s: %s", path.name, e)
+                self._bundles[key] = bundle
+        return bundle
+
+    def _save_bundle(self) -> None:
+        """原子写入当前变量组的缓存包"""
+        key = self._bundle_key()
+        path = CACHE_DIR / f"{key}.pickle"
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                pickle.dump(self._bundles[key], f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning("样式缓存写入失败: %s", e)
+
+    # ============== 解析 ==============
+
+    def _parse_rules(self, css, read_from, is_default_rules=False, tie_breaker=0, scope=""):
+        key = _digest(css, read_from, is_default_rules, tie_breaker, scope)
+        self._used.add(key)
+        bundle = self._bundle()
+        rules = bundle.get(key)
+        if rules is not None:
+            self.disk_hits += 1
+            return rules
+        self.disk_misses += 1
+        rules = super()._parse_rules(css, read_from, is_default_rules, tie_breaker, scope)
+        if not any(rule.errors for rule in rules):
+            bundle[key] = rules
+            self._dirty = True
+        return rules
+
+    def parse(self) -> None:
+        self._used = set()
+        super().parse()
+        if self._dirty:
+            # 只保留本次用到的条目 (开发时改过的旧 CSS 不再堆积)
+            bundle = self._bundle()
+            for key in set(bundle) - self._used:
+                del bundle[key]
+            self._dirty = False
+            self._save_bundle()
+
+    def reparse(self) -> None:
+        """在自身上重新解析 (基类会新建普通 Stylesheet，绕过缓存)；出错时保留原规则"""
+        self.parse()
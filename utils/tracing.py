@@ -0,0 +1,188 @@
+"""
+请求生命周期追踪 - Chrome / Perfetto trace-event 导出
+- 预分配环形缓冲区，记录时不新建列表，写满后覆盖最旧的事件
+- 关闭时 span() 直接返回共享空对象，只多一次属性判断，可常驻生产环境
+- 运行时 /trace on|off 开关，关闭时导出 JSON (chrome://tracing 或 ui.perfetto.dev 打开)
+"""
+import itertools
+import json
+import os
+import threading
+import time
+from functools import wraps
+from pathlib import Path
+
+# 缓冲区容量 (事件数)
+TRACE_CAPACITY = 65536
+
+
+class _NullSpan:
+    """关闭状态下的空 span (全局唯一)"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """记录一个完整事件 (ph='X')"""
+    __slots__ = ("_recorder", "_name", "_args", "_start")
+
+    def __init__(self, recorder: "TraceRecorder", name: str, args: dict | None):
+        self._recorder = recorder
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self._recorder._record("X", self._name, self._start, end - self._start, self._args)
+        return False
+
+
+class TraceRecorder:
+    """Trace 事件记录器"""
+
+    def __init__(self, capacity: int = TRACE_CAPACITY):
+        self.enabled = False
+        self._capacity = capacity
+        # 按列预分配，避免每条事件一个 dict
+        self._ph: list = [None] * capacity
+        self._name: list = [None] * capacity
+        self._ts: list = [0] * capacity
+        self._dur: list = [0] * capacity
+        self._tid: list = [0] * capacity
+        self._args: list = [None] * capacity
+        self._counter = itertools.count()
+        self._written = 0
+        self._epoch = time.perf_counter_ns()
+        self._thread_names: dict[int, str] = {}
+        self._async_ids = itertools.count(1)
+
+    # ============== 开关 ==============
+
+    def start(self) -> None:
+        """清空缓冲并开始记录"""
+        self._counter = itertools.count()
+        self._written = 0
+        self._thread_names.clear()
+        self._epoch = time.perf_counter_ns()
+        self.enabled = True
+
+    def stop(self) -> None:
+        """停止记录 (缓冲保留，可随后导出)"""
+        self.enabled = False
+
+    @property
+    def event_count(self) -> int:
+        return min(self._written, self._capacity)
+
+    # ============== 记录 ==============
+
+    def _record(self, ph: str, name: str, start_ns: int, dur_ns: int, args: dict | None) -> None:
+        # itertools.count 的 next() 在 GIL 下是原子的，多线程写入无需加锁
+        seq = next(self._counter)
+        i = seq % self._capacity
+        tid = threading.get_ident()
+        if tid not in self._thread_names:
+            self._thread_names[tid] = threading.current_thread().name
+        self._ph[i] = ph
+        self._name[i] = name
+        self._ts[i] = start_ns
+        self._dur[i] = dur_ns
+        self._tid[i] = tid
+        self._args[i] = args
+        self._written = seq + 1
+
+    def span(self, name: str, **args):
+        """记录一段耗时: with tracer.span("service.sdk_call"): ..."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args or None)
+
+    def instant(self, name: str, **args) -> None:
+        """记录一个瞬时事件 (如首个 chunk 到达)"""
+        if self.enabled:
+            self._record("i", name, time.perf_counter_ns(), 0, args or None)
+
+    def async_begin(self, name: str, **args) -> int | None:
+        """开始一个跨线程的异步区间，返回 id (关闭时返回 None)"""
+        if not self.enabled:
+            return None
+        async_id = next(self._async_ids)
+        self._record("b", name, time.perf_counter_ns(), async_id, args or None)
+        return async_id
+
+    def async_end(self, name: str, async_id: int | None) -> None:
+        """结束异步区间 (id 为 None 时忽略)"""
+        if self.enabled and async_id is not None:
+            self._record("e", name, time.perf_counter_ns(), async_id, None)
+
+    def traced(self, name: str | None = None):
+        """装饰器：整个函数记录为一个 span"""
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Span(self, span_name, None):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # ============== 导出 ==============
+
+    def export(self, path: str | Path) -> Path:
+        """导出为 Chrome trace-event JSON"""
+        pid = os.getpid()
+        written = self._written
+        first = max(0, written - self._capacity)
+        events = []
+        for seq in range(first, written):
+            i = seq % self._capacity
+            ph = self._ph[i]
+            event = {
+                "name": self._name[i],
+                "ph": ph,
+                "ts": (self._ts[i] - self._epoch) / 1000,  # 微秒
+                "pid": pid,
+                "tid": self._tid[i],
+                "cat": self._name[i].split(".", 1)[0],
+            }
+            if ph == "X":
+                event["dur"] = self._dur[i] / 1000
+            elif ph in ("b", "e"):
+                event["id"] = self._dur[i]  # 异步事件复用 dur 列保存 id
+            elif ph == "i":
+                event["s"] = "t"
+            if self._args[i]:
+                event["args"] = self._args[i]
+            events.append(event)
+
+        # 线程名元数据
+        for tid, thread_name in self._thread_names.items():
+            events.append({
+                "name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                "args": {"name": thread_name},
+            })
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return path
+
+
+# 全局实例
+tracer = TraceRecorder()
@@ -1,14 +1,17 @@
 """
-天气获取器 - 双源版
-- 优先: Open-Meteo (免费、无需Key)
-- 备用: 和风天气 (需要配置)
-- 本地缓存 (15分钟有效)
+天气获取器 - 缓存优先版
+- 数据源: Open-Meteo (免费、无需Key)
+- 缓存优先: 15分钟内直接用缓存；过期先返回旧数据，后台异步刷新 (stale-while-revalidate)
+- 条件请求: ETag / Last-Modified，未变化时服务端返回 304
+- 缓存结构化原始数据，展示文本每次由数据格式化生成
 """
-import os
+import asyncio
 import json
 import time
-import urllib.request
 from pathlib import Path
+from typing import Callable
+
+from utils.http import get_async_client
 
 # 缓存配置
 CACHE_DIR = Path(__file__).parent.parent / "data"
@@ -46,102 +49,164 @@ WMO_CODES = {
 
 
 class WeatherFetcher:
-    """天气获取器 (Open-Meteo)"""
+    """天气获取器 (Open-Meteo，缓存优先)"""
     
     def __init__(self):
         CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # 内存缓存: {'timestamp', 'data', 'etag', 'last_modified'}
+        self._cache: dict | None = None
+        self._cache_loaded = False
+        self._revalidating: asyncio.Task | None = None
     
-    def _request(self) -> dict:
-        """发起 API 请求 (绕过代理)"""
-        no_proxy_handler = urllib.request.ProxyHandler({})
-        opener = urllib.request.build_opener(no_proxy_handler)
-        
-        req = urllib.request.Request(OPENMETEO_URL, headers={'User-Agent': 'Mozilla/5.0'})
-        with opener.open(req, timeout=8) as resp:
-            return json.loads(resp.read().decode('utf-8'))
+    # ============== 缓存 ==============
     
     def _load_cache(self) -> dict | None:
-        """加载缓存"""
+        """加载缓存 (磁盘只读一次，之后走内存)"""
+        if self._cache_loaded:
+            return self._cache
+        self._cache_loaded = True
         if not CACHE_FILE.exists():
             return None
         try:
             with open(CACHE_FILE, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-            if time.time() - data.get('timestamp', 0) > CACHE_TTL:
-                return None
-            return data
-        except (json.JSONDecodeError, OSError, KeyError):
-            return None
+            # 旧版缓存存的是 Rich 文本，没有结构化数据，直接作废
+            if isinstance(data.get('data'), dict):
+                self._cache = data
+        except (json.JSONDecodeError, OSError, AttributeError):
+            self._cache = None
+        return self._cache
     
-    def _save_cache(self, today: str, tomorrow: str):
+    def _save_cache(self):
         """保存缓存"""
         try:
             with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump({
-                    'timestamp': time.time(),
-                    'today': today,
-                    'tomorrow': tomorrow
-                }, f, ensure_ascii=False)
+                json.dump(self._cache, f, ensure_ascii=False)
         except (OSError, IOError):
             pass  # 缓存保存失败不影响主流程
     
+    def _is_stale(self, cache: dict) -> bool:
+        return time.time() - cache.get('timestamp', 0) > CACHE_TTL
+    
+    # ============== 网络 ==============
+    
+    async def _request(self) -> dict:
+        """发起条件请求 (直连，复用共享会话)，返回最新的结构化数据"""
+        cache = self._load_cache()
+        headers = {}
+        if cache:
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
+        
+        client = get_async_client(use_proxy=False)
+        resp = await client.get(OPENMETEO_URL, headers=headers, timeout=8)
+        
+        if resp.status_code == 304 and cache:
+            # 数据未变化，只续期
+            cache['timestamp'] = time.time()
+        else:
+            resp.raise_for_status()
+            self._cache = {
+                'timestamp': time.time(),
+                'data': resp.json(),
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+            }
+        self._save_cache()
+        return self._cache['data']
+    
+    async def _revalidate(self, on_update: Callable[[str, str], None] | None) -> None:
+        """后台刷新，成功后回调最新文本"""
+        try:
+            data = await self._request()
+        except Exception:
+            return  # 刷新失败继续用旧数据
+        finally:
+            self._revalidating = None
+        if on_update:
+            on_update(*self._format(data))
+    
+    # ============== 格式化 ==============
+    
     def _get_weather_text(self, code: int) -> str:
         """WMO 代码转中文"""
         return WMO_CODES.get(code, "未知")
     
-    def fetch(self) -> tuple[str, str]:
-        """获取天气信息 (今日+明日)"""
+    def _format(self, data: dict) -> tuple[str, str]:
+        """结构化数据 -> (今日, 明日) Rich 文本"""
+        # 实时天气
+        cur = data['current']
+        temp = cur['temperature_2m']
+        feels = cur['apparent_temperature']
+        humid = cur['relative_humidity_2m']
+        wind = cur['wind_speed_10m']
+        precip = cur['precipitation']
+        code = cur['weather_code']
+        text = self._get_weather_text(code)
+        
+        today_str = (
+            f"[bold cyan]📍 南宁:[/] [yellow]{text}[/] [bold red]{temp:.0f}°C[/] | "
+            f"[dim]🌡️ 体感[/] [red]{feels:.0f}°C[/] | "
+            f"[dim]💧 湿度[/] [blue]{humid}%[/] | "
+            f"[dim]🌬️ 风速[/] [green]{wind:.0f}km/h[/] | "
+            f"[dim]☂️ 降水[/] [cyan]{precip}mm[/]"
+        )
+        
+        # 明日预报 (daily[1])
+        daily = data['daily']
+        tom_date = daily['time'][1]
+        tom_code = daily['weather_code'][1]
+        tom_text = self._get_weather_text(tom_code)
+        tom_min = daily['temperature_2m_min'][1]
+        tom_max = daily['temperature_2m_max'][1]
+        tom_uv = daily['uv_index_max'][1]
+        tom_rain = daily.get('precipitation_probability_max', [0, 0])[1]
+        tom_sunrise = daily.get('sunrise', ['', ''])[1][-5:] if daily.get('sunrise') else ''
+        tom_sunset = daily.get('sunset', ['', ''])[1][-5:] if daily.get('sunset') else ''
+        
+        tom_str = (
+            f"[bold cyan]明日[/] [dim]({tom_date}):[/] [yellow]{tom_text}[/] "
+            f"[blue]{tom_min:.0f}[/]~[red]{tom_max:.0f}°C[/] | "
+            f"[dim]☔ 降水概率[/] [cyan]{tom_rain}%[/] | "
+            f"[dim]☀️ UV[/] [magenta]{tom_uv:.0f}[/] | "
+            f"[dim]🌅[/] {tom_sunrise} [dim]🌇[/] {tom_sunset}"
+        )
+        return today_str, tom_str
+    
+    # ============== 对外接口 ==============
+    
+    def get_cached(self) -> tuple[str, str] | None:
+        """只读缓存，不触网 (无缓存返回 None)"""
+        cache = self._load_cache()
+        if not cache:
+            return None
+        try:
+            return self._format(cache['data'])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+    
+    async def fetch(self, on_update: Callable[[str, str], None] | None = None) -> tuple[str, str]:
+        """
+        获取天气信息 (今日+明日)，缓存优先
+        - 缓存新鲜: 直接返回，不触网
+        - 缓存过期: 立即返回旧数据，后台刷新完成后调用 on_update
+        - 没有缓存: 等待网络请求
+        """
+        cache = self._load_cache()
+        cached = self.get_cached()
+        if cached:
+            if not self._is_stale(cache):
+                return cached
+            if self._revalidating is None:
+                self._revalidating = asyncio.create_task(self._revalidate(on_update))
+            today, tomorrow = cached
+            return f"{today} [dim](缓存)[/dim]", tomorrow
+        
         try:
-            data = self._request()
-            
-            # 实时天气
-            cur = data['current']
-            temp = cur['temperature_2m']
-            feels = cur['apparent_temperature']
-            humid = cur['relative_humidity_2m']
-            wind = cur['wind_speed_10m']
-            precip = cur['precipitation']
-            code = cur['weather_code']
-            text = self._get_weather_text(code)
-            
-            today_str = (
-                f"[bold cyan]📍 南宁:[/] [yellow]{text}[/] [bold red]{temp:.0f}°C[/] | "
-                f"[dim]🌡️ 体感[/] [red]{feels:.0f}°C[/] | "
-                f"[dim]💧 湿度[/] [blue]{humid}%[/] | "
-                f"[dim]🌬️ 风速[/] [green]{wind:.0f}km/h[/] | "
-                f"[dim]☂️ 降水[/] [cyan]{precip}mm[/]"
-            )
-            
-            # 明日预报 (daily[1])
-            daily = data['daily']
-            tom_date = daily['time'][1]
-            tom_code = daily['weather_code'][1]
-            tom_text = self._get_weather_text(tom_code)
-            tom_min = daily['temperature_2m_min'][1]
-            tom_max = daily['temperature_2m_max'][1]
-            tom_uv = daily['uv_index_max'][1]
-            tom_rain = daily.get('precipitation_probability_max', [0, 0])[1]
-            tom_sunrise = daily.get('sunrise', ['', ''])[1][-5:] if daily.get('sunrise') else ''
-            tom_sunset = daily.get('sunset', ['', ''])[1][-5:] if daily.get('sunset') else ''
-            
-            tom_str = (
-                f"[bold cyan]明日[/] [dim]({tom_date}):[/] [yellow]{tom_text}[/] "
-                f"[blue]{tom_min:.0f}[/]~[red]{tom_max:.0f}°C[/] | "
-                f"[dim]☔ 降水概率[/] [cyan]{tom_rain}%[/] | "
-                f"[dim]☀️ UV[/] [magenta]{tom_uv:.0f}[/] | "
-                f"[dim]🌅[/] {tom_sunrise} [dim]🌇[/] {tom_sunset}"
-            )
-            
-            # 缓存
-            self._save_cache(today_str, tom_str)
-            
-            return today_str, tom_str
-            
+            return self._format(await self._request())
         except Exception as e:
-            # 尝试读取缓存
-            cache = self._load_cache()
-            if cache:
-                return f"{cache['today']} [dim](缓存)[/dim]", cache['tomorrow']
             return f"⚠️ 天气服务异常 ({str(e)})", "明日数据不可用"
 
 
@@ -2,6 +2,8 @@
 from .message_log import MessageLog, UserBubble, AIBubble, SystemBubble, InlineInput
 from .status_bar import StatusBar
 from .glitch_label import GlitchLabel, GlitchAIBubble
+from .compare_view import CompareView
+from .prompt_queue import PromptQueue
 
 __all__ = [
     "MessageLog",
@@ -12,6 +14,8 @@ __all__ = [
     "StatusBar",
     "GlitchLabel",
     "GlitchAIBubble",
+    "CompareView",
+    "PromptQueue",
 ]
 
 
@@ -0,0 +1,107 @@
+"""
+多模型对比视图 - 并排显示各模型的流式回答与指标
+- 工作线程只写 CompareResult，本组件按帧轮询刷新 (不逐 chunk 跨线程调度)
+- 全部完成后取消订阅，回答渲染为 Markdown
+"""
+from rich.markdown import Markdown
+from rich.text import Text
+from textual.containers import Horizontal, Vertical
+from textual.widgets import Label, Static
+
+from services.compare import CompareResult, CompareRun
+from .frame_scheduler import get_frame_scheduler
+
+# 流式阶段刷新频率
+REFRESH_FPS = 10
+
+
+def format_metrics(result: CompareResult) -> Text:
+    """单个模型的指标行"""
+    text = Text()
+    if result.state == "error":
+        text.append(f"⚠️ {result.error[:80]}", style="red")
+        return text
+    if result.state == "pending":
+        text.append("⏳ 排队中 (等待并发名额)...", style="dim")
+        return text
+    if result.ttft_ms is None:
+        text.append("⏳ 等待首字...", style="dim")
+        return text
+    text.append(f"TTFT {result.ttft_ms:,.0f}ms", style="bold")
+    if result.state == "streaming":
+        text.append(f"  ·  {len(result.content):,} 字", style="dim")
+        return text
+    text.append(f"  ·  总 {result.total_ms / 1000:.1f}s")
+    tps = result.tokens_per_s
+    if tps:
+        text.append(f"  ·  {tps:.0f} tok/s", style="green")
+    mark = "≈" if result.estimated else ""
+    text.append(f"\n入 {mark}{result.input_tokens:,} / 出 {mark}{result.output_tokens:,} tokens", style="dim")
+    return text
+
+
+class ComparePane(Vertical):
+    """单个模型一列"""
+
+    def __init__(self, result: CompareResult):
+        super().__init__(classes="compare-pane ai-bubble-container")
+        self.result = result
+        self._shown = (None, -1)  # (state, 内容长度) 无变化时不重绘
+
+    def compose(self):
+        yield Label(f"🤖 {self.result.model}", classes="bubble-header ai-header")
+        yield Static("", classes="bubble-content compare-content")
+        yield Static("", classes="compare-metrics")
+
+    def on_mount(self) -> None:
+        self.refresh_result()
+
+    def refresh_result(self) -> None:
+        result = self.result
+        shown = (result.state, len(result.content))
+        if shown == self._shown:
+            return
+        self._shown = shown
+        content = self.query_one(".compare-content", Static)
+        if result.state == "done":
+            content.update(Markdown(result.content or "(空)"))
+        else:
+            content.update(Text(result.content or "▌", style="cyan"))
+        self.query_one(".compare-metrics", Static).update(format_metrics(result))
+
+
+class CompareView(Horizontal):
+    """一次 /compare 的并排视图"""
+
+    def __init__(self, run: CompareRun):
+        super().__init__(classes="compare-view")
+        self.run = run
+        self._frame_handle: int | None = None
+
+    def compose(self):
+        for result in self.run.results:
+            yield ComparePane(result)
+
+    def on_mount(self) -> None:
+        if not self.run.finished:
+            self._frame_handle = get_frame_scheduler(self).subscribe(
+                self, self._on_frame, fps=REFRESH_FPS, keep_awake=True
+            )
+
+    def on_unmount(self) -> None:
+        self._stop_timer()
+
+    def _stop_timer(self) -> None:
+        if self._frame_handle is not None:
+            get_frame_scheduler(self).unsubscribe(self._frame_handle)
+            self._frame_handle = None
+
+    def _on_frame(self) -> None:
+        self.refresh_results()
+        if self.run.finished:
+            self._stop_timer()
+
+    def refresh_results(self) -> None:
+        """刷新所有列 (也可在结果完成时直接调用)"""
+        for pane in self.query(ComparePane):
+            pane.refresh_result()
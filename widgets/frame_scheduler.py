@@ -0,0 +1,204 @@
+"""
+帧调度器 - 全局统一动画时钟
+- 所有动画共用一个 App 级定时器，不再各自 set_interval
+- 跳过不可见组件（未挂载 / display=False / 滚出视口）
+- 失焦或空闲时自动降频，没有订阅时直接停表
+- 每秒统计一次帧数与耗时
+"""
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from textual.timer import Timer
+from textual.widget import Widget
+
+
+# ============== 配置参数 ==============
+ACTIVE_FPS = 20     # 活跃帧率上限 (50ms，对齐原 Token 动画)
+IDLE_FPS = 2        # 失焦 / 空闲时的帧率
+IDLE_AFTER = 30.0   # 无用户操作多久视为空闲 (秒)
+
+
+@dataclass
+class FrameStats:
+    """上一秒的调度统计"""
+    clock_fps: int = 0          # 当前时钟频率
+    frames: int = 0             # 实际执行的帧数
+    callbacks: int = 0          # 实际执行的回调次数
+    skipped: int = 0            # 因不可见而跳过的回调次数
+    busy_ms: float = 0.0        # 回调耗时合计 (毫秒)
+    subscribers: int = 0        # 当前订阅数
+
+
+@dataclass
+class _Subscription:
+    """单个动画订阅"""
+    widget: Widget
+    callback: Callable[[], None]
+    interval: float
+    keep_awake: bool = False    # 代表正在进行的工作 (如思考动画)，空闲时不降频
+    next_due: float = 0.0
+
+
+def _is_visible(widget: Widget) -> bool:
+    """组件是否真正显示在屏幕上"""
+    try:
+        return widget.is_mounted and widget.display and widget.is_on_screen
+    except Exception:
+        return False
+
+
+class FrameScheduler:
+    """App 级帧调度器 - 一个时钟驱动所有动画"""
+
+    def __init__(self, app):
+        self._app = app
+        self._subs: dict[int, _Subscription] = {}
+        self._next_handle = 1
+        self._timer: Timer | None = None
+        self._clock_fps = 0
+        self._focused = True
+        self._last_activity = time.monotonic()
+
+        # 统计窗口 (每秒滚动一次)
+        self._window_start = time.monotonic()
+        self._frames = 0
+        self._callbacks = 0
+        self._skipped = 0
+        self._busy = 0.0
+        self.stats = FrameStats()
+
+    # ============== 订阅接口 ==============
+
+    def subscribe(
+        self,
+        widget: Widget,
+        callback: Callable[[], None],
+        fps: float,
+        keep_awake: bool = False,
+    ) -> int:
+        """订阅动画帧，返回句柄 (用于取消订阅)"""
+        handle = self._next_handle
+        self._next_handle += 1
+        self._subs[handle] = _Subscription(
+            widget=widget,
+            callback=callback,
+            interval=1.0 / max(0.1, fps),
+            keep_awake=keep_awake,
+            next_due=time.monotonic(),
+        )
+        self._retune()
+        return handle
+
+    def unsubscribe(self, handle: int | None) -> None:
+        """取消订阅 (重复取消无副作用)"""
+        if handle is not None and self._subs.pop(handle, None) is not None:
+            self._retune()
+
+    # ============== 节流状态 ==============
+
+    def touch(self) -> None:
+        """记录一次用户活动 (按键 / 鼠标)，空闲状态下立即恢复帧率"""
+        was_idle = self._is_idle(time.monotonic())
+        self._last_activity = time.monotonic()
+        if was_idle:
+            self._retune()
+
+    def set_focused(self, focused: bool) -> None:
+        """终端获得 / 失去焦点"""
+        self._focused = focused
+        self._last_activity = time.monotonic()
+        self._retune()
+
+    def _is_idle(self, now: float) -> bool:
+        return now - self._last_activity > IDLE_AFTER
+
+    def _target_fps(self) -> int:
+        """根据订阅和焦点状态计算时钟频率 (0 = 停表)"""
+        if not self._subs:
+            return 0
+        # 时钟不必快于最快的订阅
+        wanted = min(ACTIVE_FPS, max(round(1.0 / s.interval) for s in self._subs.values()))
+        wanted = max(1, wanted)
+        if not self._focused:
+            return min(wanted, IDLE_FPS)
+        busy = any(s.keep_awake for s in self._subs.values())
+        if not busy and self._is_idle(time.monotonic()):
+            return min(wanted, IDLE_FPS)
+        return wanted
+
+    def _retune(self) -> None:
+        """按目标帧率重建 (或停止) 时钟"""
+        target = self._target_fps()
+        if target == self._clock_fps:
+            return
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        self._clock_fps = target
+        if target == 0:
+            self.stats = FrameStats()
+        else:
+            self._timer = self._app.set_interval(1.0 / target, self._tick, name="frame-scheduler")
+
+    # ============== 时钟 ==============
+
+    def _tick(self) -> None:
+        """一帧：依次执行到期且可见的订阅"""
+        now = time.monotonic()
+        started = time.perf_counter()
+        ran = False
+        dropped = False
+
+        for handle, sub in list(self._subs.items()):
+            if now < sub.next_due:
+                continue
+            # 保持节拍，落后太多时不补帧
+            sub.next_due = max(sub.next_due + sub.interval, now)
+            if not _is_visible(sub.widget):
+                self._skipped += 1
+                continue
+            try:
+                sub.callback()
+            except Exception:
+                # 单个动画出错只摘掉它自己
+                self._subs.pop(handle, None)
+                dropped = True
+            self._callbacks += 1
+            ran = True
+
+        if ran:
+            self._frames += 1
+        self._busy += time.perf_counter() - started
+
+        if now - self._window_start >= 1.0:
+            self._roll_stats(now)
+            # 每秒检查一次是否进入空闲
+            self._retune()
+        elif dropped:
+            # 摘掉订阅后按剩余订阅调整时钟 (没有订阅时停止)
+            self._retune()
+
+    def _roll_stats(self, now: float) -> None:
+        """结算上一秒的统计"""
+        self.stats = FrameStats(
+            clock_fps=self._clock_fps,
+            frames=self._frames,
+            callbacks=self._callbacks,
+            skipped=self._skipped,
+            busy_ms=self._busy * 1000,
+            subscribers=len(self._subs),
+        )
+        self._window_start = now
+        self._frames = self._callbacks = self._skipped = 0
+        self._busy = 0.0
+
+
+def get_frame_scheduler(widget: Widget) -> FrameScheduler:
+    """获取组件所属 App 的帧调度器 (不存在时自动挂载)"""
+    app = widget.app
+    scheduler = getattr(app, "frame_scheduler", None)
+    if scheduler is None:
+        scheduler = FrameScheduler(app)
+        app.frame_scheduler = scheduler
+    return scheduler
@@ -5,9 +5,16 @@ GlitchLabel 组件 - 简化版：纯 Markdown 输出
 """
 import random
 from textual.widgets import Static
-from textual.timer import Timer
+from rich.console import Console
+from rich.markdown import Markdown
 from rich.text import Text
 
+from .frame_scheduler import get_frame_scheduler
+from utils.highlight import DEFAULT_THEME, highlight_cache, is_large, plain
+from utils.markdown_stream import MdBlock, parse_blocks
+from utils.text_width import truncate
+from utils.tracing import tracer
+
 
 # ============== 配置参数 ==============
 # 速度档位 (保留，用于未来扩展)
@@ -18,6 +25,40 @@ SPEED_LEVELS = {
 }
 CURRENT_SPEED = "normal"
 
+# 气泡标题中模型名最多占用的显示宽度
+HEADER_MODEL_WIDTH = 28
+
+# Markdown 渲染宽度
+RENDER_WIDTH = 100
+# 检查可见代码块并补高亮的频率
+HIGHLIGHT_FPS = 5
+
+_render_console: Console | None = None
+
+
+def _get_render_console() -> Console:
+    """共享的离屏渲染 Console (只在 UI 线程使用)"""
+    global _render_console
+    if _render_console is None:
+        _render_console = Console(force_terminal=True, width=RENDER_WIDTH, no_color=False)
+    return _render_console
+
+
+def render_block(block: MdBlock) -> Text:
+    """渲染单个 Markdown 块 (去掉 Rich 在块前插入的空行，块间距由调用方统一加)"""
+    rendered = Text()
+    leading = True
+    for segment in _get_render_console().render(
+        Markdown(block.text, justify="left", code_theme="monokai")
+    ):
+        if not segment.text:
+            continue
+        if leading and segment.text == "\n":
+            continue
+        leading = False
+        rendered.append(segment.text, style=segment.style)
+    return rendered
+
 
 def get_speed_config():
     """获取当前速度配置"""
@@ -54,12 +95,15 @@ class GlitchLabel(Static):
         self._target_text = text
         self._decoded_count = 0
         self._frame = 0
-        self._timer: Timer | None = None
+        self._frame_handle: int | None = None
         self._custom_style = style
     
     def on_mount(self) -> None:
         if self._target_text:
             self._start_decode()
+
+    def on_unmount(self) -> None:
+        self._stop_decode()
     
     def set_text_with_glitch(self, text: str) -> None:
         """设置文本并触发解码动画"""
@@ -69,15 +113,19 @@ class GlitchLabel(Static):
         self._start_decode()
     
     def _start_decode(self) -> None:
-        """启动解码动画"""
-        if self._timer is not None:
-            self._timer.stop()
+        """启动解码动画 (挂到全局帧调度器)"""
+        self._stop_decode()
         
         fps = 10
         total_frames = 10
         self._chars_per_frame = max(1, len(self._target_text) / total_frames)
         
-        self._timer = self.set_interval(1 / fps, self._animate_frame, name="glitch")
+        self._frame_handle = get_frame_scheduler(self).subscribe(self, self._animate_frame, fps)
+    
+    def _stop_decode(self) -> None:
+        if self._frame_handle is not None:
+            get_frame_scheduler(self).unsubscribe(self._frame_handle)
+            self._frame_handle = None
     
     def _animate_frame(self) -> None:
         """每帧：已解码部分 + 乱码尾部"""
@@ -102,9 +150,7 @@ class GlitchLabel(Static):
         self._decoded_count = min(int(self._frame * self._chars_per_frame), text_len)
     
     def _finalize(self) -> None:
-        if self._timer:
-            self._timer.stop()
-            self._timer = None
+        self._stop_decode()
         self.update(Text(self._target_text, style=self._custom_style))
 
 
@@ -118,27 +164,48 @@ class GlitchAIBubble(Vertical):
     
     流程：
     1. API 流式返回 -> 后台积累（显示"思考中"动画）
-    2. 完成后 -> 直接显示 Markdown 渲染结果
+       订阅流式分块器：每个块闭合时渲染一次并缓存
+    2. 完成后 -> 拼接已渲染的块，只渲染剩余的未闭合部分
+    3. 代码块先显示纯文本，滚到可见时再高亮 (结果全局缓存)
     """
     
-    def __init__(self, model_name: str = "AI"):
+    def __init__(self, model_name: str = "AI", content: str = "", state: str = "streaming"):
         super().__init__()
-        self._raw_content = ""
-        self._is_streaming = True
-        self._timer: Timer | None = None
+        # content/state 用于切换标签页时从会话数据恢复气泡
+        self._raw_content = content
+        self._is_streaming = state == "streaming"
+        self._is_error = state == "error"
+        self._frame_handle: int | None = None
         self._thinking_frame = 0
         self._model_name = model_name
+        self._rendered: list[Text] = []  # 已闭合块的渲染缓存 (按块顺序)
+        # 懒高亮：尚未高亮的代码块 (渲染序号 -> 块) 与各块在显示文本中的行范围
+        self._unhighlighted: dict[int, MdBlock] = {}
+        self._highlighting: set[int] = set()
+        self._line_spans: list[tuple[int, int]] = []
+        self._total_lines = 0
+        self._highlight_handle: int | None = None
         
         self.add_class("ai-bubble-container")
 
     def compose(self):
-        header_text = f"🤖 {self._model_name.upper()} │ 💬 RESPONSE"
+        model = truncate(self._model_name.upper(), HEADER_MODEL_WIDTH, "…")
+        header_text = f"🤖 {model} │ 💬 RESPONSE"
         yield Label(header_text, classes="bubble-header ai-header")
         yield Static("", id="ai-content", classes="bubble-content")
     
     def on_mount(self) -> None:
-        """启动思考动画"""
-        self._start_thinking_animation()
+        """启动思考动画 (恢复的气泡直接显示结果)"""
+        if self._is_streaming:
+            self._start_thinking_animation()
+        elif self._is_error:
+            self._show_error()
+        else:
+            self._render_and_display()
+
+    def on_unmount(self) -> None:
+        self._stop_timer()
+        self._stop_highlight()
     
     @property
     def display_widget(self) -> Static:
@@ -147,8 +214,10 @@ class GlitchAIBubble(Vertical):
     # ============== 阶段1: 流式接收 + 思考动画 ==============
     
     def _start_thinking_animation(self) -> None:
-        """显示"思考中"动画"""
-        self._timer = self.set_interval(0.15, self._thinking_tick, name="thinking")
+        """显示"思考中"动画 (挂到全局帧调度器，滚出视口时自动跳过)"""
+        self._frame_handle = get_frame_scheduler(self).subscribe(
+            self, self._thinking_tick, fps=1 / 0.15, keep_awake=True
+        )
     
     def _thinking_tick(self) -> None:
         """思考动画 tick"""
@@ -188,6 +257,21 @@ class GlitchAIBubble(Vertical):
         """接收 API 流式返回的文本块 (只积累，不显示)"""
         self._raw_content += chunk
 
+    def add_block(self, block: MdBlock) -> None:
+        """分块器事件：块已闭合，立即渲染并缓存 (流式期间分摊渲染开销)"""
+        try:
+            if block.kind == "code":
+                # 代码块先用缓存的高亮结果，没有则放纯文本占位，滚到可见时再高亮
+                part = highlight_cache.cached(block.code, block.lang, DEFAULT_THEME, RENDER_WIDTH)
+                if part is None:
+                    part = plain(block.code, DEFAULT_THEME, RENDER_WIDTH)
+                    self._unhighlighted[len(self._rendered)] = block
+                self._rendered.append(part)
+            else:
+                self._rendered.append(render_block(block))
+        except Exception:
+            self._rendered.append(Text(block.text, style="cyan"))
+
     # ============== 阶段2: 直接显示 Markdown ==============
 
     def finalize_with_glitch(self) -> None:
@@ -195,54 +279,139 @@ class GlitchAIBubble(Vertical):
         self._is_streaming = False
         self._stop_timer()
         
-        # 渲染并显示
-        self._render_and_display()
+        # 渲染并显示 (尚未挂载时由 on_mount 渲染)
+        if self.is_mounted:
+            self._render_and_display()
     
     def _render_and_display(self) -> None:
         """渲染 Markdown 并直接显示"""
+        with tracer.span("ui.render_and_display", chars=len(self._raw_content)):
+            self._render_markdown()
+
+    def _render_markdown(self) -> None:
         try:
-            from rich.markdown import Markdown
-            from rich.console import Console
-            from rich.text import Text as RichText
-            
-            # 使用合适的宽度
-            console = Console(force_terminal=True, width=100, no_color=False)
-            md = Markdown(self._raw_content, justify="left", code_theme="monokai")
-            
-            # 渲染为 Text
-            rendered = RichText()
-            for segment in console.render(md):
-                if segment.text:
-                    rendered.append(segment.text, style=segment.style)
-            
-            # 创建带统计头的最终文本
-            char_count = len(self._raw_content)
-            est_tokens = max(1, int(char_count * 0.7))
-            
-            final_text = Text()
-            final_text.append("📊 ", style="dim")
-            final_text.append(f"{char_count}", style="bold yellow")
-            final_text.append(" 字符", style="dim")
-            final_text.append(" │ ", style="dim")
-            final_text.append(f"≈{est_tokens}", style="bold magenta")
-            final_text.append(" tokens", style="dim")
-            final_text.append("\n\n", style="dim")
-            
-            # 添加渲染后的内容
-            final_text.append_text(rendered)
-            
-            self.display_widget.update(final_text)
+            # 恢复的气泡没有经过流式分块，这里一次性分块
+            if not self._rendered and self._raw_content:
+                for block in parse_blocks(self._raw_content):
+                    self.add_block(block)
+            self._compose_display()
+            if self._unhighlighted:
+                self._start_highlight()
             
         except Exception as e:
             # 降级：纯文本
             self.display_widget.update(Text(self._raw_content, style="cyan"))
 
+    def _compose_display(self) -> None:
+        """拼接统计头与各块的渲染结果，并记录每块所在的行范围"""
+        # 创建带统计头的最终文本
+        char_count = len(self._raw_content)
+        est_tokens = max(1, int(char_count * 0.7))
+        
+        final_text = Text()
+        final_text.append("📊 ", style="dim")
+        final_text.append(f"{char_count}", style="bold yellow")
+        final_text.append(" 字符", style="dim")
+        final_text.append(" │ ", style="dim")
+        final_text.append(f"≈{est_tokens}", style="bold magenta")
+        final_text.append(" tokens", style="dim")
+        final_text.append("\n\n", style="dim")
+        line = 2
+        
+        # 添加渲染后的内容
+        self._line_spans = []
+        for index, part in enumerate(self._rendered):
+            if index:
+                final_text.append("\n")
+                line += 1
+            final_text.append_text(part)
+            height = part.plain.count("\n")
+            self._line_spans.append((line, line + height))
+            line += height
+        self._total_lines = line
+        
+        self.display_widget.update(final_text)
+
+    # ============== 阶段3: 可见代码块懒高亮 ==============
+
+    def _start_highlight(self) -> None:
+        """挂到帧调度器：气泡不在屏幕上时调度器直接跳过"""
+        if self._highlight_handle is None and self.is_mounted:
+            self._highlight_handle = get_frame_scheduler(self).subscribe(
+                self, self._highlight_visible, fps=HIGHLIGHT_FPS
+            )
+
+    def _stop_highlight(self) -> None:
+        if self._highlight_handle is not None:
+            get_frame_scheduler(self).unsubscribe(self._highlight_handle)
+            self._highlight_handle = None
+
+    def _visible_lines(self) -> tuple[float, float] | None:
+        """显示文本中当前可见的行范围 (组件窄于渲染宽度时会折行，按高度比例换算)"""
+        try:
+            geometry = self.screen.find_widget(self.display_widget)
+        except Exception:
+            return None
+        region, visible = geometry.region, geometry.visible_region
+        if not visible.height or not region.height:
+            return None
+        scale = self._total_lines / region.height
+        return (visible.y - region.y) * scale, (visible.bottom - region.y) * scale
+
+    def _highlight_visible(self) -> None:
+        """高亮可见范围 (前后各预取一屏) 内的代码块；大块交给工作线程"""
+        if not self._unhighlighted:
+            self._stop_highlight()
+            return
+        lines = self._visible_lines()
+        if lines is None:
+            return
+        top, bottom = lines
+        margin = bottom - top
+        changed = False
+        for index, block in list(self._unhighlighted.items()):
+            start, end = self._line_spans[index]
+            if end < top - margin or start > bottom + margin or index in self._highlighting:
+                continue
+            if is_large(block.code):
+                self._highlighting.add(index)
+                self.run_worker(
+                    lambda index=index, block=block: self._highlight_in_thread(index, block),
+                    thread=True, group="highlight", exit_on_error=False,
+                )
+                continue
+            with tracer.span("ui.highlight", lines=end - start):
+                self._rendered[index] = highlight_cache.highlight(
+                    block.code, block.lang, DEFAULT_THEME, RENDER_WIDTH
+                )
+            del self._unhighlighted[index]
+            changed = True
+        if changed:
+            self._compose_display()
+
+    def _highlight_in_thread(self, index: int, block: MdBlock) -> None:
+        """工作线程：高亮大代码块 (结果进缓存，再回到 UI 线程替换)"""
+        text = highlight_cache.highlight(block.code, block.lang, DEFAULT_THEME, RENDER_WIDTH)
+        self.app.call_from_thread(self._on_highlighted, index, text)
+
+    def _on_highlighted(self, index: int, text: Text) -> None:
+        self._highlighting.discard(index)
+        if not self.is_mounted or self._unhighlighted.pop(index, None) is None:
+            return
+        self._rendered[index] = text
+        self._compose_display()
+
     # ============== 辅助方法 ==============
     
     def set_reconnecting(self, attempt: int = 1, max_attempts: int = 5) -> None:
         styled = Text()
         styled.append("⚠️ API 连接中断 (CONNECTION_LOST)\n", style="bold red")
-        styled.append(f"⟳ 正在尝试切换线路并重连... ({attempt}/{max_attempts})", style="yellow blink")
+        if self._raw_content:
+            # 已输出的部分保留，重连后从断点续写
+            styled.append(f"⟳ 正在重连并从断点续写 (已收到 {len(self._raw_content)} 字)... ({attempt}/{max_attempts})",
+                          style="yellow blink")
+        else:
+            styled.append(f"⟳ 正在尝试切换线路并重连... ({attempt}/{max_attempts})", style="yellow blink")
         self.display_widget.update(styled)
         self.add_class("reconnecting")
     
@@ -250,11 +419,16 @@ class GlitchAIBubble(Vertical):
         self._stop_timer()
         self._raw_content = f"⚠️ 错误: {error}"
         self._is_streaming = False
+        self._is_error = True
+        if self.is_mounted:
+            self._show_error()
+    
+    def _show_error(self) -> None:
         self.display_widget.update(Text(self._raw_content, style="red"))
         self.add_class("error-bubble")
         self.remove_class("reconnecting")
     
     def _stop_timer(self) -> None:
-        if self._timer:
-            self._timer.stop()
-            self._timer = None
+        if self._frame_handle is not None:
+            get_frame_scheduler(self).unsubscribe(self._frame_handle)
+            self._frame_handle = None
@@ -6,6 +6,9 @@ from textual.containers import ScrollableContainer, Vertical
 from textual.message import Message
 
 from .glitch_label import GlitchAIBubble
+from .compare_view import CompareView
+from utils.input_history import input_history
+from utils.tracing import tracer
 
 
 class MessageBubble(Vertical):
@@ -50,6 +53,8 @@ AIBubble = GlitchAIBubble
 
 class InlineInputContainer(Vertical):
     """内联输入框容器 - 带标题和边框"""
+
+    HEADER = "💬 CONSOLE │ ✏️ INPUT"
     
     def __init__(self, input_widget: "InlineInput"):
         super().__init__()
@@ -58,9 +63,13 @@ class InlineInputContainer(Vertical):
         
     def compose(self):
         # 输入框标题
-        yield Label("💬 CONSOLE │ ✏️ INPUT", classes="bubble-header input-header")
+        yield Label(self.HEADER, classes="bubble-header input-header")
         yield self.input_widget
 
+    def set_header(self, text: str | None) -> None:
+        """更新标题 (None 恢复默认)"""
+        self.query_one(".input-header", Label).update(text or self.HEADER)
+
 
 class ShortcutTriggered(Message):
     """快捷键触发事件 - 转发到 App 层处理"""
@@ -70,10 +79,7 @@ class ShortcutTriggered(Message):
 
 
 class InlineInput(TextArea):
-    """内联输入框 - 多行支持 + 历史记录"""
-
-    # 全局输入历史 (所有输入框共享)
-    HISTORY: list[str] = []
+    """内联输入框 - 多行支持 + 持久化历史记录 (上下键按已输入前缀过滤，Ctrl+R 反向搜索)"""
 
     class Submitted(Message):
         """输入提交事件"""
@@ -88,8 +94,12 @@ class InlineInput(TextArea):
         self.add_class("inline-input")
         # 历史记录指针 (None 表示在最新空白处)
         self._history_index: int | None = None
+        # 本轮上下键浏览的条目 (按下第一次上键时按已输入内容取前缀匹配)
+        self._history_items: list[str] = []
         # 暂存当前正在输入的内容 (以便从历史切回来时不丢失)
         self._temp_input: str = ""
+        # Ctrl+R 搜索状态 (None 表示不在搜索中)
+        self._search: dict | None = None
 
     def _emit_shortcut(self, action: str) -> None:
         """发送快捷键事件到 App 层"""
@@ -99,23 +109,40 @@ class InlineInput(TextArea):
     def value(self) -> str:
         return self.text
 
-    def _on_key(self, event) -> None:
+    async def _on_key(self, event) -> None:
         """拦截按键事件 - 处理快捷键、Enter、上、下键"""
         key = event.key if hasattr(event, 'key') else ''
         key_lower = key.lower()
 
+        # 反向搜索模式下的按键
+        if self._search is not None and self._handle_search_key(event, key_lower):
+            event.prevent_default()
+            event.stop()
+            return
+
         # 功能键快捷键
-        if key_lower in ["f2", "f5", "f12"]:
+        if key_lower in ["f2", "f3", "f4", "f5", "f12"]:
             event.prevent_default()
             event.stop()
             if key_lower == "f2":
                 self._emit_shortcut("clear_log")
+            elif key_lower == "f3":
+                self._emit_shortcut("prev_session")
+            elif key_lower == "f4":
+                self._emit_shortcut("next_session")
             elif key_lower == "f5":
                 self._emit_shortcut("reset_session")
             elif key_lower == "f12":
                 self._emit_shortcut("switch_flavor")
             return
 
+        # Esc 中断正在生成的回答
+        if key_lower == "escape":
+            event.prevent_default()
+            event.stop()
+            self._emit_shortcut("stop_generation")
+            return
+
         # 检测 Ctrl+ 字母组合
         # 支持两种格式：直接 "ctrl+s" 等或单独的字符 + ctrl 属性
         is_ctrl = False
@@ -134,8 +161,12 @@ class InlineInput(TextArea):
                 self._emit_shortcut("switch_speed")
             elif key_lower == "d":
                 self._emit_shortcut("switch_service")
+            elif key_lower == "t":
+                self._emit_shortcut("new_session")
             elif key_lower == "q":
                 self._emit_shortcut("quit")
+            elif key_lower == "r":
+                self._start_search()
             return
 
         # 处理 "ctrl+x" 格式的按键 (某些 Textual 版本)
@@ -150,8 +181,12 @@ class InlineInput(TextArea):
                         self._emit_shortcut("switch_speed")
                     elif letter == "d":
                         self._emit_shortcut("switch_service")
+                    elif letter == "t":
+                        self._emit_shortcut("new_session")
                     elif letter == "q":
                         self._emit_shortcut("quit")
+                    elif letter == "r":
+                        self._start_search()
                     return
 
         # Enter 键发送消息
@@ -177,55 +212,118 @@ class InlineInput(TextArea):
                 event.stop()
                 return
 
-        # 其他按键交给父类处理
-        super()._on_key(event)
+        # 其他按键交给父类处理 (TextArea._on_key 是协程)
+        await super()._on_key(event)
 
     def _navigate_history(self, direction: int) -> None:
         """导航历史记录 (-1: 上一条, 1: 下一条)"""
-        if not self.HISTORY:
-            return
-
-        # 如果当前在“最新”位置，先暂存当前输入
+        # 如果当前在“最新”位置，先暂存当前输入，并按其前缀筛选历史
         if self._history_index is None:
-            self._temp_input = self.text
-
-        # 计算新索引
-        new_index = -1
-        if self._history_index is None:
-            # 从最新处开始按上键 -> 列表最后一个
-            if direction == -1:
-                new_index = len(self.HISTORY) - 1
-            else:
+            if direction != -1:
                 return # 在最新处按下键无效
+            self._temp_input = self.text
+            prefix = self.text.strip()
+            self._history_items = input_history.with_prefix(prefix) if prefix else input_history.entries()
+            if not self._history_items:
+                return
+            new_index = len(self._history_items) - 1
         else:
             new_index = self._history_index + direction
         
         # 边界检查
         if new_index < 0:
             new_index = 0 # 到底了
-        elif new_index >= len(self.HISTORY):
-            # 超过最旧的一条，回到“最新”空白/暂存状态
+        elif new_index >= len(self._history_items):
+            # 超过最新的一条，回到“最新”空白/暂存状态
             self._history_index = None
-            self.text = self._temp_input
-            self.cursor_location = (len(self.text.splitlines()) - 1, len(self.text)) # 光标移到最后
+            self._set_text(self._temp_input)
             return
 
         # 应用历史记录
         self._history_index = new_index
-        history_text = self.HISTORY[new_index]
-        self.text = history_text
-        
-        # 光标移到末尾
-        lines = history_text.splitlines() or [""]
+        self._set_text(self._history_items[new_index])
+
+    def _set_text(self, text: str) -> None:
+        """替换内容并把光标移到末尾"""
+        self.text = text
+        lines = text.splitlines() or [""]
         self.cursor_location = (len(lines) - 1, len(lines[-1]))
 
+    # ============== Ctrl+R 反向搜索 ==============
+
+    def _start_search(self) -> None:
+        """进入搜索；已在搜索中时跳到下一条更旧的匹配"""
+        if self._search is not None:
+            self._step_search(1)
+            return
+        self._search = {"query": "", "matches": [], "pos": 0, "original": self.text}
+        self._update_search()
+
+    def _handle_search_key(self, event, key_lower: str) -> bool:
+        """搜索模式按键；返回 False 表示退出搜索后按普通按键继续处理"""
+        search = self._search
+        if key_lower in ("ctrl+r", "up"):
+            self._step_search(1)
+        elif key_lower in ("ctrl+s", "down"):
+            self._step_search(-1)
+        elif key_lower == "enter":
+            self._end_search(accept=True)  # 只填入输入框，不直接发送
+        elif key_lower in ("escape", "ctrl+g"):
+            self._end_search(accept=False)
+        elif key_lower == "backspace":
+            search["query"] = search["query"][:-1]
+            self._update_search()
+        elif event.is_printable and event.character:
+            search["query"] += event.character
+            self._update_search()
+        else:
+            # 其他按键 (方向键、快捷键等)：接受当前匹配，按键照常生效
+            self._end_search(accept=True)
+            return False
+        return True
+
+    def _update_search(self) -> None:
+        search = self._search
+        search["matches"] = input_history.search(search["query"])
+        search["pos"] = 0
+        self._show_search()
+
+    def _step_search(self, step: int) -> None:
+        search = self._search
+        if search["matches"]:
+            search["pos"] = max(0, min(search["pos"] + step, len(search["matches"]) - 1))
+        self._show_search()
+
+    def _show_search(self) -> None:
+        """输入框显示当前匹配，标题显示查询与位置"""
+        search = self._search
+        matches = search["matches"]
+        if matches:
+            self._set_text(matches[search["pos"]])
+            status = f"({search['pos'] + 1}/{len(matches)})"
+        else:
+            status = "(无匹配)"
+        self._set_header(f"🔍 反向搜索: {search['query']}▏ {status} │ Enter 选用 · Esc 取消")
+
+    def _end_search(self, accept: bool) -> None:
+        search = self._search
+        self._search = None
+        if not accept or not search["matches"]:
+            self._set_text(search["original"])
+        self._history_index = None
+        self._set_header(None)
+
+    def _set_header(self, text: str | None) -> None:
+        if isinstance(self.parent, InlineInputContainer):
+            self.parent.set_header(text)
+
+    @tracer.traced("input.do_submit")
     def _do_submit(self) -> None:
         """执行提交"""
         val = self.text.strip()
         if val:
-            # 记录到历史 (避免连续重复)
-            if not self.HISTORY or self.HISTORY[-1] != val:
-                self.HISTORY.append(val)
+            # 记录到历史 (重复的只保留最近一次，写入磁盘)
+            input_history.add(val)
             
             self.post_message(self.Submitted(val, self))
             self.text = ""
@@ -240,25 +338,43 @@ class MessageLog(ScrollableContainer):
         super().__init__(*args, **kwargs)
         self._current_input: InlineInput | None = None
     
+    def _mount_message(self, bubble) -> None:
+        """挂载消息气泡 (始终位于输入框之上)"""
+        container = self._current_input.parent if self._current_input else None
+        if container is not None and container.parent is self:
+            self.mount(bubble, before=container)
+        else:
+            self.mount(bubble)
+        self.scroll_end(animate=False)
+    
     def add_user_message(self, content: str) -> UserBubble:
         """添加用户消息"""
         bubble = UserBubble(content)
-        self.mount(bubble)
-        self.scroll_end(animate=False)
+        self._mount_message(bubble)
         return bubble
     
     def add_ai_message_streaming(self, model_name: str = "AI") -> GlitchAIBubble:
         """创建流式 AI 消息气泡 (带 Glitch 动画)"""
         bubble = GlitchAIBubble(model_name=model_name)
-        self.mount(bubble)
-        self.scroll_end(animate=False)
+        self._mount_message(bubble)
         return bubble
     
+    def add_ai_message(self, model_name: str, content: str, state: str = "done") -> GlitchAIBubble:
+        """按已有内容恢复 AI 气泡 (切换标签页时使用)"""
+        bubble = GlitchAIBubble(model_name=model_name, content=content, state=state)
+        self._mount_message(bubble)
+        return bubble
+    
+    def add_compare_view(self, run) -> CompareView:
+        """添加多模型并排对比视图"""
+        view = CompareView(run)
+        self._mount_message(view)
+        return view
+    
     def add_system_message(self, content: str) -> SystemBubble:
         """添加系统消息"""
         bubble = SystemBubble(content)
-        self.mount(bubble)
-        self.scroll_end(animate=False)
+        self._mount_message(bubble)
         return bubble
     
     def create_inline_input(self) -> InlineInput:
@@ -274,6 +390,11 @@ class MessageLog(ScrollableContainer):
         self._current_input = input_widget
         return input_widget
     
+    def remove_inline_input(self) -> None:
+        """移除当前输入框容器 (提交后 / 会话生成中)"""
+        self.query(InlineInputContainer).remove()
+        self._current_input = None
+    
     def clear_messages(self) -> None:
         """清空所有消息"""
         for child in list(self.children):
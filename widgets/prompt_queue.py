@@ -0,0 +1,37 @@
+"""
+待发送队列 - 回答生成期间提交的问题排在这里
+- 停靠在底部，队列为空时隐藏
+- 每项压成一行，按显示宽度截断 (中英文混排对齐)
+"""
+from rich.text import Text
+from textual.widgets import Static
+
+from utils.text_width import truncate
+
+# 最多展示的条数 (其余折叠为 "+N")
+MAX_VISIBLE = 5
+
+
+class PromptQueue(Static):
+    """当前会话的待发送问题列表"""
+
+    def on_mount(self) -> None:
+        self.display = False
+
+    def show_items(self, items: list[str]) -> None:
+        """刷新队列内容 (空列表时隐藏)"""
+        if not items:
+            self.display = False
+            return
+        width = max(20, self.size.width - 8) if self.size.width else 80
+        text = Text()
+        text.append(f"📥 待发送 {len(items)} 条", style="bold yellow")
+        text.append("  (/queue 管理)", style="dim")
+        for i, item in enumerate(items[:MAX_VISIBLE], 1):
+            line = " ".join(item.split())  # 多行问题压成一行
+            text.append(f"\n {i}. ", style="yellow")
+            text.append(truncate(line, width, "…"))
+        if len(items) > MAX_VISIBLE:
+            text.append(f"\n    +{len(items) - MAX_VISIBLE} 条...", style="dim")
+        self.update(text)
+        self.display = True
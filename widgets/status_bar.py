@@ -12,11 +12,15 @@ from textual import work
 from rich.text import Text
 import random
 
+from .frame_scheduler import get_frame_scheduler
+from utils.text_width import display_width, truncate
+
 
 class StatusBar(Static):
     """
     底部多功能状态栏 (极简版)
     - 天气分两行（今天/明天）
+    - 新闻翻页轮播
     - 系统监控（CPU/GPU/内存/磁盘/网络）
     """
     
@@ -45,6 +49,7 @@ class StatusBar(Static):
     # 插件数据
     weather_today: reactive[str] = reactive("🌤️ 今日天气加载中...")
     weather_tomorrow: reactive[str] = reactive("📅 明日天气加载中...")
+    news_text: reactive[str] = reactive("📰 新闻加载中...")
     
     # 动态天气图标帧 (避免在 render() 中使用 time.time())
     weather_icon_frame: reactive[int] = reactive(0)
@@ -55,24 +60,35 @@ class StatusBar(Static):
     _turn_target: int = 0
     _total_target: int = 0
     _animating: bool = False
+    _token_handle: int | None = None
     
     def on_mount(self) -> None:
         """启动各模块的异步刷新"""
-        # 高频刷新 (每秒)
-        self.set_interval(1.0, self._refresh_system)
-        
-        # 天气图标动画 (每0.5秒切换一帧)
-        self.set_interval(0.5, self._update_weather_icon)
-        
-        # Token 动画 (每50ms) - 保留逻辑以支持心跳特效
-        self.set_interval(0.05, self._animate_tokens)
+        scheduler = get_frame_scheduler(self)
+        self._frame_handles = [
+            # 系统监控 (每秒)
+            scheduler.subscribe(self, self._refresh_system, fps=1),
+            # 天气图标动画 (每0.5秒切换一帧)
+            scheduler.subscribe(self, self._update_weather_icon, fps=2),
+            # 新闻翻页 (只读内存，缓存过期时新闻模块自行排后台刷新)
+            scheduler.subscribe(self, self._update_news, fps=1),
+        ]
+        # Token 动画 (每50ms) 只在 add_tokens 后临时订阅
         
-        # 启动异步数据加载 (仅天气)
+        # 启动异步数据加载
         self._load_weather()
+        self._update_news()
         
         # 定时刷新 (每5分钟)
         self.set_interval(300.0, self._refresh_all_plugins)
     
+    def on_unmount(self) -> None:
+        scheduler = get_frame_scheduler(self)
+        for handle in self._frame_handles:
+            scheduler.unsubscribe(handle)
+        scheduler.unsubscribe(self._token_handle)
+        self._token_handle = None
+    
     def _update_weather_icon(self) -> None:
         """更新天气图标帧 (避免 render() 中产生副作用)"""
         self.weather_icon_frame = (self.weather_icon_frame + 1) % 6
@@ -84,6 +100,8 @@ class StatusBar(Static):
         self._total_target += turn_tokens
         self._animating = True
         self.turn_tokens = 0
+        if self._token_handle is None:
+            self._token_handle = get_frame_scheduler(self).subscribe(self, self._animate_tokens, fps=20)
     
     def _animate_tokens(self) -> None:
         """Token 数字滚动动画"""
@@ -100,6 +118,8 @@ class StatusBar(Static):
         
         if self.turn_tokens >= self._turn_target and self.total_tokens >= self._total_target:
             self._animating = False
+            get_frame_scheduler(self).unsubscribe(self._token_handle)
+            self._token_handle = None
     
     # ============== 实时刷新 ==============
     def _refresh_system(self) -> None:
@@ -134,24 +154,38 @@ class StatusBar(Static):
             pass  # 系统监控刷新失败不影响主流程
     
     # ============== 异步数据加载 ==============
-    @work(thread=True, exclusive=False)
-    def _load_weather(self) -> None:
-        """后台加载天气"""
+    @work(exclusive=True, group="weather")
+    async def _load_weather(self) -> None:
+        """加载天气 (缓存优先，过期时后台刷新完成再更新一次)"""
         try:
             from utils.weather import weather_fetcher
-            today, tomorrow = weather_fetcher.fetch()
-            import re
-            today_clean = re.sub(r'\[/?[^\]]*\]', '', today)
-            tomorrow_clean = re.sub(r'\[/?[^\]]*\]', '', tomorrow)
-            self.weather_today = f"🌤️ 今日: {today_clean}"
-            self.weather_tomorrow = f"📅 明日: {tomorrow_clean}"
+            today, tomorrow = await weather_fetcher.fetch(on_update=self._apply_weather)
+            self._apply_weather(today, tomorrow)
         except Exception:
             self.weather_today = "🌤️ 今日: 天气服务异常"
             self.weather_tomorrow = "📅 明日: --"
     
+    def _apply_weather(self, today: str, tomorrow: str) -> None:
+        """去掉 Rich 标记后写入显示"""
+        import re
+        today_clean = re.sub(r'\[/?[^\]]*\]', '', today)
+        tomorrow_clean = re.sub(r'\[/?[^\]]*\]', '', tomorrow)
+        self.weather_today = f"🌤️ 今日: {today_clean}"
+        self.weather_tomorrow = f"📅 明日: {tomorrow_clean}"
+    
+    def _update_news(self) -> None:
+        """刷新新闻行 (每4秒翻一条)"""
+        try:
+            from utils.news import news_fetcher
+            self.news_text = news_fetcher.get_scrolling_text(self.content_size.width or 60)
+        except Exception:
+            pass  # 新闻失败不影响主流程
+    
     def _refresh_all_plugins(self) -> None:
-        """定时刷新所有插件"""
+        """定时刷新所有插件 (缓存新鲜时不会触网)"""
         self._load_weather()
+        from utils.news import news_fetcher
+        news_fetcher.request_refresh()
     
     # ============== 渲染 ==============
     def _make_bar(self, percent: float, width: int = 8) -> tuple[str, str]:
@@ -171,13 +205,18 @@ class StatusBar(Static):
         weather_line = Text()
         weather_line.append(f"{w_icons[self.weather_icon_frame]} ", style="bright_yellow")
         weather_content = self.weather_today.replace("🌤️ ", "")
-        weather_line.append(weather_content, style="bright_cyan")
+        max_width = self.content_size.width or 200
+        icon_width = display_width(w_icons[self.weather_icon_frame]) + 1
+        weather_line.append(truncate(weather_content, max_width - icon_width, "…"), style="bright_cyan")
         lines.append(weather_line)
         
         # 第2行: 明日天气
-        lines.append(Text(self.weather_tomorrow, style="cyan"))
+        lines.append(Text(truncate(self.weather_tomorrow, max_width, "…"), style="cyan"))
+        
+        # 第3行: 新闻
+        lines.append(Text(truncate(self.news_text, max_width, "…"), style="bright_white"))
         
-        # 第3行: 系统监控 (Emoji 版)
+        # 第4行: 系统监控 (Emoji 版)
         line_sys = Text()
         
         # 动态心跳图标